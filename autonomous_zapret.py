@@ -15,9 +15,12 @@ import signal
 import time
 import logging
 import argparse
-from core.db import StrategyDB
+from typing import Optional
+from core.db import StrategyDB, get_db
 from core.strategy_applicator import get_applicator
 from solver.parallel_prober import ParallelProber
+from solver.batch_solver import BatchSolver
+from solver.bandit import configured_isp
 
 # Setup Logging
 logging.basicConfig(
@@ -34,60 +37,71 @@ def check_root():
 def signal_handler(sig, frame):
     logging.info("Shutdown signal received...")
     applicator = get_applicator()
-    applicator.cleanup()
+    applicator.stop()
     logging.info("Cleanup complete. Exiting.")
     sys.exit(0)
 
-def apply_saved_strategies():
+def apply_saved_strategies(db: Optional[StrategyDB] = None):
     """Apply all saved strategies from database on startup."""
-    db = StrategyDB()
+    db = db or get_db()
     applicator = get_applicator()
     
-    try:
-        import sqlite3
-        conn = sqlite3.connect(db.db_path)
-        cursor = conn.cursor()
-        cursor.execute("SELECT DISTINCT strategy FROM domains LIMIT 1")
-        row = cursor.fetchone()
-        conn.close()
-        
-        if row:
-            strategy = row[0]
-            logging.info(f"Applying saved strategy: {strategy}")
-            applicator.apply(strategy)
-            return True
-    except Exception as e:
-        logging.debug(f"No saved strategies: {e}")
-    
-    return False
+    # The whole domains table in one nfqws: a profile per strategy
+    saved = db.all_strategies()
+    if not saved:
+        return False
+    logging.info(f"Applying {len(saved)} saved domains ({len(set(saved.values()))} strategies)")
+    return applicator.apply_many(saved)
 
-def solve_and_apply(domain: str):
+def solve_and_apply(domain: str, db: Optional[StrategyDB] = None, isp: Optional[str] = None):
     """Solve for a domain and apply the strategy."""
-    db = StrategyDB()
+    db = db or get_db()
     applicator = get_applicator()
     
     # Check cache first
     cached = db.get_strategy(domain)
     if cached:
         logging.info(f"Using cached strategy '{cached}' for {domain}")
-        return applicator.apply(cached)
+        return applicator.apply(cached, [domain])
     
     # Solve
     logging.info(f"No cached strategy for {domain}, probing...")
-    prober = ParallelProber(domain)
+    prober = ParallelProber(domain, isp=isp)
     strategy = prober.solve()
     
     if strategy:
-        db.save_strategy(domain, strategy)
-        return applicator.apply(strategy)
+        db.save_strategy(domain, strategy, isp=prober.isp)
+        return applicator.apply(strategy, [domain])
     else:
         logging.error(f"Could not find working strategy for {domain}")
         return False
 
+def solve_and_apply_many(domains: list, db: Optional[StrategyDB] = None, isp: Optional[str] = None):
+    """Solve several domains together (one probe run per edge) and apply them."""
+    db = db or get_db()
+    applicator = get_applicator()
+    
+    strategies = db.get_strategies(domains)
+    unsolved = [domain for domain, strategy in strategies.items() if not strategy]
+    if unsolved:
+        logging.info(f"No cached strategy for {len(unsolved)} domains, batch probing...")
+        solver = BatchSolver(unsolved, isp=isp)
+        solved = {domain: strategy for domain, strategy in solver.solve().items() if strategy}
+        db.save_strategies(solved, isp=solver.isp)
+        strategies.update(solved)
+    
+    for domain, strategy in strategies.items():
+        if not strategy:
+            logging.error(f"Could not find working strategy for {domain}")
+    active = {domain: strategy for domain, strategy in strategies.items() if strategy}
+    return bool(active) and applicator.apply_many(active)
+
 def main():
     parser = argparse.ArgumentParser(description='Autonomous Zapret Service')
     parser.add_argument('--domains', nargs='*', help='Domains to bypass (optional)')
     parser.add_argument('--daemon', action='store_true', help='Run as daemon')
+    parser.add_argument('--isp', default=configured_isp(),
+                        help='ISP label probe history is scoped by (default: $ZAPRET_ISP or Unknown)')
     args = parser.parse_args()
     
     check_root()
@@ -99,16 +113,18 @@ def main():
     logging.info("="*50)
     
     # Initialize
-    db = StrategyDB()
+    db = get_db()
     applicator = get_applicator()
     
     # If domains provided, solve for them
     if args.domains:
-        for domain in args.domains:
-            solve_and_apply(domain)
+        if len(args.domains) > 1:
+            solve_and_apply_many(args.domains, db, args.isp)
+        else:
+            solve_and_apply(args.domains[0], db, args.isp)
     else:
         # Try to apply any saved strategy
-        if apply_saved_strategies():
+        if apply_saved_strategies(db):
             logging.info("Bypass active with saved strategy")
         else:
             logging.warning("No saved strategies. Use --domains to add some.")
@@ -123,13 +139,12 @@ def main():
                     time.sleep(5)
                 else:
                     logging.warning("nfqws process died, restarting...")
-                    if applicator.active_strategy:
-                        applicator.apply(applicator.active_strategy)
+                    applicator.restart()
                     time.sleep(1)
         except KeyboardInterrupt:
             pass
     
-    applicator.cleanup()
+    applicator.stop()
     logging.info("Service stopped.")
 
 if __name__ == "__main__":
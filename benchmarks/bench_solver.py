@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Benchmark: solve latency and correctness against the local DPI test bed
+Builds the namespace path from testbed/lab.py and solves a blocked domain
+once per run for each emulator profile. Every winner is confirmed with a
+full handshake plus an HTTP exchange through its nfqws. A strategy that
+only got a ServerHello past the filter, or past a server that then choked
+on a fake, counts as a false positive. 'strict' has no hole, so the only
+correct answer there is no winner.
+Needs root, iproute2, iptables, nfqws and NetfilterQueue.
+Usage: sudo python3 benchmarks/bench_solver.py [--profiles split,fake-ttl] [--runs 3] [--engine thread|async]
+"""
+import os
+import sys
+import time
+import asyncio
+import logging
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from core.firewall import RuleBatch, get_firewall
+from solver.async_prober import AsyncProber
+from solver.heuristics import PRIORITY_LIST
+from solver.nfqws_pool import get_nfqws_pool
+from solver.parallel_prober import MAX_PARALLEL, PROBE_TIMEOUT, ParallelProber, _reserve_port
+from solver.tls_probe import probe_tls
+from testbed.dpi_emulator import PROFILES
+from testbed.lab import BLOCKED_DOMAINS, SERVER_IP, DpiTestbed
+
+
+def solve_once(engine: str, domain: str, max_parallel: int):
+    """One solve without history (static order); returns (winner, seconds, probes run)."""
+    # The test bed path is IPv4 only
+    kwargs = dict(enable_telemetry=False, adaptive=False, max_parallel=max_parallel, resolved_ip=SERVER_IP,
+                  dual_stack=False)
+    start = time.perf_counter()
+    if engine == 'async':
+        prober = AsyncProber(domain, **kwargs)
+
+        async def run():
+            winner = await prober.solve()
+            elapsed = time.perf_counter() - start
+            await prober.wait_cleanup()
+            return winner, elapsed
+        winner, elapsed = asyncio.run(run())
+    else:
+        prober = ParallelProber(domain, **kwargs)
+        winner = prober.solve()
+        elapsed = time.perf_counter() - start
+        prober.wait_cleanup()
+    return winner, elapsed, len(prober.results)
+
+
+def confirm(strategy: str, domain: str) -> bool:
+    """Full handshake + HTTP response through the strategy's nfqws."""
+    worker = get_nfqws_pool().acquire(strategy)
+    if worker is None:
+        return False
+    sock = _reserve_port()
+    source_port = sock.getsockname()[1]
+    rule = ['OUTPUT', '-p', 'tcp', '--sport', str(source_port), '--dport', '443', '-d', SERVER_IP,
+            '-j', 'NFQUEUE', '--queue-num', str(worker.queue_num), '--queue-bypass']
+    if not get_firewall().commit(RuleBatch().insert(rule)):
+        sock.close()
+        return False
+    try:
+        return probe_tls(SERVER_IP, domain, timeout=PROBE_TIMEOUT, sock=sock, http=True).ok
+    finally:
+        get_firewall().commit(RuleBatch().delete(rule))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Solver benchmark on the DPI test bed')
+    parser.add_argument('--profiles', default=','.join(PROFILES), help='Comma-separated emulator profiles')
+    parser.add_argument('--runs', type=int, default=3, help='Solves per profile')
+    parser.add_argument('--engine', choices=('thread', 'async'), default='thread')
+    parser.add_argument('--parallel', type=int, default=MAX_PARALLEL)
+    args = parser.parse_args()
+
+    if os.geteuid() != 0:
+        parser.error("needs root (network namespaces, iptables, NFQUEUE)")
+    profiles = [p for p in args.profiles.split(',') if p]
+    unknown = [p for p in profiles if p not in PROFILES]
+    if unknown:
+        parser.error(f"unknown profile(s): {', '.join(unknown)}")
+
+    logging.basicConfig(level=logging.WARNING, format='%(message)s')
+    domain = BLOCKED_DOMAINS[0]
+    # Spawn cost is not part of a solve: workers stay warm across runs
+    get_nfqws_pool().warm(PRIORITY_LIST)
+
+    print(f"{'profile':<14}{'median s':>10}{'max s':>8}{'probes':>8}{'correct':>9}  winners")
+    with DpiTestbed() as lab:
+        for profile in profiles:
+            lab.set_profile(profile)
+            times, probes, winners, correct = [], [], [], 0
+            for _ in range(args.runs):
+                winner, elapsed, count = solve_once(args.engine, domain, args.parallel)
+                times.append(elapsed)
+                probes.append(count)
+                winners.append(winner or '-')
+                if profile == 'strict':
+                    correct += winner is None
+                else:
+                    correct += winner is not None and confirm(winner, domain)
+            print(f"{profile:<14}{statistics.median(times):>10.2f}{max(times):>8.2f}"
+                  f"{statistics.median(probes):>8.0f}{correct:>6}/{args.runs:<2}  {', '.join(winners)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Benchmark: StrategyDB lookups/s and writes/s
+Compares the old connect-per-call implementation against the current one
+(in-memory reads, write-behind over a WAL connection). Write throughput
+includes the final flush, so deferred writes are not counted as free.
+Uses a throwaway temp DB.
+Usage: python3 benchmarks/bench_strategy_db.py [-n 2000] [--threads 4]
+"""
+import os
+import sys
+import time
+import logging
+import sqlite3
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from core.db import StrategyDB
+
+
+class LegacyStrategyDB:
+    """The pre-WAL StrategyDB: new connection and commit per call, one global lock."""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        conn = sqlite3.connect(db_path)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS domains (
+                domain TEXT PRIMARY KEY, strategy TEXT NOT NULL, isp TEXT,
+                last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP, success_count INTEGER DEFAULT 1
+            )
+        ''')
+        conn.commit()
+        conn.close()
+
+    def get_strategy(self, domain):
+        with self.lock:
+            conn = sqlite3.connect(self.db_path)
+            row = conn.execute("SELECT strategy FROM domains WHERE domain = ?", (domain,)).fetchone()
+            conn.close()
+            return row[0] if row else None
+
+    def save_strategy(self, domain, strategy, isp="Unknown"):
+        with self.lock:
+            conn = sqlite3.connect(self.db_path)
+            conn.execute('''
+                INSERT INTO domains (domain, strategy, isp, success_count) VALUES (?, ?, ?, 1)
+                ON CONFLICT(domain) DO UPDATE SET strategy=excluded.strategy,
+                    last_updated=CURRENT_TIMESTAMP, success_count=success_count + 1
+            ''', (domain, strategy, isp))
+            conn.commit()
+            conn.close()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def run_threads(fn, threads: int, per_thread: int) -> float:
+    """Run fn(thread_idx, i) from several threads; returns ops/s."""
+    def worker(t):
+        for i in range(per_thread):
+            fn(t, i)
+    pool = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+    start = time.perf_counter()
+    for p in pool:
+        p.start()
+    for p in pool:
+        p.join()
+    return threads * per_thread / (time.perf_counter() - start)
+
+
+def bench(db_cls, path: str, n: int, threads: int):
+    db = db_cls(path)
+    per_thread = max(n // threads, 1)
+    start = time.perf_counter()
+    run_threads(lambda t, i: db.save_strategy(f"d{t}-{i}.example", "fake_ttl3"), threads, per_thread)
+    db.flush()
+    writes = threads * per_thread / (time.perf_counter() - start)
+    reads = run_threads(lambda t, i: db.get_strategy(f"d{t}-{i}.example"), threads, per_thread)
+    db.close()
+    return reads, writes
+
+
+def bench_bulk(path: str, n: int):
+    """save_strategies / get_strategies over n domains; returns (reads/s, writes/s)."""
+    db = StrategyDB(path)
+    domains = [f"bulk{i}.example" for i in range(n)]
+    start = time.perf_counter()
+    db.save_strategies({domain: "fake_ttl3" for domain in domains})
+    writes = n / (time.perf_counter() - start)
+    start = time.perf_counter()
+    db.get_strategies(domains)
+    reads = n / (time.perf_counter() - start)
+    db.close()
+    return reads, writes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='StrategyDB benchmark')
+    parser.add_argument('-n', type=int, default=2000, help='Operations per phase')
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--bulk', type=int, default=10000, help='Domains for the bulk API phase')
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+
+    print(f"{'impl':<10}{'lookups/s':>14}{'writes/s':>14}")
+    for name, cls in (('legacy', LegacyStrategyDB), ('current', StrategyDB)):
+        with tempfile.TemporaryDirectory() as tmp:
+            reads, writes = bench(cls, os.path.join(tmp, 'bench.db'), args.n, args.threads)
+        print(f"{name:<10}{reads:>14,.0f}{writes:>14,.0f}")
+    with tempfile.TemporaryDirectory() as tmp:
+        reads, writes = bench_bulk(os.path.join(tmp, 'bench.db'), args.bulk)
+    print(f"{'bulk':<10}{reads:>14,.0f}{writes:>14,.0f}")
+
+
+if __name__ == '__main__':
+    main()
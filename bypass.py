@@ -1,13 +1,14 @@
 #!/usr/bin/env python3
 """
 ZAPRET BYPASS - STANDALONE SCRIPT
-No dependencies on other files, self-contained solution.
+Self-contained apart from core/firewall.py, which installs its rules in one
+transaction.
 
 Usage:
     sudo python3 bypass.py turbo.cr jpg6.su
 
 This script:
-1. Uses DoH to bypass DNS poisoning
+1. Uses DoH to bypass DNS poisoning (A and AAAA: dual-stack targets are bypassed on both)
 2. Applies nfqws with working strategies
 3. Keeps bypass running in background
 """
@@ -20,10 +21,12 @@ import time
 import shlex
 import requests
 import urllib3
+from core.firewall import RuleBatch, get_firewall
 urllib3.disable_warnings()
 
 # ===== CONFIGURATION =====
 NFQUEUE_NUM = 200
+DOH_TYPES = {"A": (1, socket.AF_INET), "AAAA": (28, socket.AF_INET6)}
 NFQWS_PATH = shutil.which('nfqws') or '/usr/bin/nfqws'
 
 # Proven strategies for Turkey ISPs
@@ -40,15 +43,20 @@ def check_root():
         print("❌ Root gerekli: sudo python3 bypass.py <domain>")
         sys.exit(1)
 
-def resolve_via_doh(domain: str) -> str:
-    """Cloudflare DoH ile gerçek IP'yi al."""
-    print(f"[DoH] {domain} için gerçek IP alınıyor...")
+def _usable(ip: str) -> bool:
+    """Zehirli cevaplar (0.x, 127.0.0.1, ::, ::1) sayılmaz."""
+    return bool(ip) and not ip.startswith("0.") and ip not in ("127.0.0.1", "::", "::1")
+
+def resolve_via_doh(domain: str, record_type: str = "A") -> str:
+    """Cloudflare DoH ile gerçek IP'yi al (record_type: A veya AAAA)."""
+    rr_type, family = DOH_TYPES[record_type]
+    print(f"[DoH] {domain} için gerçek IP alınıyor ({record_type})...")
     
     try:
         # Cloudflare DoH
         resp = requests.get(
             "https://cloudflare-dns.com/dns-query",
-            params={"name": domain, "type": "A"},
+            params={"name": domain, "type": record_type},
             headers={"Accept": "application/dns-json"},
             timeout=10,
             verify=False
@@ -57,9 +65,9 @@ def resolve_via_doh(domain: str) -> str:
         
         if "Answer" in data:
             for ans in data["Answer"]:
-                if ans.get("type") == 1:
+                if ans.get("type") == rr_type:
                     ip = ans.get("data")
-                    if ip and not ip.startswith("0.") and ip != "127.0.0.1":
+                    if _usable(ip):
                         print(f"[DoH] ✓ {domain} -> {ip}")
                         return ip
     except Exception as e:
@@ -69,7 +77,7 @@ def resolve_via_doh(domain: str) -> str:
         # Google DoH fallback
         resp = requests.get(
             "https://dns.google/resolve",
-            params={"name": domain, "type": "A"},
+            params={"name": domain, "type": record_type},
             timeout=10,
             verify=False
         )
@@ -77,9 +85,9 @@ def resolve_via_doh(domain: str) -> str:
         
         if "Answer" in data:
             for ans in data["Answer"]:
-                if ans.get("type") == 1:
+                if ans.get("type") == rr_type:
                     ip = ans.get("data")
-                    if ip and not ip.startswith("0.") and ip != "127.0.0.1":
+                    if _usable(ip):
                         print(f"[DoH] ✓ {domain} -> {ip} (Google)")
                         return ip
     except Exception as e:
@@ -87,49 +95,66 @@ def resolve_via_doh(domain: str) -> str:
     
     # Last resort: normal DNS
     try:
-        ip = socket.gethostbyname(domain)
-        if not ip.startswith("0."):
+        ip = socket.getaddrinfo(domain, 443, family, socket.SOCK_STREAM)[0][4][0]
+        if _usable(ip):
             return ip
     except:
         pass
     
-    print(f"[DoH] ❌ IP alınamadı!")
+    print(f"[DoH] ❌ {record_type} alınamadı!")
     return None
 
+def has_ipv6_route() -> bool:
+    """IPv6 internete yol var mı? (UDP connect paket göndermez)"""
+    try:
+        with socket.socket(socket.AF_INET6, socket.SOCK_DGRAM) as s:
+            s.connect(("2001:4860:4860::8888", 53))
+        return True
+    except OSError:
+        return False
+
 def cleanup():
     """Eski kuralları temizle."""
     print("[CLEANUP] Eski kurallar temizleniyor...")
     subprocess.run(['pkill', '-9', 'nfqws'], capture_output=True)
-    subprocess.run(['iptables', '-t', 'mangle', '-F', 'POSTROUTING'], capture_output=True)
-    subprocess.run(['iptables', '-t', 'mangle', '-F', 'OUTPUT'], capture_output=True)
+    # Sadece kendi zincirlerimiz: diğer araçların kuralları yerinde kalır
+    get_firewall().teardown()
 
-def add_iptables_rules(target_ip: str):
-    """NFQUEUE kuralları ekle."""
-    print(f"[IPTABLES] Kurallar ekleniyor ({target_ip})...")
+def add_iptables_rules(target_ips: list):
+    """NFQUEUE kuralları ekle (IPv6 adresleri ip6tables'a)."""
+    print(f"[IPTABLES] Kurallar ekleniyor ({', '.join(target_ips)})...")
+    batch = RuleBatch()
     
-    # POSTROUTING için (genel)
-    subprocess.run([
-        'iptables', '-t', 'mangle', '-A', 'POSTROUTING',
-        '-p', 'tcp', '-m', 'multiport', '--dports', '80,443',
-        '-m', 'connbytes', '--connbytes-dir=original', '--connbytes-mode=packets', '--connbytes', '1:6',
-        '-m', 'mark', '!', '--mark', '0x40000000/0x40000000',
-        '-j', 'NFQUEUE', '--queue-num', str(NFQUEUE_NUM), '--queue-bypass'
-    ], capture_output=True)
+    # POSTROUTING için (genel), hedeflerin her ailesi için bir kez
+    for family in sorted({6 if ':' in ip else 4 for ip in target_ips}):
+        batch.append([
+            'POSTROUTING',
+            '-p', 'tcp', '-m', 'multiport', '--dports', '80,443',
+            '-m', 'connbytes', '--connbytes-dir=original', '--connbytes-mode=packets', '--connbytes', '1:6',
+            '-m', 'mark', '!', '--mark', '0x40000000/0x40000000',
+            '-j', 'NFQUEUE', '--queue-num', str(NFQUEUE_NUM), '--queue-bypass'
+        ], family=family)
     
     # OUTPUT için (spesifik IP)
-    subprocess.run([
-        'iptables', '-t', 'mangle', '-A', 'OUTPUT',
-        '-p', 'tcp', '--dport', '443', '-d', target_ip,
-        '-j', 'NFQUEUE', '--queue-num', str(NFQUEUE_NUM), '--queue-bypass'
-    ], capture_output=True)
+    for target_ip in target_ips:
+        batch.append([
+            'OUTPUT',
+            '-p', 'tcp', '--dport', '443', '-d', target_ip,
+            '-j', 'NFQUEUE', '--queue-num', str(NFQUEUE_NUM), '--queue-bypass'
+        ])
     
-    print("[IPTABLES] ✓ Kurallar eklendi")
+    # İkisi tek transaction'da: ya hepsi ya hiçbiri
+    if get_firewall().commit(batch):
+        print("[IPTABLES] ✓ Kurallar eklendi")
+    else:
+        print("[IPTABLES] ❌ Kurallar eklenemedi")
 
 def test_connection(domain: str, ip: str) -> bool:
     """Bağlantıyı test et."""
+    host = f"[{ip}]" if ':' in ip else ip
     try:
         resp = requests.get(
-            f"https://{ip}",
+            f"https://{host}",
             headers={"Host": domain, "User-Agent": "Mozilla/5.0"},
             timeout=8,
             verify=False,
@@ -150,8 +175,8 @@ def start_nfqws(strategy_args: str) -> subprocess.Popen:
     )
     return proc
 
-def find_working_strategy(domain: str, ip: str) -> str:
-    """Çalışan stratejiyi bul."""
+def find_working_strategy(domain: str, ips: list) -> str:
+    """Çalışan stratejiyi bul: her adres ailesinde (IPv4/IPv6) çalışmalı."""
     print(f"\n[PROBE] Stratejiler test ediliyor...")
     
     for name, args in STRATEGIES:
@@ -162,7 +187,7 @@ def find_working_strategy(domain: str, ip: str) -> str:
         time.sleep(0.5)
         
         # Test et
-        if test_connection(domain, ip):
+        if all(test_connection(domain, ip) for ip in ips):
             print("✓ ÇALIŞIYOR!")
             return name, args, proc
         else:
@@ -193,28 +218,31 @@ def main():
     for domain in domains:
         print(f"\n[TARGET] {domain}")
         
-        # 1. DNS çöz (DoH ile)
-        ip = resolve_via_doh(domain)
-        if not ip:
+        # 1. DNS çöz (DoH ile); IPv6 sadece yolu varsa
+        ips = [resolve_via_doh(domain)]
+        if has_ipv6_route():
+            ips.append(resolve_via_doh(domain, "AAAA"))
+        ips = [ip for ip in ips if ip]
+        if not ips:
             print(f"❌ {domain} için IP alınamadı, atlanıyor...")
             continue
         
         # 2. iptables kuralları ekle
-        add_iptables_rules(ip)
+        add_iptables_rules(ips)
         
         # 3. Çalışan stratejiyi bul
-        name, args, proc = find_working_strategy(domain, ip)
+        name, args, proc = find_working_strategy(domain, ips)
         
         if proc:
             print(f"\n{'='*50}")
             print(f"  ✓ BYPASS AKTİF!")
             print(f"  Domain: {domain}")
-            print(f"  IP: {ip}")
+            print(f"  IP: {', '.join(ips)}")
             print(f"  Strateji: {name}")
             print(f"  nfqws PID: {proc.pid}")
             print(f"{'='*50}")
             print("\nTerminal serbest, nfqws arka planda çalışıyor.")
-            print("Durdurmak için: sudo pkill nfqws && sudo iptables -t mangle -F")
+            print("Durdurmak için: sudo python3 zapret-cli.py stop")
             break
         else:
             print(f"❌ {domain} için çalışan strateji bulunamadı")
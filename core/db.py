@@ -1,19 +1,68 @@
 import sqlite3
 import threading
 import logging
-from typing import Optional, Dict
+import atexit
+from typing import Optional, Dict, Tuple, Iterable
+from core.domain_index import SuffixIndex
+
+# Connection tuning: WAL lets readers run alongside the single writer,
+# synchronous=NORMAL only fsyncs at checkpoints instead of every commit.
+BUSY_TIMEOUT_MS = 5000
+# Write-behind: pending updates are coalesced and committed this often
+FLUSH_INTERVAL = 0.5
+# Stay well below SQLITE_MAX_VARIABLE_NUMBER (999 on older builds)
+IN_CHUNK = 500
 
 class StrategyDB:
-    def __init__(self, db_path: str = "strategies.db"):
+    """
+    Strategy store. The whole domains table is held in memory, so lookups
+    never touch sqlite; writes update memory at once and are persisted by
+    a background thread that coalesces updates per domain into one transaction.
+    Entries may be wildcards ('*.example.com'); subdomains inherit the
+    strategy of their longest stored suffix.
+    """
+
+    def __init__(self, db_path: str = "strategies.db", flush_interval: float = FLUSH_INTERVAL):
         self.db_path = db_path
-        self.lock = threading.Lock()
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()  # Serializes writers; readers never take it
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+
+        self._cache: Dict[str, str] = {}
+        self._index = SuffixIndex()
+        # domain -> [strategy or None (delete), isp, success increments, delete first]
+        self._pending: Dict[str, list] = {}
+        self._pending_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._writer = None
+        self._closed = False
+
         self._init_db()
+        self.reload()
+        atexit.register(self.flush)
+
+    def _conn(self) -> sqlite3.Connection:
+        """Long-lived connection owned by the calling thread."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # check_same_thread=False only so close() can run from any thread;
+            # each connection is still used exclusively by its owner thread
+            conn = sqlite3.connect(self.db_path, timeout=BUSY_TIMEOUT_MS / 1000,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
 
     def _init_db(self):
         with self.lock:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute('''
+            conn = self._conn()
+            conn.execute('''
                 CREATE TABLE IF NOT EXISTS domains (
                     domain TEXT PRIMARY KEY,
                     strategy TEXT NOT NULL,
@@ -23,40 +72,173 @@ class StrategyDB:
                 )
             ''')
             conn.commit()
-            conn.close()
 
-    def get_strategy(self, domain: str) -> Optional[str]:
-        """Retrieve the known working strategy for a domain."""
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute("SELECT strategy FROM domains WHERE domain = ?", (domain,))
-            row = cursor.fetchone()
-            conn.close()
-            return row[0] if row else None
+    def reload(self):
+        """(Re)load the domains table into memory, e.g. after another process wrote to it."""
+        self.flush()
+        rows = self._conn().execute("SELECT domain, strategy FROM domains").fetchall()
+        self._cache = dict(rows)
+        self._index = SuffixIndex(self._cache)
+
+    def get_strategy(self, domain: str, inherit: bool = True) -> Optional[str]:
+        """
+        Retrieve the known working strategy for a domain.
+        With inherit=True a subdomain falls back to its longest stored suffix.
+        """
+        strategy = self._cache.get(domain)
+        if strategy is None and inherit:
+            match = self._index.lookup(domain)
+            if match:
+                strategy = match[1]
+        return strategy
+
+    def all_strategies(self) -> Dict[str, str]:
+        """Every stored domain -> strategy (a copy)."""
+        return dict(self._cache)
+
+    def get_strategies(self, domains: Iterable[str], inherit: bool = True) -> Dict[str, Optional[str]]:
+        """Bulk get_strategy(): every requested domain maps to its strategy or None."""
+        return {domain: self.get_strategy(domain, inherit) for domain in domains}
+
+    def match_strategy(self, domain: str) -> Optional[Tuple[str, str]]:
+        """Longest-suffix match: (stored entry, strategy) or None."""
+        return self._index.lookup(domain)
+
+    def match_strategies(self, domains: Iterable[str]) -> Dict[str, Tuple[str, str]]:
+        """Bulk match_strategy(); unmatched domains are left out."""
+        return self._index.lookup_many(domains)
 
     def save_strategy(self, domain: str, strategy: str, isp: str = "Unknown"):
         """Save a working strategy for a domain."""
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO domains (domain, strategy, isp, success_count)
-                VALUES (?, ?, ?, 1)
-                ON CONFLICT(domain) DO UPDATE SET
-                    strategy=excluded.strategy,
-                    last_updated=CURRENT_TIMESTAMP,
-                    success_count=success_count + 1
-            ''', (domain, strategy, isp))
-            conn.commit()
-            conn.close()
-            logging.info(f"Saved strategy for {domain}: {strategy}")
+        self._cache[domain] = strategy
+        self._index.add(domain, strategy)
+        with self._pending_lock:
+            op = self._pending.get(domain)
+            if op is None:
+                self._pending[domain] = [strategy, isp, 1, False]
+            else:
+                op[0], op[1] = strategy, isp
+                op[2] += 1
+        self._start_writer()
+        logging.info(f"Saved strategy for {domain}: {strategy}")
 
     def delete_strategy(self, domain: str):
         """Delete a saved strategy for a domain."""
+        self._cache.pop(domain, None)
+        self._index.remove(domain)
+        with self._pending_lock:
+            # Drops any queued save: the row is deleted and not re-inserted
+            self._pending[domain] = [None, None, 0, True]
+        self._start_writer()
+
+    def save_strategies(self, mapping: Dict[str, str], isp: str = "Unknown"):
+        """Save many domain -> strategy pairs and persist them in one transaction."""
+        with self._pending_lock:
+            for domain, strategy in mapping.items():
+                self._cache[domain] = strategy
+                self._index.add(domain, strategy)
+                op = self._pending.get(domain)
+                if op is None:
+                    self._pending[domain] = [strategy, isp, 1, False]
+                else:
+                    op[0], op[1] = strategy, isp
+                    op[2] += 1
+        self._start_writer()  # Retries the batch should this flush fail
+        self.flush()
+        logging.info(f"Saved strategies for {len(mapping)} domains")
+
+    def delete_strategies(self, domains: Iterable[str]):
+        """Delete many domains and persist the deletion in one transaction."""
+        with self._pending_lock:
+            for domain in domains:
+                self._cache.pop(domain, None)
+                self._index.remove(domain)
+                self._pending[domain] = [None, None, 0, True]
+        self._start_writer()
+        self.flush()
+
+    def _start_writer(self):
+        if self._closed:
+            # No writer thread any more: persist right away instead of queueing forever
+            self.flush()
+        elif self._writer is None:
+            self._writer = threading.Thread(target=self._write_behind, daemon=True)
+            self._writer.start()
+
+    def _requeue(self, batch: Dict[str, list]):
+        """Put a batch whose transaction failed back in front of what was queued since."""
+        with self._pending_lock:
+            for domain, op in batch.items():
+                newer = self._pending.get(domain)
+                if newer is None:
+                    self._pending[domain] = op
+                elif not newer[3]:
+                    # Newer saves build on the failed ops; a newer delete supersedes them
+                    newer[2] += op[2]
+                    newer[3] = op[3]
+
+    def _write_behind(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                logging.error(f"StrategyDB write-behind failed: {e}")
+
+    def flush(self):
+        """Persist all pending updates in a single transaction."""
         with self.lock:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM domains WHERE domain = ?", (domain,))
-            conn.commit()
-            conn.close()
+            with self._pending_lock:
+                if not self._pending:
+                    return
+                batch, self._pending = self._pending, {}
+
+            deletes = [domain for domain, op in batch.items() if op[3]]
+            upserts = [(domain, op[0], op[1], op[2]) for domain, op in batch.items() if op[0] is not None]
+            conn = self._conn()
+            try:
+                with conn:
+                    for i in range(0, len(deletes), IN_CHUNK):
+                        chunk = deletes[i:i + IN_CHUNK]
+                        conn.execute(f"DELETE FROM domains WHERE domain IN ({','.join('?' * len(chunk))})", chunk)
+                    if upserts:
+                        conn.executemany('''
+                            INSERT INTO domains (domain, strategy, isp, success_count)
+                            VALUES (?, ?, ?, ?)
+                            ON CONFLICT(domain) DO UPDATE SET
+                                strategy=excluded.strategy,
+                                last_updated=CURRENT_TIMESTAMP,
+                                success_count=success_count + excluded.success_count
+                        ''', upserts)
+            except sqlite3.Error:
+                # Busy/locked: nothing was committed, retry the batch on the next tick
+                self._requeue(batch)
+                raise
+
+    def close(self):
+        """Flush pending writes and close every connection opened by this instance."""
+        self._closed = True
+        self._wakeup.set()
+        if self._writer is not None:
+            self._writer.join(timeout=self.flush_interval * 4)
+            self._writer = None
+        self.flush()
+        atexit.unregister(self.flush)
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
+
+
+_db_instance = None
+_db_lock = threading.Lock()
+
+
+def get_db() -> StrategyDB:
+    """Process-wide StrategyDB: one cache and one writer thread shared by every caller."""
+    global _db_instance
+    with _db_lock:
+        if _db_instance is None:
+            _db_instance = StrategyDB()
+        return _db_instance
@@ -0,0 +1,82 @@
+"""
+Domain Suffix Index - reversed-label trie for strategy inheritance
+'example.com' covers example.com and every subdomain, '*.example.com'
+covers subdomains only. Lookups return the longest matching suffix, so
+'rr3---sn-xyz.googlevideo.com' inherits the strategy solved for
+'googlevideo.com' unless something more specific exists.
+"""
+from typing import Optional, Tuple, Dict, Iterable
+
+
+class _Node:
+    __slots__ = ('children', 'exact', 'wildcard')
+
+    def __init__(self):
+        self.children = {}
+        self.exact = None     # (entry, strategy) for 'label.parent'
+        self.wildcard = None  # (entry, strategy) for '*.label.parent'
+
+
+def _labels(domain: str):
+    return reversed(domain.strip().rstrip('.').lower().split('.'))
+
+
+class SuffixIndex:
+    def __init__(self, entries: Optional[Dict[str, str]] = None):
+        self._root = _Node()
+        self._size = 0
+        for domain, strategy in (entries or {}).items():
+            self.add(domain, strategy)
+
+    def __len__(self):
+        return self._size
+
+    def add(self, entry: str, strategy: str):
+        """Insert 'example.com' or '*.example.com'."""
+        wildcard = entry.startswith('*.')
+        node = self._root
+        for label in _labels(entry[2:] if wildcard else entry):
+            node = node.children.setdefault(label, _Node())
+        slot = 'wildcard' if wildcard else 'exact'
+        if getattr(node, slot) is None:
+            self._size += 1
+        setattr(node, slot, (entry, strategy))
+
+    def remove(self, entry: str):
+        wildcard = entry.startswith('*.')
+        node = self._root
+        for label in _labels(entry[2:] if wildcard else entry):
+            node = node.children.get(label)
+            if node is None:
+                return
+        slot = 'wildcard' if wildcard else 'exact'
+        if getattr(node, slot) is not None:
+            self._size -= 1
+            setattr(node, slot, None)
+
+    def lookup(self, domain: str) -> Optional[Tuple[str, str]]:
+        """Longest-suffix match: (matched entry, strategy) or None."""
+        labels = list(_labels(domain))
+        best = None
+        node = self._root
+        last = len(labels) - 1
+        for depth, label in enumerate(labels):
+            node = node.children.get(label)
+            if node is None:
+                break
+            if depth == last:
+                if node.exact is not None:
+                    best = node.exact
+            else:
+                # Proper ancestor: a wildcard is the more specific statement
+                best = node.wildcard or node.exact or best
+        return best
+
+    def lookup_many(self, domains: Iterable[str]) -> Dict[str, Tuple[str, str]]:
+        """Bulk lookup; domains without any match are left out."""
+        result = {}
+        for domain in domains:
+            match = self.lookup(domain)
+            if match is not None:
+                result[domain] = match
+        return result
@@ -0,0 +1,605 @@
+"""
+Firewall Backend - rule changes committed as one transaction
+Forking `iptables` per rule takes the xtables lock and rewrites the whole
+table every time. Here changes are collected in a RuleBatch and applied
+with a single `iptables-restore --noflush` (or `nft -f`): one exec per
+batch, and the batch lands completely or not at all.
+
+The backend is auto-detected: iptables-legacy or iptables-nft (each through
+its own *-restore), or plain nft when no iptables is installed. Rules are
+written in iptables syntax everywhere in this codebase; the nft backend
+translates the subset used here (protocol, ports, address, set match,
+connbytes, mark, NFQUEUE) into rules of its own table and deletes them by
+handle.
+
+Nothing is written into the built-in chains except one jump per chain:
+rules for OUTPUT land in our own ZAPRET_AUTO_OUTPUT (created, together
+with its jump, in the first transaction that needs it), and with nft in
+our own table. Every chain we create is recorded in STATE_PATH (in the
+root-owned runtime directory, see core.runtime), so
+teardown() - from this or any later process - is one flush-and-delete of
+what we own, however many rules there are, and never touches other tools'
+rules.
+
+IPv6 rules go through ip6tables(-restore) in a transaction of their own,
+undone again if the other family's half fails; the nft table is inet and
+holds both. A rule's family follows from its addresses (RuleBatch
+defaults), or is given explicitly for address-less rules such as set
+matches.
+
+Concurrent callers (probe threads) go through submit(): batches arriving
+while a transaction is running are folded into the next one. Coroutines
+use AsyncFirewall instead, which folds batches on the event loop and runs
+the same transactions as asyncio subprocesses, without threads.
+"""
+import os
+import re
+import json
+import asyncio
+import weakref
+import shutil
+import logging
+import threading
+import subprocess
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from core.runtime import RUNTIME_DIR, ensure_runtime_dir, read_file, write_atomic
+
+BACKEND_LEGACY = 'iptables-legacy'
+BACKEND_IPT_NFT = 'iptables-nft'
+BACKEND_NFT = 'nft'
+
+CHAIN_PREFIX = "ZAPRET_AUTO"
+NFT_TABLE = "zapret_auto_fw"
+# What we installed; lives as long as the rules do (until reboot), like the hostlists
+STATE_PATH = os.path.join(RUNTIME_DIR, "firewall.json")
+BACKENDS = (BACKEND_LEGACY, BACKEND_IPT_NFT, BACKEND_NFT)
+# iptables mangle chain -> nft base chain declaration
+NFT_CHAINS = {
+    'OUTPUT': ('output', "type filter hook output priority mangle;"),
+    'POSTROUTING': ('postrouting', "type filter hook postrouting priority mangle;"),
+    'PREROUTING': ('prerouting', "type filter hook prerouting priority mangle;"),
+}
+
+_HANDLE_RE = re.compile(r"# handle (\d+)")
+# iptables connbytes direction -> nft ct direction prefix
+CONNBYTES_DIRS = {'original': 'original ', 'reply': 'reply ', 'both': ''}
+CONNBYTES_MODES = ('packets', 'bytes', 'avgpkt')
+
+
+def detect_backend() -> Optional[str]:
+    """iptables flavour from `iptables -V` ("(nf_tables)" / "(legacy)"); nft only without iptables."""
+    iptables = shutil.which('iptables')
+    if iptables:
+        try:
+            version = subprocess.run([iptables, '-V'], capture_output=True, text=True, timeout=5).stdout
+        except (OSError, subprocess.TimeoutExpired):
+            version = ""
+        return BACKEND_IPT_NFT if 'nf_tables' in version else BACKEND_LEGACY
+    if shutil.which('nft'):
+        return BACKEND_NFT
+    return None
+
+
+def rule_family(rule: List[str]) -> int:
+    """6 if the rule matches an IPv6 address (-d/-s), else 4."""
+    for flag, value in zip(rule, rule[1:]):
+        if flag in ('-d', '-s') and ':' in value:
+            return 6
+    return 4
+
+
+class RuleBatch:
+    """Ordered rule changes: (action, table, rule, family), action being '-I', '-A' or '-D'."""
+
+    def __init__(self, changes: Optional[List[Tuple[str, str, List[str], int]]] = None):
+        self.changes = list(changes or [])
+
+    def _add(self, action: str, rule: List[str], table: str, family: Optional[int]) -> 'RuleBatch':
+        self.changes.append((action, table, list(rule), family or rule_family(rule)))
+        return self
+
+    def insert(self, rule: List[str], table: str = 'mangle', family: Optional[int] = None) -> 'RuleBatch':
+        return self._add('-I', rule, table, family)
+
+    def append(self, rule: List[str], table: str = 'mangle', family: Optional[int] = None) -> 'RuleBatch':
+        return self._add('-A', rule, table, family)
+
+    def delete(self, rule: List[str], table: str = 'mangle', family: Optional[int] = None) -> 'RuleBatch':
+        return self._add('-D', rule, table, family)
+
+    def family(self, family: int) -> 'RuleBatch':
+        """The changes of one address family, in order."""
+        return RuleBatch([change for change in self.changes if change[3] == family])
+
+    def inverse(self) -> 'RuleBatch':
+        """Changes undoing this batch (deleted rules come back at the top)."""
+        undo = {'-I': '-D', '-A': '-D', '-D': '-I'}
+        return RuleBatch([(undo[action], table, rule, family)
+                          for action, table, rule, family in reversed(self.changes)])
+
+    def __len__(self):
+        return len(self.changes)
+
+
+def own_chain(chain: str) -> str:
+    """Our chain behind a built-in one: OUTPUT -> ZAPRET_AUTO_OUTPUT."""
+    return f"{CHAIN_PREFIX}_{chain}"
+
+
+def iptables_script(batch: RuleBatch, create: Iterable[Tuple[str, str]] = ()) -> str:
+    """
+    `iptables-restore --noflush` input, one COMMIT per table. Rules are moved
+    from their built-in chain into our own; create lists the (table, chain)
+    pairs whose own chain and jump do not exist yet.
+    """
+    tables: Dict[str, List[str]] = {}
+    for table, chain in create:
+        # Declaring an existing chain under --noflush flushes it: only ever for new ones
+        tables.setdefault(table, []).insert(0, f":{own_chain(chain)} - [0:0]")
+        tables[table].append(f"-I {chain} -j {own_chain(chain)}")
+    for action, table, rule, _ in batch.changes:
+        tables.setdefault(table, []).append(f"{action} {' '.join([own_chain(rule[0])] + rule[1:])}")
+    lines = []
+    for table, changes in tables.items():
+        lines.append(f"*{table}")
+        lines.extend(changes)
+        lines.append("COMMIT")
+    return "\n".join(lines) + "\n"
+
+
+def teardown_script(chains: Iterable[Tuple[str, str]]) -> str:
+    """`iptables-restore --noflush` input: unhook, flush and delete our chains."""
+    tables: Dict[str, List[str]] = {}
+    for table, chain in chains:
+        tables.setdefault(table, []).extend([
+            f"-D {chain} -j {own_chain(chain)}",
+            f"-F {own_chain(chain)}",
+            f"-X {own_chain(chain)}",
+        ])
+    lines = []
+    for table, changes in tables.items():
+        lines.append(f"*{table}")
+        lines.extend(changes)
+        lines.append("COMMIT")
+    return "\n".join(lines) + "\n"
+
+
+def nft_expression(rule: List[str]) -> Tuple[str, str]:
+    """iptables rule (chain first) -> (nft chain, nft rule expression). ValueError if not translatable."""
+    if rule[0] not in NFT_CHAINS:
+        raise ValueError(f"no nft chain for {rule[0]}")
+    chain = NFT_CHAINS[rule[0]][0]
+    args = rule[1:]
+    proto, parts, verdict = 'tcp', [], []
+    negate = False
+    module = None
+    connbytes = {}
+    idx = 0
+    while idx < len(args):
+        arg = args[idx]
+        value = args[idx + 1] if idx + 1 < len(args) else None
+        step = 2
+        if arg.startswith('--') and '=' in arg:
+            # --connbytes-dir=reply style
+            arg, value = arg.split('=', 1)
+            step = 1
+        if arg == '!':
+            negate, step = True, 1
+        elif arg == '-p':
+            proto = value
+            if proto != 'tcp' and not any(a in args for a in ('--dport', '--sport', '--dports', '--sports')):
+                parts.append(f"meta l4proto {proto}")
+        elif arg in ('--dport', '--sport'):
+            parts.append(f"{proto} {arg[2:]} {value}")
+        elif arg in ('--dports', '--sports'):
+            parts.append(f"{proto} {arg[2:-1]} {{ {value.replace(',', ', ')} }}")
+        elif arg in ('-d', '-s'):
+            parts.append(f"{'ip6' if ':' in value else 'ip'} {'daddr' if arg == '-d' else 'saddr'} {value}")
+        elif arg == '-m':
+            module = value
+        elif arg == '--match-set':
+            # An ipset is invisible to nft: set rules go through nft sets instead (core.strategy_applicator)
+            raise ValueError(f"ipset {value!r} cannot be matched from nft")
+        elif arg in ('--connbytes-dir', '--connbytes-mode', '--connbytes'):
+            connbytes[arg] = value
+        elif arg == '--mark':
+            mark, _, mask = value.partition('/')
+            mask = mask or '0xffffffff'
+            key = 'ct mark' if module == 'connmark' else 'meta mark'
+            parts.append(f"{key} and {mask} {'!=' if negate else '=='} {mark}")
+            negate = False
+        elif arg == '-j' and value == 'NFQUEUE':
+            verdict.append('queue')
+        elif arg == '--queue-num':
+            verdict.append(f"num {value}")
+        elif arg == '--queue-balance':
+            verdict.append(f"num {value.replace(':', '-')}")
+        elif arg == '--queue-bypass':
+            verdict.append('bypass')
+            step = 1
+        else:
+            raise ValueError(f"cannot translate {arg!r} to nft")
+        idx += step
+    if connbytes:
+        direction = CONNBYTES_DIRS.get(connbytes.get('--connbytes-dir'))
+        mode = connbytes.get('--connbytes-mode')
+        if direction is None or mode not in CONNBYTES_MODES or '--connbytes' not in connbytes:
+            raise ValueError(f"incomplete connbytes match {connbytes}")
+        parts.append(f"ct {direction}{mode} {connbytes['--connbytes'].replace(':', '-')}")
+    if not verdict:
+        raise ValueError("only NFQUEUE rules are translated")
+    return chain, ' '.join(parts + verdict)
+
+
+class Firewall:
+    def __init__(self, backend: Optional[str] = None):
+        self.backend = backend or detect_backend()
+        self.commits = 0                      # Transactions executed (execs), for stats
+        self._handles: Dict[tuple, List[int]] = {}  # nft: rule -> handles, oldest first
+        self._chains: Set[Tuple[int, str, str]] = set()  # (family, table, built-in chain) with our chain in place
+        self._nft_ready = False               # nft: our table is known to exist
+        self._cond = threading.Condition()
+        self._pending = []
+        self._committing = False
+
+    def _binary(self, family: int = 4) -> str:
+        # Prefer the flavour-specific binary so a mixed install cannot pick the wrong one
+        prefix = 'ip6' if family == 6 else 'ip'
+        name = prefix + self.backend[2:]
+        return name if shutil.which(name) else f'{prefix}tables'
+
+    def _restore_cmd(self, family: int = 4) -> List[str]:
+        prefix = 'ip6' if family == 6 else 'ip'
+        name = f"{prefix}{self.backend[2:]}-restore"
+        return [name if shutil.which(name) else f'{prefix}tables-restore', '--noflush']
+
+    def _record(self):
+        """Persist what we own, merged with the record of earlier processes."""
+        chains = set(recorded_chains(load_state())) | self._chains
+        state = {'backend': self.backend,
+                 'chains': [[family, table, own_chain(chain)] for family, table, chain in sorted(chains)]}
+        if self.backend == BACKEND_NFT:
+            state['nft_table'] = NFT_TABLE
+        try:
+            ensure_runtime_dir(os.path.dirname(STATE_PATH))
+            write_atomic(STATE_PATH, json.dumps(state).encode())
+        except OSError as e:
+            logging.warning(f"[FW] Could not record installed chains: {e}")
+
+    def _nft_script(self, batch: RuleBatch) -> Tuple[str, List[tuple]]:
+        lines = [f"table inet {NFT_TABLE} {{"]
+        lines.extend(f"  chain {name} {{ {decl} }}" for name, decl in NFT_CHAINS.values())
+        lines.append("}")
+        added, pending_deletes = [], {}
+        for action, _, rule, family in batch.changes:
+            chain, expr = nft_expression(rule)
+            key = tuple(rule)
+            if action == '-D':
+                # Same rule deleted twice in one batch: take the next handle
+                handles = self._handles.get(key, [])
+                used = pending_deletes.get(key, 0)
+                if used >= len(handles):
+                    raise ValueError(f"rule not installed: {' '.join(rule)}")
+                pending_deletes[key] = used + 1
+                lines.append(f"delete rule inet {NFT_TABLE} {chain} handle {handles[used]}")
+            else:
+                verb = 'insert' if action == '-I' else 'add'
+                lines.append(f"{verb} rule inet {NFT_TABLE} {chain} {expr}")
+                added.append(key)
+        return "\n".join(lines) + "\n", added
+
+    def _run(self, cmd: List[str], script: Optional[str]) -> Optional[bytes]:
+        """stdout of cmd fed script on stdin; None if it failed."""
+        try:
+            if script is None:
+                result = subprocess.run(cmd, capture_output=True)
+            else:
+                result = subprocess.run(cmd, input=script.encode(), capture_output=True)
+        except OSError as e:
+            logging.debug(f"[FW] {e}")
+            return None
+        if result.returncode != 0:
+            logging.debug(f"[FW] {result.stderr.decode(errors='replace').strip()}")
+            return None
+        return result.stdout
+
+    def _transaction(self, batch: RuleBatch):
+        """
+        One transaction as a generator of commands: yields (cmd, stdin script or
+        None), is sent the command's stdout (None if it failed) and returns
+        success. _execute() drives it with subprocess.run, AsyncFirewall with
+        asyncio subprocesses, so both share the bookkeeping.
+        """
+        if self.backend is None:
+            logging.error("No iptables or nft found")
+            return False
+        self.commits += 1
+        if self.backend != BACKEND_NFT:
+            done = []
+            for family in (4, 6):
+                part = batch.family(family)
+                if not part:
+                    continue
+                if not (yield from self._family_transaction(part, family)):
+                    # One transaction per family: take back the half that already landed
+                    for applied, applied_family in done:
+                        yield from self._family_transaction(applied.inverse(), applied_family)
+                    return False
+                done.append((part, family))
+            return True
+
+        try:
+            script, added = self._nft_script(batch)
+        except ValueError as e:
+            logging.debug(f"[FW] {e}")
+            return False
+        stdout = yield ['nft', '-e', '-a', '-f', '-'], script
+        if stdout is None:
+            self._nft_ready = False
+            return False
+        if not self._nft_ready:
+            self._nft_ready = True
+            self._record()
+        # Echoed rules come back in order, each with its handle
+        handles = [int(m.group(1)) for line in stdout.decode(errors='replace').splitlines()
+                   if ' rule ' in line for m in [_HANDLE_RE.search(line)] if m]
+        for key, handle in zip(added, handles):
+            self._handles.setdefault(key, []).append(handle)
+        for action, _, rule, _ in batch.changes:
+            if action == '-D':
+                self._handles[tuple(rule)].pop(0)
+        return True
+
+    def _family_transaction(self, batch: RuleBatch, family: int):
+        """_transaction() for the iptables changes of one family, creating our chains as needed."""
+        created = []
+        for table, chain in dict.fromkeys((table, rule[0]) for _, table, rule, _ in batch.changes):
+            if (family, table, chain) in self._chains:
+                continue
+            # Left over by an earlier process: reuse, declaring it again would flush it
+            if (yield [self._binary(family), '-t', table, '-S', own_chain(chain)], None) is not None:
+                self._chains.add((family, table, chain))
+            else:
+                created.append((table, chain))
+        if (yield self._restore_cmd(family), iptables_script(batch, created)) is None:
+            # Our chains may have been torn down by another process: look again next time
+            self._chains = {c for c in self._chains if c[0] != family}
+            return False
+        if created:
+            self._chains.update((family, table, chain) for table, chain in created)
+            self._record()
+        return True
+
+    def _execute(self, batch: RuleBatch) -> bool:
+        steps = self._transaction(batch)
+        try:
+            cmd, script = next(steps)
+            while True:
+                cmd, script = steps.send(self._run(cmd, script))
+        except StopIteration as done:
+            return done.value
+
+    def check(self, rule: List[str], table: str = 'mangle', family: Optional[int] = None) -> bool:
+        """True if rule is installed (`iptables -C`; for nft: installed by this process)."""
+        if self.backend == BACKEND_NFT:
+            return bool(self._handles.get(tuple(rule)))
+        if self.backend is None:
+            return False
+        cmd = [self._binary(family or rule_family(rule)), '-t', table, '-C', own_chain(rule[0])] + rule[1:]
+        try:
+            return subprocess.run(cmd, capture_output=True).returncode == 0
+        except OSError:
+            return False
+
+    def teardown(self) -> bool:
+        """
+        Remove everything recorded in STATE_PATH (by any process): our chains
+        and their jumps, or our nft table. Without a record, our chains behind
+        every built-in chain we know of are tried.
+        """
+        state = load_state()
+        backend = state.get('backend') if state.get('backend') in BACKENDS else self.backend
+        with self._cond:
+            while self._committing:
+                self._cond.wait()
+            if backend == BACKEND_NFT:
+                # Declaring the table first makes the delete succeed when it is already gone
+                ok = self._run(['nft', '-f', '-'], f"table inet {NFT_TABLE}\ndelete table inet {NFT_TABLE}\n") is not None
+            elif backend is None:
+                ok = False
+            else:
+                chains = (recorded_chains(state) or
+                          [(family, 'mangle', chain) for family in (4, 6) for chain in NFT_CHAINS])
+                ok = True
+                for family in sorted({c[0] for c in chains}):
+                    own = [(table, chain) for f, table, chain in chains if f == family]
+                    if self._run(self._restore_cmd(family), teardown_script(own)) is not None:
+                        continue
+                    # Partly gone already: each step on its own, failures ignored
+                    for table, chain in own:
+                        for step in (['-D', chain, '-j', own_chain(chain)], ['-F', own_chain(chain)],
+                                     ['-X', own_chain(chain)]):
+                            try:
+                                subprocess.run([self._binary(family), '-t', table] + step, capture_output=True)
+                            except OSError:
+                                pass
+            self._chains.clear()
+            self._nft_ready = False
+            self._handles.clear()
+            if os.path.exists(STATE_PATH):
+                os.remove(STATE_PATH)
+        return ok
+
+    def commit(self, batch: RuleBatch, strict: bool = True) -> bool:
+        """
+        Apply batch in one transaction. With strict=False a failed transaction
+        (typically a delete of a rule that is already gone) is retried change by
+        change and the failures are ignored: for best-effort cleanup.
+        """
+        if not batch:
+            return True
+        ok = self.submit(batch)
+        if ok or strict:
+            return ok
+        for change in batch.changes:
+            self.submit(RuleBatch([change]))
+        return True
+
+    def submit(self, batch: RuleBatch) -> bool:
+        """
+        commit() for concurrent callers: batches that arrive while a transaction
+        is running are merged into the next one. If a merged transaction fails,
+        its batches are retried one by one so a bad batch only fails itself.
+        """
+        slot = {'done': False, 'ok': False}
+        with self._cond:
+            self._pending.append((batch, slot))
+            while self._committing and not slot['done']:
+                self._cond.wait()
+            if slot['done']:
+                return slot['ok']
+            group, self._pending = self._pending, []
+            self._committing = True
+        try:
+            merged = RuleBatch([change for b, _ in group for change in b.changes])
+            if self._execute(merged):
+                for _, s in group:
+                    s['ok'] = True
+            elif len(group) > 1:
+                for b, s in group:
+                    s['ok'] = self._execute(b)
+        finally:
+            with self._cond:
+                for _, s in group:
+                    s['done'] = True
+                self._committing = False
+                self._cond.notify_all()
+        return slot['ok']
+
+
+def load_state() -> dict:
+    """The record of installed chains (see module docstring); {} if there is none."""
+    try:
+        state = json.loads(read_file(STATE_PATH))
+    except (OSError, ValueError):
+        return {}
+    return state if isinstance(state, dict) else {}
+
+
+def recorded_chains(state: dict) -> List[Tuple[int, str, str]]:
+    """
+    (family, table, built-in chain) of the record's chains. Entries that are
+    not one of our ZAPRET_AUTO_* chains behind a known built-in chain are
+    dropped: teardown() flushes and deletes what this returns, as root.
+    """
+    chains = []
+    for entry in state.get('chains', []):
+        try:
+            family, table, name = entry
+        except (TypeError, ValueError):
+            family = table = name = None
+        prefix = f"{CHAIN_PREFIX}_"
+        if (family in (4, 6) and table == 'mangle' and isinstance(name, str) and name.startswith(prefix)
+                and name[len(prefix):] in NFT_CHAINS):
+            chains.append((family, table, name[len(prefix):]))
+        else:
+            logging.warning(f"[FW] Ignoring unexpected chain record: {entry!r}")
+    return chains
+
+
+_firewall_instance = None
+_firewall_lock = threading.Lock()
+
+
+def get_firewall() -> Firewall:
+    """Process-wide Firewall (shared group commit and nft handle bookkeeping)."""
+    global _firewall_instance
+    with _firewall_lock:
+        if _firewall_instance is None:
+            _firewall_instance = Firewall()
+            logging.debug(f"[FW] Backend: {_firewall_instance.backend}")
+        return _firewall_instance
+
+
+class AsyncFirewall:
+    """
+    Firewall.submit() for one event loop: batches submitted while a
+    transaction runs are folded into the next one, and the commands of
+    Firewall._transaction() run through create_subprocess_exec. Chain and
+    handle bookkeeping is the shared Firewall's.
+    """
+
+    def __init__(self, firewall: Firewall):
+        self.firewall = firewall
+        self._pending = []
+        self._drainer: Optional[asyncio.Task] = None
+
+    @staticmethod
+    async def _run(cmd: List[str], script: Optional[str]) -> Optional[bytes]:
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *cmd, stdin=asyncio.subprocess.PIPE if script is not None else asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+            )
+            stdout, stderr = await proc.communicate(script.encode() if script is not None else None)
+        except OSError as e:
+            logging.debug(f"[FW] {e}")
+            return None
+        if proc.returncode != 0:
+            logging.debug(f"[FW] {stderr.decode(errors='replace').strip()}")
+            return None
+        return stdout
+
+    async def _execute(self, batch: RuleBatch) -> bool:
+        steps = self.firewall._transaction(batch)
+        try:
+            cmd, script = next(steps)
+            while True:
+                cmd, script = steps.send(await self._run(cmd, script))
+        except StopIteration as done:
+            return done.value
+
+    async def _drain(self):
+        try:
+            while self._pending:
+                group, self._pending = self._pending, []
+                merged = RuleBatch([change for b, _ in group for change in b.changes])
+                if await self._execute(merged):
+                    results = [True] * len(group)
+                elif len(group) > 1:
+                    # Retry one by one so a bad batch only fails itself
+                    results = [await self._execute(b) for b, _ in group]
+                else:
+                    results = [False]
+                for (_, future), ok in zip(group, results):
+                    if not future.done():
+                        future.set_result(ok)
+        finally:
+            for _, future in self._pending:
+                if not future.done():
+                    future.set_result(False)
+            self._pending = []
+            self._drainer = None
+
+    async def submit(self, batch: RuleBatch) -> bool:
+        """Apply batch, folded with the batches of other coroutines on this loop."""
+        if not batch:
+            return True
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((batch, future))
+        if self._drainer is None:
+            # Own task: a cancelled submitter must not abort the transaction of the others
+            self._drainer = asyncio.ensure_future(self._drain())
+        return await future
+
+
+_async_firewalls = weakref.WeakKeyDictionary()
+
+
+def get_async_firewall() -> AsyncFirewall:
+    """AsyncFirewall of the running loop, on top of get_firewall()."""
+    loop = asyncio.get_running_loop()
+    if loop not in _async_firewalls:
+        _async_firewalls[loop] = AsyncFirewall(get_firewall())
+    return _async_firewalls[loop]
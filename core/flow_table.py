@@ -0,0 +1,105 @@
+"""
+Flow Table - Per-connection state for the interceptor
+Keyed by 5-tuple so that, once a connection's ClientHello has been seen
+and classified, the rest of the flow can be accepted without parsing.
+"""
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from core.packet_parser import PacketInfo
+
+# Flow states
+FLOW_NEW = 0         # SYN / handshake seen, no payload yet
+FLOW_HELLO = 1       # ClientHello sent, waiting for the server's answer
+FLOW_CLASSIFIED = 2  # Handshake outcome known (or flow is not TLS): fast-path accept
+
+DEFAULT_MAX_FLOWS = 65536
+DEFAULT_IDLE_TIMEOUT = 120.0
+
+
+class FlowEntry:
+    __slots__ = ('state', 'dst', 'sni', 'created', 'last_seen', 'packets',
+                 'hello_time', 'hello_count', 'server_ttl')
+
+    def __init__(self, now: float, dst: bytes = b''):
+        self.state = FLOW_NEW
+        self.dst = dst
+        self.sni = None
+        self.created = now
+        self.last_seen = now
+        self.packets = 0
+        self.hello_time = 0.0
+        self.hello_count = 0
+        self.server_ttl = 0  # TTL seen on the SYN-ACK, baseline for RST checks
+
+
+def flow_key(info: PacketInfo) -> tuple:
+    return (info.proto, info.src, info.sport, info.dst, info.dport)
+
+
+def reverse_flow_key(info: PacketInfo) -> tuple:
+    return (info.proto, info.dst, info.dport, info.src, info.sport)
+
+
+class FlowTable:
+    """
+    LRU-ordered flow table with idle-timeout eviction.
+    Keys are oriented client -> server; packets in the reply direction
+    resolve to the same entry through lookup().
+    """
+
+    def __init__(self, max_flows: int = DEFAULT_MAX_FLOWS, idle_timeout: float = DEFAULT_IDLE_TIMEOUT):
+        self.max_flows = max_flows
+        self.idle_timeout = idle_timeout
+        self._flows = OrderedDict()
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._flows)
+
+    def lookup(self, info: PacketInfo, now: Optional[float] = None) -> Tuple[Optional[FlowEntry], bool]:
+        """
+        Find the flow for a packet in either direction and refresh its idle timer.
+        Returns (entry, reply) where reply is True for server -> client packets.
+        """
+        key = flow_key(info)
+        reply = False
+        entry = self._flows.get(key)
+        if entry is None:
+            key = reverse_flow_key(info)
+            entry = self._flows.get(key)
+            if entry is None:
+                return None, False
+            reply = True
+        entry.last_seen = now if now is not None else time.monotonic()
+        entry.packets += 1
+        self._flows.move_to_end(key)
+        return entry, reply
+
+    def add(self, info: PacketInfo, now: Optional[float] = None) -> FlowEntry:
+        """Create (or reset) the flow for a packet sent by the client."""
+        now = now if now is not None else time.monotonic()
+        entry = FlowEntry(now, info.dst)
+        entry.packets = 1
+        key = flow_key(info)
+        self._flows[key] = entry
+        self._flows.move_to_end(key)
+        if len(self._flows) > self.max_flows:
+            self._flows.popitem(last=False)
+            self.evicted += 1
+        return entry
+
+    def expire(self, now: Optional[float] = None) -> int:
+        """Evict idle flows. Oldest entries sit at the front, so this stops early."""
+        now = now if now is not None else time.monotonic()
+        deadline = now - self.idle_timeout
+        removed = 0
+        while self._flows:
+            key, entry = next(iter(self._flows.items()))
+            if entry.last_seen > deadline:
+                break
+            del self._flows[key]
+            removed += 1
+        self.evicted += removed
+        return removed
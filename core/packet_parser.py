@@ -0,0 +1,256 @@
+"""
+Packet Parser - Zero-copy header walker for NFQUEUE payloads
+Extracts TLS SNI/ALPN straight from raw IPv4/IPv6 packets without building
+scapy layers. Everything works on a memoryview of the original buffer, so
+the only allocations are the PacketInfo itself and the decoded hostname.
+"""
+import socket
+from typing import Optional, Tuple, List
+
+PROTO_TCP = 6
+PROTO_UDP = 17
+
+# IPv6 extension headers we can walk over to reach the L4 header
+_IPV6_EXT_HEADERS = (0, 43, 60)  # hop-by-hop, routing, destination options
+_IPV6_FRAGMENT = 44
+
+# TLS constants
+TLS_CONTENT_HANDSHAKE = 0x16
+TLS_HANDSHAKE_CLIENT_HELLO = 0x01
+TLS_EXT_SERVER_NAME = 0x0000
+TLS_EXT_ALPN = 0x0010
+
+# Request lines we recognize as plain HTTP
+HTTP_METHODS = (b"GET ", b"POST ", b"HEAD ", b"PUT ", b"DELETE ", b"OPTIONS ", b"PATCH ", b"CONNECT ")
+HTTP_SCAN_LIMIT = 2048  # Host must appear within the first segment's headers
+
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_RST = 0x04
+TCP_PSH = 0x08
+TCP_ACK = 0x10
+
+
+class PacketInfo:
+    """Decoded view of a single IP packet. Addresses are kept as raw bytes."""
+    __slots__ = ('family', 'src', 'dst', 'proto', 'sport', 'dport', 'ttl',
+                 'tcp_flags', 'payload', 'sni', 'alpn')
+
+    def __init__(self, family, src, dst, proto, sport, dport, ttl, tcp_flags, payload):
+        self.family = family
+        self.src = src
+        self.dst = dst
+        self.proto = proto
+        self.sport = sport
+        self.dport = dport
+        self.ttl = ttl
+        self.tcp_flags = tcp_flags
+        self.payload = payload
+        self.sni = None
+        self.alpn = None
+
+    @property
+    def src_ip(self) -> str:
+        return socket.inet_ntop(self.family, self.src)
+
+    @property
+    def dst_ip(self) -> str:
+        return socket.inet_ntop(self.family, self.dst)
+
+    def __repr__(self):
+        return (f"PacketInfo({self.src_ip}:{self.sport} -> {self.dst_ip}:{self.dport} "
+                f"proto={self.proto} sni={self.sni!r})")
+
+
+def parse_packet(raw, tls: bool = True) -> Optional[PacketInfo]:
+    """
+    Walk IP + TCP/UDP headers of a raw packet.
+    Returns None for anything that is not a well-formed, unfragmented
+    TCP/UDP packet. TLS ClientHello SNI/ALPN are filled in when present,
+    unless tls=False (headers only, for flow-table lookups).
+    """
+    buf = memoryview(raw)
+    n = len(buf)
+    if n < 20:
+        return None
+
+    version = buf[0] >> 4
+    if version == 4:
+        ihl = (buf[0] & 0x0F) * 4
+        if ihl < 20 or n < ihl:
+            return None
+        # Skip non-first fragments: no L4 header in them
+        if ((buf[6] & 0x1F) << 8) | buf[7]:
+            return None
+        family = socket.AF_INET
+        proto = buf[9]
+        ttl = buf[8]
+        src = bytes(buf[12:16])
+        dst = bytes(buf[16:20])
+        off = ihl
+        end = min(n, (buf[2] << 8) | buf[3]) or n
+    elif version == 6:
+        if n < 40:
+            return None
+        family = socket.AF_INET6
+        proto = buf[6]
+        ttl = buf[7]
+        src = bytes(buf[8:24])
+        dst = bytes(buf[24:40])
+        off = 40
+        end = min(n, 40 + ((buf[4] << 8) | buf[5]))
+        while proto in _IPV6_EXT_HEADERS or proto == _IPV6_FRAGMENT:
+            if off + 8 > end:
+                return None
+            if proto == _IPV6_FRAGMENT:
+                if ((buf[off + 2] << 8) | buf[off + 3]) & 0xFFF8:
+                    return None
+                proto = buf[off]
+                off += 8
+            else:
+                proto, off = buf[off], off + (buf[off + 1] + 1) * 8
+    else:
+        return None
+
+    if proto == PROTO_TCP:
+        if off + 20 > end:
+            return None
+        doff = (buf[off + 12] >> 4) * 4
+        if doff < 20 or off + doff > end:
+            return None
+        info = PacketInfo(family, src, dst, proto,
+                          (buf[off] << 8) | buf[off + 1],
+                          (buf[off + 2] << 8) | buf[off + 3],
+                          ttl, buf[off + 13], buf[off + doff:end])
+    elif proto == PROTO_UDP:
+        if off + 8 > end:
+            return None
+        info = PacketInfo(family, src, dst, proto,
+                          (buf[off] << 8) | buf[off + 1],
+                          (buf[off + 2] << 8) | buf[off + 3],
+                          ttl, 0, buf[off + 8:end])
+    else:
+        return None
+
+    if tls and proto == PROTO_TCP and len(info.payload) > 5 and info.payload[0] == TLS_CONTENT_HANDSHAKE:
+        hello = parse_client_hello(info.payload)
+        if hello:
+            info.sni, info.alpn = hello
+    return info
+
+
+def parse_client_hello(data) -> Optional[Tuple[Optional[str], List[str]]]:
+    """
+    Parse a TLS record carrying a ClientHello.
+    Returns (sni, alpn_list) or None if the data is not a ClientHello.
+    Truncated records (ClientHello split over several segments) are parsed
+    as far as the bytes go, which is enough for SNI in practice.
+    """
+    buf = data if isinstance(data, memoryview) else memoryview(data)
+    n = len(buf)
+    # Record header (5) + handshake header (4) + version (2) + random (32)
+    if n < 43 or buf[0] != TLS_CONTENT_HANDSHAKE or buf[1] != 0x03:
+        return None
+    if buf[5] != TLS_HANDSHAKE_CLIENT_HELLO:
+        return None
+    return parse_client_hello_body(buf[9:])
+
+
+def parse_client_hello_body(buf) -> Optional[Tuple[Optional[str], List[str]]]:
+    """
+    Parse a ClientHello handshake body (after the 4-byte handshake header).
+    Shared by the TLS-over-TCP and QUIC CRYPTO-frame paths.
+    """
+    n = len(buf)
+    off = 34  # version + random
+    if off >= n:
+        return None
+    # session_id
+    off += 1 + buf[off]
+    if off + 2 > n:
+        return None
+    # cipher_suites
+    off += 2 + ((buf[off] << 8) | buf[off + 1])
+    if off >= n:
+        return None
+    # compression_methods
+    off += 1 + buf[off]
+    if off + 2 > n:
+        return None
+    ext_end = min(n, off + 2 + ((buf[off] << 8) | buf[off + 1]))
+    off += 2
+
+    sni = None
+    alpn = []
+    while off + 4 <= ext_end:
+        ext_type = (buf[off] << 8) | buf[off + 1]
+        ext_len = (buf[off + 2] << 8) | buf[off + 3]
+        off += 4
+        if off + ext_len > ext_end:
+            break
+        if ext_type == TLS_EXT_SERVER_NAME:
+            sni = _parse_server_name(buf[off:off + ext_len])
+        elif ext_type == TLS_EXT_ALPN:
+            alpn = _parse_alpn(buf[off:off + ext_len])
+        off += ext_len
+    return sni, alpn
+
+
+def _parse_server_name(ext) -> Optional[str]:
+    # server_name_list length (2), then entries of type (1) + length (2) + name
+    if len(ext) < 5:
+        return None
+    end = min(len(ext), 2 + ((ext[0] << 8) | ext[1]))
+    off = 2
+    while off + 3 <= end:
+        name_type = ext[off]
+        name_len = (ext[off + 1] << 8) | ext[off + 2]
+        off += 3
+        if off + name_len > end:
+            return None
+        if name_type == 0:
+            try:
+                return bytes(ext[off:off + name_len]).decode('ascii').lower()
+            except UnicodeDecodeError:
+                return None
+        off += name_len
+    return None
+
+
+def _parse_alpn(ext) -> List[str]:
+    protocols = []
+    if len(ext) < 2:
+        return protocols
+    end = min(len(ext), 2 + ((ext[0] << 8) | ext[1]))
+    off = 2
+    while off < end:
+        plen = ext[off]
+        off += 1
+        if off + plen > end:
+            break
+        protocols.append(bytes(ext[off:off + plen]).decode('ascii', 'replace'))
+        off += plen
+    return protocols
+
+
+def parse_http_host(data) -> Optional[str]:
+    """Return the Host header of a plain HTTP request, or None."""
+    head = bytes(data[:HTTP_SCAN_LIMIT])
+    if not head.startswith(HTTP_METHODS):
+        return None
+    end = head.find(b"\r\n\r\n")
+    if end != -1:
+        head = head[:end]
+    for line in head.split(b"\r\n")[1:]:
+        if line[:5].lower() == b"host:":
+            host = line[5:].strip()
+            # Strip port, keep IPv6 literals intact
+            if host.startswith(b"["):
+                host = host[:host.find(b"]") + 1]
+            elif b":" in host:
+                host = host.rsplit(b":", 1)[0]
+            try:
+                return host.decode('ascii').lower() or None
+            except UnicodeDecodeError:
+                return None
+    return None
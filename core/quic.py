@@ -0,0 +1,214 @@
+"""
+QUIC Initial decoder
+Derives the Initial keys from the Destination Connection ID (RFC 9001 §5),
+removes header protection, decrypts the payload and reassembles CRYPTO
+frames into the TLS ClientHello so the SNI can be read like TCP TLS.
+Keys and reassembly state are cached per connection ID.
+
+Needs the 'cryptography' package for AES; without it is_available() is
+False and decode() always returns None.
+"""
+import re
+import hmac
+import hashlib
+from collections import OrderedDict
+from typing import Optional, Tuple, List
+
+from core.packet_parser import parse_client_hello_body
+
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:
+    Cipher = None
+    AESGCM = None
+
+QUIC_V1 = 0x00000001
+QUIC_V2 = 0x6b3343cf
+QUIC_DRAFT29 = 0xff00001d
+
+# version -> (initial salt, label prefix, long-header type of Initial packets)
+_VERSIONS = {
+    QUIC_V1: (bytes.fromhex("38762cf7f55934b34d179ae6a4c80cadccbb7f0a"), b"quic ", 0),
+    QUIC_V2: (bytes.fromhex("0dede3def700a6db819381be6e269dcbf9bd2ed9"), b"quicv2 ", 1),
+    QUIC_DRAFT29: (bytes.fromhex("afbfec289993d24c9e9786f19c6111e04390a899"), b"quic ", 0),
+}
+
+FRAME_PADDING = 0x00
+FRAME_PING = 0x01
+FRAME_ACK = 0x02
+FRAME_ACK_ECN = 0x03
+FRAME_CRYPTO = 0x06
+FRAME_CONNECTION_CLOSE = 0x1c
+
+_NON_PADDING = re.compile(b"[^\x00]")
+
+MAX_CONNECTIONS = 4096     # Cached connection IDs (LRU)
+MAX_CRYPTO_BYTES = 16384   # Give up on ClientHellos larger than this
+
+
+def is_available() -> bool:
+    return AESGCM is not None
+
+
+def _hkdf_extract(salt: bytes, ikm: bytes) -> bytes:
+    return hmac.new(salt, ikm, hashlib.sha256).digest()
+
+
+def _hkdf_expand_label(secret: bytes, label: bytes, length: int) -> bytes:
+    full_label = b"tls13 " + label
+    info = length.to_bytes(2, 'big') + bytes([len(full_label)]) + full_label + b"\x00"
+    # length <= 32, so one HMAC block is always enough
+    return hmac.new(secret, info + b"\x01", hashlib.sha256).digest()[:length]
+
+
+def _read_varint(buf, off: int) -> Tuple[int, int]:
+    first = buf[off]
+    size = 1 << (first >> 6)
+    value = first & 0x3F
+    for i in range(1, size):
+        value = (value << 8) | buf[off + i]
+    return value, off + size
+
+
+class _InitialState:
+    """Per-DCID keys plus CRYPTO stream reassembly."""
+    __slots__ = ('key', 'iv', 'hp', 'fragments', 'result')
+
+    def __init__(self, version: int, dcid: bytes):
+        salt, prefix, _ = _VERSIONS[version]
+        client_secret = _hkdf_expand_label(_hkdf_extract(salt, dcid), b"client in", 32)
+        self.key = AESGCM(_hkdf_expand_label(client_secret, prefix + b"key", 16))
+        self.iv = _hkdf_expand_label(client_secret, prefix + b"iv", 12)
+        self.hp = Cipher(algorithms.AES(_hkdf_expand_label(client_secret, prefix + b"hp", 16)),
+                         modes.ECB()).encryptor()
+        self.fragments = {}
+        self.result = None
+
+
+def is_initial(payload) -> bool:
+    """Cheap check: long header, known version, Initial packet type."""
+    if len(payload) < 7 or not payload[0] & 0x80:
+        return False
+    version = int.from_bytes(payload[1:5], 'big')
+    entry = _VERSIONS.get(version)
+    return entry is not None and ((payload[0] >> 4) & 0x03) == entry[2]
+
+
+class QuicInitialDecoder:
+    """Extracts (sni, alpn) from client QUIC Initial packets."""
+
+    def __init__(self, max_connections: int = MAX_CONNECTIONS):
+        self.max_connections = max_connections
+        self._states = OrderedDict()
+        self.decrypt_errors = 0
+
+    def decode(self, payload) -> Optional[Tuple[Optional[str], List[str]]]:
+        """
+        Returns (sni, alpn) once the ClientHello is complete, None otherwise
+        (not an Initial, undecryptable, or ClientHello spans more packets).
+        """
+        if AESGCM is None or not is_initial(payload):
+            return None
+        buf = payload if isinstance(payload, memoryview) else memoryview(payload)
+        try:
+            return self._decode(buf)
+        except (IndexError, ValueError):
+            return None
+
+    def _decode(self, buf):
+        version = int.from_bytes(buf[1:5], 'big')
+        off = 5
+        dcid_len = buf[off]
+        dcid = bytes(buf[off + 1:off + 1 + dcid_len])
+        off += 1 + dcid_len
+        off += 1 + buf[off]  # SCID
+        token_len, off = _read_varint(buf, off)
+        off += token_len
+        length, pn_off = _read_varint(buf, off)
+        if pn_off + length > len(buf) or length < 20:
+            return None
+
+        state = self._states.get(dcid)
+        if state is None:
+            state = _InitialState(version, dcid)
+            self._states[dcid] = state
+            if len(self._states) > self.max_connections:
+                self._states.popitem(last=False)
+        else:
+            self._states.move_to_end(dcid)
+        if state.result is not None:
+            # Retransmission of a ClientHello we already decoded
+            return state.result
+
+        # Header protection: sample starts 4 bytes after the packet number offset
+        mask = state.hp.update(bytes(buf[pn_off + 4:pn_off + 20]))
+        first = buf[0] ^ (mask[0] & 0x0F)
+        pn_len = (first & 0x03) + 1
+        pn = bytearray(buf[pn_off:pn_off + pn_len])
+        for i in range(pn_len):
+            pn[i] ^= mask[1 + i]
+
+        header = bytearray(buf[:pn_off])
+        header[0] = first
+        header += pn
+        nonce = bytearray(state.iv)
+        for i in range(pn_len):
+            nonce[12 - pn_len + i] ^= pn[i]
+
+        try:
+            plain = state.key.decrypt(bytes(nonce), bytes(buf[pn_off + pn_len:pn_off + length]), bytes(header))
+        except Exception:
+            self.decrypt_errors += 1
+            return None
+
+        self._collect_crypto(state, plain)
+        state.result = self._try_client_hello(state)
+        return state.result
+
+    def _collect_crypto(self, state: _InitialState, plain: bytes):
+        off = 0
+        n = len(plain)
+        while off < n:
+            ftype = plain[off]
+            if ftype == FRAME_PADDING:
+                # Padding runs are long (Initials are padded to 1200 bytes); skip in C
+                m = _NON_PADDING.search(plain, off)
+                off = m.start() if m else n
+            elif ftype == FRAME_PING:
+                off += 1
+            elif ftype == FRAME_CRYPTO:
+                c_off, off = _read_varint(plain, off + 1)
+                c_len, off = _read_varint(plain, off)
+                if c_off + c_len <= MAX_CRYPTO_BYTES:
+                    state.fragments[c_off] = plain[off:off + c_len]
+                off += c_len
+            elif ftype == FRAME_ACK or ftype == FRAME_ACK_ECN:
+                _, off = _read_varint(plain, off + 1)          # largest acknowledged
+                _, off = _read_varint(plain, off)              # ack delay
+                ranges, off = _read_varint(plain, off)
+                _, off = _read_varint(plain, off)              # first range
+                for _ in range(ranges * 2):
+                    _, off = _read_varint(plain, off)
+                if ftype == FRAME_ACK_ECN:
+                    for _ in range(3):
+                        _, off = _read_varint(plain, off)
+            else:
+                # CONNECTION_CLOSE or anything unexpected in an Initial: stop here
+                break
+
+    def _try_client_hello(self, state: _InitialState):
+        # Stitch fragments contiguous from offset 0
+        data = bytearray()
+        for c_off in sorted(state.fragments):
+            if c_off > len(data):
+                break
+            chunk = state.fragments[c_off]
+            data += chunk[len(data) - c_off:]
+        if len(data) < 4 or data[0] != 0x01:
+            return None
+        hello_len = int.from_bytes(data[1:4], 'big')
+        if len(data) < 4 + hello_len:
+            return None
+        state.fragments = {}
+        return parse_client_hello_body(memoryview(data)[4:4 + hello_len])
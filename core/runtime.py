@@ -0,0 +1,57 @@
+"""
+Runtime Directory - state that has to outlive this process
+Hostlists, nfqws logs and the firewall record are read and replaced by a
+root process, so they must not live in a world-writable place such as
+/tmp: a user who creates the directory first, or plants a symlink in it,
+would get root to clobber or delete files of their choosing. Everything
+goes into RUNTIME_DIR instead, which is only used once it is a real
+directory owned by us that nobody else can write to, and files inside are
+never opened through a symlink.
+
+Directory and files stay world-readable (0755/0644): nfqws started as root
+drops to an unprivileged uid (0x7FFFFFFF unless --user/--uid is given)
+before it opens its --hostlist files.
+"""
+import os
+import stat
+import tempfile
+
+RUNTIME_DIR = "/run/zapret-autonomous"
+RUNTIME_DIR_MODE = 0o755
+RUNTIME_FILE_MODE = 0o644
+
+
+def ensure_runtime_dir(path: str = RUNTIME_DIR) -> str:
+    """Create path (0755) if needed; PermissionError unless it is a directory owned by us, writable by nobody else."""
+    os.makedirs(path, mode=RUNTIME_DIR_MODE, exist_ok=True)
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.geteuid() or st.st_mode & 0o022:
+        raise PermissionError(f"{path}: must be a directory owned by uid {os.geteuid()}, not group/world-writable")
+    if stat.S_IMODE(st.st_mode) != RUNTIME_DIR_MODE:
+        # A restrictive umask would lock the unprivileged nfqws out of its hostlists
+        os.chmod(path, RUNTIME_DIR_MODE)
+    return path
+
+
+def open_nofollow(path: str, flags: int = os.O_RDONLY) -> int:
+    """os.open() that refuses symlinks (ELOOP) in the last path component."""
+    return os.open(path, flags | os.O_NOFOLLOW | os.O_CLOEXEC, 0o600)
+
+
+def read_file(path: str) -> bytes:
+    with os.fdopen(open_nofollow(path), 'rb') as f:
+        return f.read()
+
+
+def write_atomic(path: str, data: bytes, mode: int = RUNTIME_FILE_MODE):
+    """Replace path with data: fresh mkstemp file (0600, widened to mode) in the same directory, then rename over it."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=f".{os.path.basename(path)}.")
+    try:
+        os.fchmod(fd, mode)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        # rename() replaces a symlink at path itself, never its target
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
@@ -2,33 +2,181 @@
 Strategy Applicator - The Real Deal
 Applies iptables rules and spawns nfqws process to actually bypass DPI.
 Implements Singleton pattern for global access.
+
+Each strategy in use is one nfqws profile (--new) filtered by its own
+hostlist, so different domains keep different strategies at the same time
+behind a single nfqws on a single queue. nfqws re-reads a hostlist when
+its mtime changes: a domain joining a strategy that is already running
+costs a file write, not a restart. Only a strategy entering or leaving the
+profile set restarts nfqws.
+
+Target IPs live in one kernel hash set per address family (ipset
+hash:net under iptables, an nftables named set under the nft backend or
+when ipset is missing) behind a single
+NFQUEUE rule each: matching stays O(1) however many domains are bypassed,
+and the whole list is loaded with one `ipset restore` / `nft -f` instead of
+an iptables call per IP. Domains are resolved to their IPv4 and, when the
+host has an IPv6 route, IPv6 address: browsers prefer the latter.
+
+Reloads are make-before-break: the new nfqws starts on the other of two
+queues, the rules are switched to it in one transaction (core.firewall /
+nft -f) once it has bound, and only then is the old process
+retired. There is no moment without a desync engine on the path.
 """
+import os
 import subprocess
 import shutil
 import logging
 import atexit
 import shlex
 import socket
-import requests
-from typing import Optional, List
+import threading
+import time
+from typing import Dict, Optional, List
+from core.firewall import BACKEND_NFT, RuleBatch, get_firewall
+from core.runtime import RUNTIME_DIR, ensure_runtime_dir, open_nofollow, read_file, write_atomic
 from solver.heuristics import STRATEGIES
+from solver.nfqws_pool import READY_MARKER, READY_TIMEOUT
+from solver.parallel_prober import ip_family, resolve_family, resolve_ipv6
 
 # Configuration
 NFQUEUE_NUM = 200
+NFQUEUE_ALT = 201      # Reloads alternate between the two queues
+RETIRE_DELAY = 0.5     # Old nfqws drains its queue this long after the switch
 NFQWS_PATH = shutil.which('nfqws') or '/usr/bin/nfqws'
 
+# Target set (see module docstring)
+SET_NAME = "zapret_auto"
+SET_NAME6 = "zapret_auto6"
+SET_MAXELEM = 65536
+NFT_TABLE = "zapret_auto"
+
+# One hostlist file per active strategy; must outlive this process, like nfqws (root-owned, see core.runtime)
+HOSTLIST_DIR = RUNTIME_DIR
+
+
+def set_name(family: int = 4) -> str:
+    return SET_NAME6 if family == 6 else SET_NAME
+
+
+def set_type(firewall_backend: Optional[str]) -> Optional[str]:
+    """'ipset' or 'nft' for a core.firewall backend: nft rules cannot match an ipset, so nft means nft sets."""
+    if firewall_backend != BACKEND_NFT and shutil.which('ipset'):
+        return 'ipset'
+    return 'nft' if shutil.which('nft') else None
+
+
+def ipset_script(ips: List[str], flush: bool = True) -> str:
+    """`ipset restore` input: create both sets if needed, optionally empty them, add ips to their family's set."""
+    lines = [f"create {SET_NAME} hash:net family inet maxelem {SET_MAXELEM}",
+             f"create {SET_NAME6} hash:net family inet6 maxelem {SET_MAXELEM}"]
+    if flush:
+        lines += [f"flush {SET_NAME}", f"flush {SET_NAME6}"]
+    lines.extend(f"add {set_name(ip_family(ip))} {ip}" for ip in ips)
+    return "\n".join(lines) + "\n"
+
+
+def _nft_rules(queue_num: int) -> str:
+    return (f"tcp dport 443 ip daddr @{SET_NAME} queue num {queue_num} bypass; "
+            f"tcp dport 443 ip6 daddr @{SET_NAME6} queue num {queue_num} bypass")
+
+
+def nft_script(ips: List[str], queue_num: int = NFQUEUE_NUM) -> str:
+    """`nft -f` input: (re)create our table with both sets and their queue rules."""
+    sets = []
+    for family, addr_type in ((4, 'ipv4_addr'), (6, 'ipv6_addr')):
+        members = [ip for ip in ips if ip_family(ip) == family]
+        # An empty element list is a syntax error: leave the clause out
+        elements = f" elements = {{ {', '.join(members)} }}" if members else ""
+        sets.append(f"  set {set_name(family)} {{ type {addr_type}; flags interval; auto-merge;"
+                    f" size {SET_MAXELEM};{elements} }}\n")
+    return (
+        f"table inet {NFT_TABLE}\n"
+        f"delete table inet {NFT_TABLE}\n"
+        f"table inet {NFT_TABLE} {{\n"
+        + ''.join(sets) +
+        f"  chain output {{ type filter hook output priority mangle; {_nft_rules(queue_num)} }}\n"
+        f"}}\n"
+    )
+
+
+def nft_steer_script(queue_num: int) -> str:
+    """`nft -f` input: point the queue rules at another queue in one transaction."""
+    return f"flush chain inet {NFT_TABLE} output\n" + ''.join(
+        f"add rule inet {NFT_TABLE} output {rule.strip()}\n" for rule in _nft_rules(queue_num).split(';'))
+
+
+def nft_add_script(ips: List[str]) -> str:
+    """`nft -f` input: add ips to the existing sets."""
+    lines = []
+    for family in (4, 6):
+        members = [ip for ip in ips if ip_family(ip) == family]
+        if members:
+            lines.append(f"add element inet {NFT_TABLE} {set_name(family)} {{ {', '.join(members)} }}")
+    return "\n".join(lines) + "\n"
+
+
+def set_rule(queue_num: int = NFQUEUE_NUM, family: int = 4) -> List[str]:
+    """The one iptables (family 4) or ip6tables rule that steers the ipset's members into nfqws."""
+    return [
+        'OUTPUT',
+        '-p', 'tcp', '--dport', '443',
+        '-m', 'set', '--match-set', set_name(family), 'dst',
+        '-j', 'NFQUEUE', '--queue-num', str(queue_num), '--queue-bypass'
+    ]
+
+
+def ip_rule(ip: str, queue_num: int = NFQUEUE_NUM) -> List[str]:
+    """Per-IP fallback rule (no set support)."""
+    return [
+        'OUTPUT',
+        '-p', 'tcp', '--dport', '443',
+        '-d', ip,
+        '-j', 'NFQUEUE', '--queue-num', str(queue_num), '--queue-bypass'
+    ]
+
+
+def remove_target_set(kind: Optional[str] = None):
+    """
+    Drop the set; works from any process (e.g. `zapret-cli.py stop`). An ipset
+    still referenced by its rule cannot be destroyed: tear the firewall down first.
+    kind defaults to the set type of the detected firewall backend.
+    """
+    kind = kind or set_type(get_firewall().backend)
+    if kind == 'ipset':
+        for name in (SET_NAME, SET_NAME6):
+            subprocess.run(['ipset', 'destroy', name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    elif kind == 'nft':
+        subprocess.run(['nft', 'delete', 'table', 'inet', NFT_TABLE],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
 class StrategyApplicator:
     """
-    Manages iptables rules and nfqws process for actual DPI bypass.
+    Manages iptables rules and the nfqws process for actual DPI bypass.
     Should be used as a Singleton via get_applicator().
     """
     
-    def __init__(self):
+    def __init__(self, hostlist_dir: str = HOSTLIST_DIR):
         self.current_process = None
         self.applied_rules = []
+        self.set_active = False
+        self.set_families: List[int] = []    # ipset: families whose set rule is installed
+        self.hostlist_dir = hostlist_dir
+        self.domains: Dict[str, str] = {}    # domain -> strategy
+        self.resolved: Dict[str, List[str]] = {}  # domain -> IPs (IPv4, IPv6) loaded into the sets
+        self.profiles: List[str] = []        # Strategies of the running nfqws, in --new order
+        self.queue_num = NFQUEUE_NUM         # Queue the rules currently point at
+        self.retiring: Dict[int, tuple] = {}  # queue -> (Timer, old nfqws) still draining it
+        self.firewall = get_firewall()
+        self.lock = threading.RLock()
         # NOT using atexit - nfqws should persist after script exits
         # User will manually call 'zapret-cli.py stop' to cleanup
-    
+
+    @property
+    def set_backend(self) -> Optional[str]:
+        """Set type matching the firewall the rules go through (see set_type())."""
+        return set_type(self.firewall.backend)
+
     def is_active(self) -> bool:
         """Check if bypass is currently active (process running)."""
         if self.current_process is None:
@@ -40,134 +188,303 @@ class StrategyApplicator:
         return True
 
     def apply(self, strategy_key: str, domains: List[str]) -> bool:
-        """Apply a specific strategy for the given domains."""
-        self.stop()  # Clean up existing processes/rules first
-        
-        logging.info(f"Applying strategy: {strategy_key} for {len(domains)} domains")
-        
-        if not self._apply_iptables(domains):
-            logging.error("Failed to apply iptables rules")
-            return False
-            
-        if not self._start_nfqws(strategy_key):
-            logging.error("Failed to start nfqws")
-            self._cleanup_iptables()
+        """Apply a specific strategy for the given domains, next to those already active."""
+        return self.apply_many({domain: strategy_key for domain in domains})
+
+    def apply_many(self, mapping: Dict[str, str]) -> bool:
+        """Add (or move) domains -> strategy; other domains keep their strategy and connections."""
+        for strategy_key in set(mapping.values()) - set(STRATEGIES):
+            logging.error(f"Unknown strategy: {strategy_key}")
+        mapping = {domain: key for domain, key in mapping.items() if key in STRATEGIES}
+        if not mapping:
             return False
+        
+        with self.lock:
+            logging.info(f"Applying {len(mapping)} domains with {len(set(mapping.values()))} strategies")
+            if not self._apply_iptables(list(mapping)):
+                logging.error("Failed to apply iptables rules")
+                return False
+            self.domains.update(mapping)
+            self._write_hostlists()
             
-        return True
+            if self.is_active() and self.profiles == self._profile_order():
+                logging.info("✓ Hostlists updated, nfqws keeps running")
+                return True
+            if not self._start_nfqws():
+                logging.error("Failed to start nfqws")
+                return False
+            return True
+    
+    def restart(self) -> bool:
+        """Restart nfqws with the current profiles, e.g. after it died."""
+        with self.lock:
+            return bool(self.domains) and self._start_nfqws()
     
     def stop(self):
-        """Stop current bypass (kill nfqws, remove rules). Safe to call multiple times."""
+        """Stop current bypass (kill nfqws, remove rules and hostlists). Safe to call multiple times."""
+        with self.lock:
+            self._stop_nfqws()
+            self._cleanup_iptables()
+            self.domains = {}
+            self.resolved = {}
+            self._write_hostlists()
+
+    def _stop_nfqws(self):
+        for queue_num in list(self.retiring):
+            self._finish_retire(queue_num)
         if self.current_process:
             logging.info("Stopping nfqws...")
-            self.current_process.terminate()
-            try:
-                self.current_process.wait(timeout=2)
-            except subprocess.TimeoutExpired:
-                self.current_process.kill()
+            self._terminate(self.current_process)
             self.current_process = None
+            self.profiles = []
             logging.info("✓ nfqws stopped")
-            
-        self._cleanup_iptables()
+        for queue_num in (NFQUEUE_NUM, NFQUEUE_ALT):
+            if os.path.exists(self._log_path(queue_num)):
+                os.remove(self._log_path(queue_num))
 
-    def _cleanup_iptables(self):
-        """Remove all applied iptables rules in reverse order."""
-        if self.applied_rules:
-            logging.info("Removing iptables rules...")
-            for rule in reversed(self.applied_rules):
-                # Suppress output during cleanup
-                subprocess.run(['iptables', '-t', 'mangle', '-D'] + rule, 
-                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            self.applied_rules = []
-            
-            # Flush specific queue rule just in case (Safety net)
-            subprocess.run(['iptables', '-t', 'mangle', '-D', 'OUTPUT', 
-                          '-p', 'tcp', '--dport', '443',
-                          '-j', 'NFQUEUE', '--queue-num', str(NFQUEUE_NUM), '--queue-bypass'], 
-                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            logging.info("✓ IPTables rules removed")
-
-    def _resolve_ip(self, domain: str) -> Optional[str]:
-        """Resolve IP. Priorities: System DNS > DoH Fallback."""
-        # 1. System DNS (Trusting user's NextDNS/DoT setup)
+    @staticmethod
+    def _terminate(proc: subprocess.Popen):
+        proc.terminate()
         try:
-            ip = socket.gethostbyname(domain)
-            if not ip.startswith("0.") and ip != "127.0.0.1":
-                return ip
-        except:
-            pass
-            
-        # 2. DoH Fallback (Cloudflare) - Only if system DNS fails
-        try:
-            resp = requests.get(
-                "https://cloudflare-dns.com/dns-query",
-                params={"name": domain, "type": "A"},
-                headers={"Accept": "application/dns-json"},
-                timeout=5, verify=False
-            )
-            data = resp.json()
-            if "Answer" in data:
-                for ans in data["Answer"]:
-                    if ans.get("type") == 1: # A record
-                        return ans.get("data")
-        except:
-            pass
-        return None
+            proc.wait(timeout=2)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+    def _profile_order(self) -> List[str]:
+        return sorted(set(self.domains.values()))
+
+    def _hostlist_path(self, strategy_key: str) -> str:
+        return os.path.join(self.hostlist_dir, f"{strategy_key}.txt")
+
+    def _log_path(self, queue_num: int) -> str:
+        # nfqws output goes to a file, not a pipe: it must survive this process exiting.
+        # Same runtime directory as the hostlists, opened without following symlinks
+        return os.path.join(self.hostlist_dir, f"nfqws-{queue_num}.log")
+
+    def _write_hostlists(self):
+        """One file per strategy in use; unchanged files are not touched (nfqws reloads on mtime)."""
+        by_strategy: Dict[str, List[str]] = {}
+        for domain, strategy_key in self.domains.items():
+            by_strategy.setdefault(strategy_key, []).append(domain)
+        ensure_runtime_dir(self.hostlist_dir)
+        
+        for strategy_key, domains in by_strategy.items():
+            path = self._hostlist_path(strategy_key)
+            content = ("\n".join(sorted(domains)) + "\n").encode()
+            try:
+                if read_file(path) == content:
+                    continue
+            except OSError:
+                pass
+            # Atomic replace: nfqws never reads a half-written list
+            write_atomic(path, content)
+        
+        for name in os.listdir(self.hostlist_dir):
+            if name.endswith(".txt") and name[:-4] not in by_strategy:
+                os.remove(os.path.join(self.hostlist_dir, name))
+
+    def _cleanup_iptables(self):
+        """Flush our own chains (set rule and per-IP rules alike), then drop the target set."""
+        logging.info("Removing iptables rules...")
+        self.firewall.teardown()
+        self.applied_rules = []
+        logging.info("✓ IPTables rules removed")
+        if self.set_active:
+            remove_target_set(self.set_backend)
+            self.set_active = False
+            self.set_families = []
+            logging.info(f"✓ Target sets {SET_NAME}/{SET_NAME6} removed")
+
+    def _resolve_ips(self, domain: str) -> List[str]:
+        """IPv4 and IPv6 address (whichever exist). Priorities: System DNS > DoH Fallback."""
+        return [ip for ip in (resolve_family(domain, socket.AF_INET), resolve_ipv6(domain)) if ip]
 
     def _apply_iptables(self, domains: List[str]) -> bool:
-        """Apply NFQUEUE rules for target domains using OUTPUT chain."""
+        """
+        Add the IPs of not yet resolved domains to the target set (loaded in full on first use),
+        or fall back to one rule per IP without set support. False if no domain has an IP.
+        """
+        new = {}
+        for domain in domains:
+            if domain in self.resolved:
+                continue
+            resolved = self._resolve_ips(domain)
+            if not resolved:
+                logging.warning(f"Could not resolve {domain}, skipping")
+                continue
+            logging.debug(f"Target {domain} -> {', '.join(resolved)}")
+            new[domain] = resolved
+        known = {ip for resolved in self.resolved.values() for ip in resolved}
+        ips = sorted({ip for resolved in new.values() for ip in resolved} - known)
+        if not ips:
+            self.resolved.update(new)
+            return bool(self.resolved)
+        if self.set_backend is None:
+            logging.warning("Neither ipset nor nft found: falling back to one iptables rule per IP")
+            if not self._apply_per_ip(ips):
+                return False
+            self.resolved.update(new)
+            return True
+        
+        logging.info(f"Loading {len(ips)} IPs into {self.set_backend} sets {SET_NAME}/{SET_NAME6}")
         try:
-            for domain in domains:
-                # Resolve IP
-                ip = self._resolve_ip(domain)
-                if not ip:
-                    logging.warning(f"Could not resolve {domain}, skipping iptables rule")
-                    continue
-                
-                logging.info(f"Adding rule for {domain} -> {ip}")
-                
-                # Rule: OUTPUT chain for specific destination IP
-                # This captures traffic generated by local processes (browsers)
-                rule = [
-                    'OUTPUT',
-                    '-p', 'tcp', '--dport', '443',
-                    '-d', ip,
-                    '-j', 'NFQUEUE', '--queue-num', str(NFQUEUE_NUM), '--queue-bypass'
-                ]
-                
-                subprocess.run(['iptables', '-t', 'mangle', '-I'] + rule, check=True)
-                self.applied_rules.append(rule)
-                
-            return len(self.applied_rules) > 0
-            
+            if self.set_backend == 'ipset':
+                script = ipset_script(ips, flush=not self.set_active)
+                subprocess.run(['ipset', '-exist', 'restore'], input=script.encode(), check=True, capture_output=True)
+                # One rule per set, installed once the family has members; check() keeps it unique
+                families = sorted({ip_family(ip) for ip in ips} - set(self.set_families))
+                batch = RuleBatch()
+                for family in families:
+                    rule = set_rule(self.queue_num, family)
+                    if not self.firewall.check(rule, family=family):
+                        batch.insert(rule, family=family)
+                if not self.firewall.commit(batch):
+                    raise subprocess.CalledProcessError(1, 'iptables-restore')
+                self.set_families = sorted(set(self.set_families) | set(families))
+            else:
+                script = nft_add_script(ips) if self.set_active else nft_script(ips, self.queue_num)
+                subprocess.run(['nft', '-f', '-'], input=script.encode(), check=True, capture_output=True)
         except subprocess.CalledProcessError as e:
-            logging.error(f"IPTables error: {e}")
+            logging.error(f"{self.set_backend} error: {(e.stderr or b'').decode(errors='replace').strip() or e}")
+            if not self.set_active:
+                remove_target_set(self.set_backend)
             return False
+        self.set_active = True
+        self.resolved.update(new)
+        return True
 
-    def _start_nfqws(self, strategy_key: str) -> bool:
-        """Start nfqws process with the given strategy."""
-        if strategy_key not in STRATEGIES:
-            logging.error(f"Unknown strategy: {strategy_key}")
+    def _apply_per_ip(self, ips: List[str]) -> bool:
+        """Legacy path: one OUTPUT rule per destination IP, all installed in one transaction."""
+        # Rule: OUTPUT chain for specific destination IP
+        # This captures traffic generated by local processes (browsers)
+        rules = [ip_rule(ip, self.queue_num) for ip in ips]
+        batch = RuleBatch()
+        for rule in rules:
+            batch.insert(rule)
+        if not self.firewall.commit(batch):
+            logging.error(f"IPTables error: could not add rules for {len(ips)} IPs")
             return False
-            
-        strategy_cmd = STRATEGIES[strategy_key]["cmd"]
-        
-        # Build nfqws command - properly parse strategy_cmd with shlex
-        cmd = [NFQWS_PATH, f'--qnum={NFQUEUE_NUM}'] + shlex.split(strategy_cmd)
-        
+        self.applied_rules.extend(rules)
+        return len(self.applied_rules) > 0
+
+    def _nfqws_command(self, profiles: List[str], queue_num: int) -> List[str]:
+        """One nfqws, one profile per strategy, each limited to its hostlist."""
+        cmd = [NFQWS_PATH, f'--qnum={queue_num}']
+        for idx, strategy_key in enumerate(profiles):
+            if idx:
+                cmd.append('--new')
+            # Properly parse strategy_cmd with shlex
+            cmd += [f'--hostlist={self._hostlist_path(strategy_key)}'] + shlex.split(STRATEGIES[strategy_key]["cmd"])
+        return cmd
+
+    def _spawn(self, profiles: List[str], queue_num: int) -> Optional[subprocess.Popen]:
+        cmd = self._nfqws_command(profiles, queue_num)
         logging.info(f"Starting nfqws: {' '.join(cmd)}")
-        
         try:
-            self.current_process = subprocess.Popen(
-                cmd,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL,
-                start_new_session=True # Detach from terminal to prevent signal propagation
-            )
-            return True
+            ensure_runtime_dir(self.hostlist_dir)
+            fd = open_nofollow(self._log_path(queue_num), os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+            with os.fdopen(fd, 'wb') as log:
+                return subprocess.Popen(
+                    cmd,
+                    stdout=log,
+                    stderr=subprocess.STDOUT,
+                    start_new_session=True # Detach from terminal to prevent signal propagation
+                )
         except Exception as e:
             logging.error(f"Failed to start nfqws: {e}")
+            return None
+
+    def _wait_ready(self, proc: subprocess.Popen, queue_num: int, timeout: float = READY_TIMEOUT) -> bool:
+        """True once nfqws reports its queue bound (see solver.nfqws_pool), False if it exits or times out."""
+        deadline = time.monotonic() + timeout
+        while proc.poll() is None and time.monotonic() < deadline:
+            try:
+                if READY_MARKER in read_file(self._log_path(queue_num)):
+                    return True
+            except OSError:
+                pass
+            time.sleep(0.05)
+        return False
+
+    def _steer(self, queue_num: int) -> bool:
+        """Point every installed rule at queue_num in a single transaction."""
+        try:
+            if self.set_active and self.set_backend == 'nft':
+                subprocess.run(['nft', '-f', '-'], input=nft_steer_script(queue_num).encode(),
+                               check=True, capture_output=True)
+            else:
+                old_rules = [(rule, None) for rule in self.applied_rules]
+                if self.set_active:
+                    old_rules += [(set_rule(self.queue_num, family), family) for family in self.set_families]
+                new_rules = [(rule[:-2] + [str(queue_num), '--queue-bypass'], family) for rule, family in old_rules]
+                batch = RuleBatch()
+                for rule, family in new_rules:
+                    batch.insert(rule, family=family)
+                for rule, family in old_rules:
+                    batch.delete(rule, family=family)
+                if not self.firewall.commit(batch):
+                    raise subprocess.CalledProcessError(1, 'iptables-restore')
+                self.applied_rules = [rule for rule, _ in new_rules[:len(self.applied_rules)]]
+        except (OSError, subprocess.CalledProcessError) as e:
+            logging.error(f"Rule switch to queue {queue_num} failed: {e}")
+            return False
+        self.queue_num = queue_num
+        return True
+
+    def _retire(self, proc: subprocess.Popen, queue_num: int):
+        self._terminate(proc)
+        if os.path.exists(self._log_path(queue_num)):
+            os.remove(self._log_path(queue_num))
+        logging.info(f"✓ Previous nfqws (queue {queue_num}) retired")
+
+    def _finish_retire(self, queue_num: int):
+        """Retire the old nfqws on queue_num now instead of when its timer fires."""
+        timer, proc = self.retiring.pop(queue_num, (None, None))
+        if timer is None:
+            return
+        timer.cancel()
+        timer.join()
+        # Ran already or not: nothing is spawned on the queue yet, so a second pass is harmless
+        self._retire(proc, queue_num)
+
+    def _start_nfqws(self) -> bool:
+        """
+        Start nfqws with a profile for every strategy in use. A running nfqws is
+        replaced make-before-break: new process on the other queue, rule switch
+        once it is bound, then the old one is retired.
+        """
+        profiles = self._profile_order()
+        if not profiles:
             return False
+        old = self.current_process if self.is_active() else None
+        if old is None:
+            # Nothing to hand over from: start on the queue the rules already use
+            self._stop_nfqws()
+            proc = self._spawn(profiles, self.queue_num)
+            if proc is None:
+                return False
+            self.current_process, self.profiles = proc, profiles
+            return True
+        
+        old_queue = self.queue_num
+        new_queue = NFQUEUE_ALT if old_queue == NFQUEUE_NUM else NFQUEUE_NUM
+        # Reload within RETIRE_DELAY of the last one: its timer must not kill (and
+        # delete the log of) the process about to be spawned on the same queue
+        self._finish_retire(new_queue)
+        proc = self._spawn(profiles, new_queue)
+        if proc is None:
+            return False
+        if not self._wait_ready(proc, new_queue) or not self._steer(new_queue):
+            # Keep the old engine: degraded (old profiles) beats unprotected
+            logging.error("New nfqws not ready, keeping the running one")
+            self._terminate(proc)
+            return False
+        self.current_process, self.profiles = proc, profiles
+        # Non-daemon: a one-shot CLI still retires the old process before exiting
+        timer = threading.Timer(RETIRE_DELAY, self._retire, args=(old, old_queue))
+        self.retiring[old_queue] = (timer, old)
+        timer.start()
+        return True
 
 # Global instance for Singleton pattern
 _applicator_instance = None
@@ -0,0 +1,80 @@
+"""
+Verdict Cache - (destination IP, SNI) -> verdict with TTLs
+Lets the interceptor decide most new flows with one dict lookup instead of
+a StrategyDB round-trip, and negatively caches domains that failed to
+solve so the solver is not re-triggered for them on every connection.
+"""
+import time
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+VERDICT_UNKNOWN = 'unknown'      # Not in DB; flows are watched by the BlockDetector
+VERDICT_GOOD = 'known-good'      # Strategy stored / reachable: fast-path accept
+VERDICT_BLOCKED = 'known-blocked'  # Solve failed: don't hammer the solver (negative entry)
+VERDICT_SOLVING = 'solving'      # Solve in progress
+
+DEFAULT_TTLS = {
+    VERDICT_UNKNOWN: 300.0,
+    VERDICT_GOOD: 3600.0,
+    VERDICT_BLOCKED: 1800.0,
+    VERDICT_SOLVING: 120.0,
+}
+DEFAULT_MAX_ENTRIES = 16384
+
+
+class VerdictCache:
+    """Bounded LRU of (dst, sni) -> (verdict, expiry)."""
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, ttls: Optional[dict] = None):
+        self.max_entries = max_entries
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, dst: bytes, sni: str, now: Optional[float] = None) -> Optional[str]:
+        """Cached verdict, or None on miss / expiry."""
+        key = (dst, sni)
+        now = now if now is not None else time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= now:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, dst: bytes, sni: str, verdict: str, ttl: Optional[float] = None,
+            now: Optional[float] = None):
+        now = now if now is not None else time.monotonic()
+        expires = now + (ttl if ttl is not None else self.ttls[verdict])
+        key = (dst, sni)
+        with self._lock:
+            self._entries[key] = (verdict, expires)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def set_domain(self, sni: str, verdict: str, ttl: Optional[float] = None):
+        """Update every cached destination of a domain (e.g. after a solve)."""
+        with self._lock:
+            keys = [key for key in self._entries if key[1] == sni]
+        for dst, _ in keys:
+            self.set(dst, sni, verdict, ttl)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits * 100.0 / total if total else 0.0,
+        }
@@ -0,0 +1,233 @@
+"""
+Async Prober - ParallelProber on a single asyncio event loop
+DNS, iptables steering (core.firewall.AsyncFirewall: folded transactions
+through asyncio.create_subprocess_exec) and TLS handshakes all run as
+coroutines with per-probe deadlines, so one process can run many
+domain solves at once without a thread per probe. The number of probes in
+flight is capped by a semaphore, which can be shared across solves.
+
+nfqws instances still come from the warm NfqwsPool: they outlive any
+single loop, so they stay plain Popen processes. A worker that is already
+running costs nothing; one that has to be (re)started is forked in the
+default executor, so the loop never blocks on Popen, and its readiness is
+then polled from the loop.
+
+Telemetry is sqlite, so it never runs on the loop either: the StatsTracker
+is created, the bandit queried and probe records written in the default
+executor.
+"""
+import asyncio
+import logging
+import socket
+import time
+from typing import Dict, List, Optional
+
+from .bandit import StrategyBandit, configured_isp, dst_prefix
+from .heuristics import PRIORITY_LIST, STRATEGIES
+from .nfqws_pool import get_nfqws_pool
+from .parallel_prober import (MAX_PARALLEL, NO_RECORD_ERRORS, PROBE_TIMEOUT, _ms_since, _reserve_port, has_route,
+                              ip_family, probe_record, probe_targets, resolve_family, usable_ip)
+from .tls_probe import ProbeResult, probe_tls_async
+from core.firewall import RuleBatch, get_async_firewall
+from telemetry.stats_tracker import StatsTracker
+
+READY_POLL = 0.02  # Interval for awaiting nfqws readiness
+
+
+async def resolve_domain_async(domain: str, family: int = socket.AF_INET) -> Optional[str]:
+    """System resolver through the loop; DoH fallback (blocking) only when that fails or is poisoned."""
+    loop = asyncio.get_running_loop()
+    try:
+        infos = await loop.getaddrinfo(domain, 443, family=family, type=socket.SOCK_STREAM)
+        ip = infos[0][4][0]
+        if usable_ip(ip):
+            return ip
+    except socket.gaierror as e:
+        if e.errno in NO_RECORD_ERRORS:
+            return None
+        logging.debug(f"[DNS] {domain}: {e}")
+    except (OSError, IndexError) as e:
+        logging.debug(f"[DNS] {domain}: {e}")
+    return await loop.run_in_executor(None, resolve_family, domain, family)
+
+
+class AsyncProber:
+    def __init__(self, target_domain: str, enable_telemetry: bool = True, max_parallel: int = MAX_PARALLEL,
+                 adaptive: bool = True, isp: Optional[str] = None, resolved_ip: Optional[str] = None,
+                 sni_pool: Optional[List[str]] = None, limiter: Optional[asyncio.Semaphore] = None,
+                 dual_stack: bool = True):
+        self.target_domain = target_domain
+        self.max_parallel = max(1, max_parallel)
+        self.adaptive = adaptive
+        self.isp = configured_isp(isp)  # Scopes telemetry and the bandit (see solver.bandit)
+        self.sni_pool = list(sni_pool) if sni_pool else [target_domain]
+        self.limiter = limiter  # Created lazily: a Semaphore must belong to the running loop
+        self.enable_telemetry = enable_telemetry
+        self.tracker: Optional[StatsTracker] = None  # Created by solve(), off the loop (sqlite)
+        self._telemetry = []  # Pending record_probe() calls in the executor
+        self.pool = get_nfqws_pool()
+        self.winner_strategy = None
+        self.results: Dict[str, ProbeResult] = {}
+        self.family_results: Dict[str, Dict[int, ProbeResult]] = {}
+        self.cleanup_task = None
+        self.dual_stack = dual_stack
+        self.targets: List[str] = []  # Filled by solve(): IPv4, then IPv6 (see ParallelProber)
+        self._resolved_ip = resolved_ip
+        self._probes = 0
+
+    async def _firewall(self, batch: RuleBatch) -> bool:
+        # Rules of concurrent probes on this loop share one transaction
+        return await get_async_firewall().submit(batch)
+
+    async def _acquire(self, strategy_key: str):
+        if strategy_key not in STRATEGIES:
+            return None
+        worker = self.pool.running(strategy_key)
+        if worker is None:
+            # Popen (and the pool lock) would block the loop: fork in the executor, deliberately
+            worker = await asyncio.get_running_loop().run_in_executor(None, self.pool.ensure, strategy_key)
+        deadline = asyncio.get_running_loop().time() + self.pool.ready_timeout
+        while not worker.ready.is_set() and asyncio.get_running_loop().time() < deadline:
+            await asyncio.sleep(READY_POLL)
+        return worker if worker.bound and worker.alive() else None
+
+    async def _test_strategy(self, strategy_key: str) -> Optional[ProbeResult]:
+        """Probe one strategy; None if it was skipped (winner already known, nfqws not ready, rule failed)."""
+        async with self.limiter:
+            if self.winner_strategy:
+                return None
+            timings = {}
+            phase_start = time.monotonic()
+            worker = await self._acquire(strategy_key)
+            timings['ready_ms'] = _ms_since(phase_start)
+            if worker is None or self.winner_strategy:
+                return None
+
+            # The primary family decides; other families are only recorded (see ParallelProber)
+            primary, *others = self.targets
+            result = await self._test_target(strategy_key, worker, primary, dict(timings))
+            if result is not None:
+                self.results[strategy_key] = result
+            if result is None or not result.ok:
+                return result
+            for ip in others:
+                extra = await self._test_target(strategy_key, worker, ip, dict(timings))
+                if extra is not None and not extra.ok:
+                    logging.warning(f"[{strategy_key}] IPv{ip_family(ip)} başarısız, IPv{ip_family(primary)} yeterli")
+            # Claim the win before this slot frees up, so queued strategies skip
+            self.winner_strategy = self.winner_strategy or strategy_key
+            return result
+
+    async def _test_target(self, strategy_key: str, worker, ip: str, timings: dict) -> Optional[ProbeResult]:
+        # Same isolation as ParallelProber: one source port per probe, matched in the rule
+        sock = _reserve_port(socket.AF_INET6 if ip_family(ip) == 6 else socket.AF_INET)
+        source_port = sock.getsockname()[1]
+        rule = [
+            'OUTPUT',
+            '-p', 'tcp', '--sport', str(source_port), '--dport', '443', '-d', ip,
+            '-j', 'NFQUEUE', '--queue-num', str(worker.queue_num), '--queue-bypass'
+        ]
+        phase_start = time.monotonic()
+        # The drainer commits the insert even if this probe is cancelled while waiting
+        # for it, so it runs as its own task and the finally below always settles it
+        insert = asyncio.ensure_future(self._firewall(RuleBatch().insert(rule)))
+        result = sni = None
+        try:
+            if not await asyncio.shield(insert):
+                return None
+            timings['iptables_ms'] = _ms_since(phase_start)
+            sni = self.sni_pool[self._probes % len(self.sni_pool)]
+            self._probes += 1
+            result = await probe_tls_async(ip, sni, timeout=PROBE_TIMEOUT, sock=sock)
+            self.family_results.setdefault(strategy_key, {})[ip_family(ip)] = result
+            if not result.ok:
+                logging.debug(f"[{strategy_key}] ✗ IPv{ip_family(ip)} {result}")
+            return result
+        finally:
+            sock.close()  # Already closed by the probe, unless it never ran
+            # Shielded: a cancelled probe still removes its rule, once the insert is known to be in
+            if await asyncio.shield(insert):
+                phase_start = time.monotonic()
+                await asyncio.shield(self._firewall(RuleBatch().delete(rule)))
+                timings['teardown_ms'] = _ms_since(phase_start)
+            if result is not None:
+                self._record(strategy_key, result, sni, timings, ip)
+
+    async def _run(self, strategy_key: str):
+        try:
+            return strategy_key, await self._test_strategy(strategy_key)
+        except (OSError, ValueError) as e:
+            logging.debug(f"[{strategy_key}] Exception: {e}")
+            return strategy_key, None
+
+    def _record(self, strategy_key: str, result: ProbeResult, sni: str, timings: dict, ip: str):
+        if self.tracker is None:
+            return
+        # record_probe() writes a full batch inline: keep it off the loop, awaited by _cleanup()
+        record = probe_record(strategy_key, result, sni, self.isp, dst_prefix(ip), timings)
+        self._telemetry.append(asyncio.get_running_loop().run_in_executor(None, self.tracker.record_probe, *record))
+
+    def strategy_order(self) -> List[str]:
+        if not self.adaptive or self.tracker is None:
+            return list(PRIORITY_LIST)
+        return StrategyBandit(self.tracker).rank(isp=self.isp, ip=self._resolved_ip)
+
+    async def solve(self) -> Optional[str]:
+        """First strategy whose handshake succeeds; losers are cancelled and cleaned up in the background."""
+        if self._resolved_ip is None:
+            self._resolved_ip = await resolve_domain_async(self.target_domain)
+        ipv6 = None
+        if self.dual_stack and has_route(socket.AF_INET6):
+            ipv6 = await resolve_domain_async(self.target_domain, socket.AF_INET6)
+        self.targets = probe_targets(self._resolved_ip, ipv6)
+        if not self.targets:
+            return None
+        self._resolved_ip = self.targets[0]
+        if self.limiter is None:
+            self.limiter = asyncio.Semaphore(self.max_parallel)
+
+        loop = asyncio.get_running_loop()
+        if self.enable_telemetry and self.tracker is None:
+            self.tracker = await loop.run_in_executor(None, StatsTracker)
+        # The bandit reads probe_log: sqlite, off the loop
+        order = await loop.run_in_executor(None, self.strategy_order)
+        # Solving again: the last run's probes must be gone before its state is reset
+        await self.wait_cleanup()
+        self.winner_strategy = None
+        self.results = {}
+        self.family_results = {}
+        tasks = [asyncio.ensure_future(self._run(key)) for key in order]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                _, result = await next_done
+                if result is not None and result.ok:
+                    logging.info(f"[{self.winner_strategy}] ✓ BAŞARILI ({result.total_time:.2f}s)")
+                    break
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.cleanup_task = asyncio.ensure_future(self._cleanup(tasks))
+        return self.winner_strategy
+
+    async def _cleanup(self, tasks):
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self.tracker is not None:
+            for outcome in await asyncio.gather(*self._telemetry, return_exceptions=True):
+                if isinstance(outcome, Exception):
+                    logging.debug(f"Telemetry error: {outcome}")
+            self._telemetry = []
+            await asyncio.get_running_loop().run_in_executor(None, self.tracker.flush_probes)
+
+    async def wait_cleanup(self):
+        """Await rule removal of cancelled probes; call before the loop shuts down."""
+        if self.cleanup_task is not None:
+            await self.cleanup_task
+
+
+async def solve_many(domains: List[str], max_parallel: int = MAX_PARALLEL, **kwargs) -> Dict[str, Optional[str]]:
+    """Solve several domains concurrently on the current loop, sharing one probe budget."""
+    limiter = asyncio.Semaphore(max_parallel)
+    probers = [AsyncProber(domain, limiter=limiter, **kwargs) for domain in domains]
+    winners = await asyncio.gather(*(prober.solve() for prober in probers))
+    await asyncio.gather(*(prober.wait_cleanup() for prober in probers))
+    return dict(zip(domains, winners))
@@ -0,0 +1,89 @@
+"""
+Adaptive Strategy Ordering - Thompson sampling over bypass_log
+Each strategy is an arm with a Beta posterior over its success rate. The
+posterior is built from probe outcomes for the same destination prefix,
+plus ISP-wide outcomes at reduced weight. The static PRIORITY_LIST is a
+weak prior, so unexplored strategies keep their hand-tuned order.
+Sampling (instead of sorting by mean) keeps exploring: a strategy that
+lost a few times still surfaces now and then.
+
+On a single ISP a handful of strategies win almost every time, so they end
+up in the first probe wave and a solve usually takes one round.
+
+The destination scope is the /24 (IPv6: /48) prefix, an approximation of
+the target's ASN / CDN edge: no ASN database is shipped, and one such
+prefix almost always belongs to a single AS and PoP. It errs on the narrow
+side (an AS spans many prefixes), which the ISP-wide outcomes make up for.
+
+The ISP is not detected either: it is a label the operator configures
+(--isp or $ZAPRET_ISP, see configured_isp()). Without one every probe lands
+under 'Unknown' and the ISP-wide level simply spans all history.
+"""
+import ipaddress
+import logging
+import os
+import random
+from typing import Dict, List, Optional, Tuple
+
+from .heuristics import PRIORITY_LIST
+
+PREFIX_V4 = 24           # Destination scope: same /24 is usually the same CDN PoP / AS
+PREFIX_V6 = 48
+ISP_WEIGHT = 0.5         # Outcomes from other prefixes on the same ISP count half
+PRIOR_STRENGTH = 1.0     # Pseudo-successes given to the head of PRIORITY_LIST
+LATENCY_REF_MS = 500.0   # A success at this latency is worth half of an instant one
+                         # (also assumed for strategies without a recorded success)
+HISTORY_DAYS = 90
+ISP_ENV = "ZAPRET_ISP"   # Default ISP label when none is passed explicitly
+UNKNOWN_ISP = "Unknown"
+
+
+def configured_isp(isp: Optional[str] = None) -> str:
+    """isp if given, else $ZAPRET_ISP, else 'Unknown'."""
+    return (isp or os.environ.get(ISP_ENV, "")).strip() or UNKNOWN_ISP
+
+
+def dst_prefix(ip: str) -> Optional[str]:
+    """'203.0.113.7' -> '203.0.113.0/24'; None for anything that is not an IP."""
+    try:
+        addr = ipaddress.ip_address(ip)
+    except ValueError:
+        return None
+    bits = PREFIX_V4 if addr.version == 4 else PREFIX_V6
+    return str(ipaddress.ip_network(f"{ip}/{bits}", strict=False))
+
+
+class StrategyBandit:
+    def __init__(self, tracker, strategies: Optional[List[str]] = None,
+                 rng: Optional[random.Random] = None):
+        self.tracker = tracker
+        self.strategies = list(strategies or PRIORITY_LIST)
+        self.rng = rng or random.Random()
+
+    def _outcomes(self, isp: Optional[str], prefix: Optional[str]) -> Tuple[Dict, Dict]:
+        try:
+            scoped = self.tracker.strategy_outcomes(isp=isp, dst_prefix=prefix, days=HISTORY_DAYS) if prefix else {}
+            wide = self.tracker.strategy_outcomes(isp=isp, days=HISTORY_DAYS)
+        except Exception as e:
+            logging.debug(f"[BANDIT] No history: {e}")
+            return {}, {}
+        return scoped, wide
+
+    def rank(self, isp: Optional[str] = None, ip: Optional[str] = None) -> List[str]:
+        """Strategies ordered by one Thompson sample each, best first."""
+        scoped, wide = self._outcomes(isp, dst_prefix(ip) if ip else None)
+        n = len(self.strategies)
+        scores = {}
+        for idx, strategy in enumerate(self.strategies):
+            ok, failed, latency = scoped.get(strategy, (0, 0, None))
+            w_ok, w_failed, w_latency = wide.get(strategy, (0, 0, None))
+            # ISP-wide counts include the scoped ones; only the remainder is discounted
+            alpha = 1.0 + PRIOR_STRENGTH * (n - idx) / n + ok + ISP_WEIGHT * (w_ok - ok)
+            beta = 1.0 + failed + ISP_WEIGHT * (w_failed - failed)
+            score = self.rng.betavariate(alpha, beta)
+            latency = latency if latency is not None else w_latency
+            if latency is None:
+                latency = LATENCY_REF_MS
+            score *= LATENCY_REF_MS / (LATENCY_REF_MS + latency)
+            scores[strategy] = score
+        return sorted(self.strategies, key=scores.__getitem__, reverse=True)
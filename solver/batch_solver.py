@@ -0,0 +1,100 @@
+"""
+Batch Solver - solve many domains per edge instead of per domain
+Blocked domains cluster on a few CDN edges (Cloudflare, Akamai, ...), and
+DPI treats them alike. Domains are resolved up front (A and AAAA, reused
+by every prober of the domain) and grouped by
+destination prefix. Each group gets one full probe run against a
+representative IP, rotating the group's domains as SNI. The winner is then
+confirmed for every other member with a single verification probe. Only
+members that fail verification are solved on their own.
+
+Cost scales with the number of distinct edges, not with the number of domains.
+"""
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from .bandit import configured_isp, dst_prefix
+from .parallel_prober import ParallelProber, resolve_domain, resolve_ipv6
+
+RESOLVE_PARALLEL = 16   # Concurrent DNS lookups
+GROUP_PARALLEL = 2      # Groups probed at once (each runs up to MAX_PARALLEL probes)
+VERIFY_PARALLEL = 8     # Concurrent single-strategy verification probes
+MAX_SNI_ROTATION = 8    # SNIs rotated across a group's probes
+
+
+class BatchSolver:
+    def __init__(self, domains: List[str], enable_telemetry: bool = True, isp: Optional[str] = None):
+        self.domains = list(OrderedDict.fromkeys(domains))
+        self.enable_telemetry = enable_telemetry
+        self.isp = configured_isp(isp)
+        self.ips: Dict[str, str] = {}
+        self.ips6: Dict[str, Optional[str]] = {}  # None: no AAAA (or no IPv6 route)
+        self.groups: Dict[str, List[str]] = {}
+        self.probes = 0  # Full probe runs, for reporting
+        self.lock = threading.Lock()
+
+    def _prober(self, domain: str, **kwargs) -> ParallelProber:
+        # Known to have no AAAA: dual_stack off, so the prober does not ask again
+        ipv6 = self.ips6.get(domain)
+        return ParallelProber(domain, enable_telemetry=self.enable_telemetry, isp=self.isp,
+                              resolved_ip=self.ips.get(domain), resolved_ipv6=ipv6,
+                              dual_stack=ipv6 is not None or domain not in self.ips6, **kwargs)
+
+    def _count_probe(self):
+        with self.lock:
+            self.probes += 1
+
+    def resolve(self):
+        """Resolve every domain and group them by destination prefix."""
+        with ThreadPoolExecutor(max_workers=RESOLVE_PARALLEL) as executor:
+            ipv4 = executor.map(resolve_domain, self.domains)
+            ipv6 = executor.map(resolve_ipv6, self.domains)
+            self.ips = dict(zip(self.domains, ipv4))
+            self.ips6 = dict(zip(self.domains, ipv6))
+        self.groups = OrderedDict()
+        for domain in self.domains:
+            # Unresolved domains (resolve_domain returns the name) get a group of their own
+            key = dst_prefix(self.ips[domain]) or domain
+            self.groups.setdefault(key, []).append(domain)
+        logging.info(f"[BATCH] {len(self.domains)} domains on {len(self.groups)} edges")
+
+    def _solve_group(self, key: str, members: List[str]) -> Dict[str, Optional[str]]:
+        lead = members[0]
+        prober = self._prober(lead, sni_pool=members[:MAX_SNI_ROTATION])
+        self._count_probe()
+        strategy = prober.solve()
+        results = {lead: strategy}
+        if len(members) == 1:
+            return results
+        if strategy is None:
+            # Nothing worked for this edge; more probes of the same edge won't help
+            logging.warning(f"[BATCH] {key}: no strategy for {len(members)} domains")
+            return dict.fromkeys(members)
+
+        prober.wait_cleanup()
+        others = members[1:]
+        with ThreadPoolExecutor(max_workers=VERIFY_PARALLEL) as executor:
+            verified = list(executor.map(lambda d: self._prober(d).verify(strategy), others))
+        for domain, ok in zip(others, verified):
+            if ok:
+                results[domain] = strategy
+            else:
+                logging.info(f"[BATCH] {domain}: {strategy} not confirmed, solving separately")
+                self._count_probe()
+                results[domain] = self._prober(domain).solve()
+        return results
+
+    def solve(self) -> Dict[str, Optional[str]]:
+        """domain -> winning strategy (None if nothing worked)."""
+        if not self.groups:
+            self.resolve()
+        results = {}
+        with ThreadPoolExecutor(max_workers=GROUP_PARALLEL) as executor:
+            for group in executor.map(lambda item: self._solve_group(*item), self.groups.items()):
+                results.update(group)
+        logging.info(f"[BATCH] {sum(1 for s in results.values() if s)}/{len(results)} solved "
+                     f"with {self.probes} probe runs")
+        return {domain: results.get(domain) for domain in self.domains}
@@ -0,0 +1,159 @@
+"""
+nfqws Worker Pool - long-lived nfqws instances for probing
+One nfqws per strategy, each bound to its own queue from TEST_QUEUE_BASE,
+kept running across solves. A probe only has to steer the target IP into
+the strategy's queue instead of spawning nfqws and sleeping until it binds.
+
+Readiness is read from nfqws' own output: it prints "initializing raw
+sockets" right after the queue is bound, so the worker is usable as soon
+as that line shows up (or it is known dead if the process exits first).
+"""
+import atexit
+import logging
+import shlex
+import shutil
+import subprocess
+import threading
+from typing import Dict, Iterable, List, Optional
+
+from .heuristics import STRATEGIES
+
+NFQWS_PATH = shutil.which('nfqws') or '/usr/bin/nfqws'
+TEST_QUEUE_BASE = 210
+READY_TIMEOUT = 3.0
+READY_MARKER = b"initializing raw sockets"
+
+
+class NfqwsWorker:
+    """A single nfqws process bound to one test queue."""
+
+    def __init__(self, strategy_key: str, queue_num: int, nfqws_path: str = NFQWS_PATH):
+        self.strategy_key = strategy_key
+        self.queue_num = queue_num
+        self.nfqws_path = nfqws_path
+        self.proc: Optional[subprocess.Popen] = None
+        self.ready = threading.Event()   # Set on bind or on exit
+        self.bound = False
+        self._reader = None
+
+    def command(self) -> List[str]:
+        return [self.nfqws_path, f'--qnum={self.queue_num}'] + shlex.split(STRATEGIES[self.strategy_key]["cmd"])
+
+    def start(self):
+        self.ready.clear()
+        self.bound = False
+        self.proc = subprocess.Popen(
+            self.command(), stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            stdin=subprocess.DEVNULL, start_new_session=True
+        )
+        self._reader = threading.Thread(target=self._read_output, args=(self.proc,), daemon=True)
+        self._reader.start()
+
+    def _read_output(self, proc: subprocess.Popen):
+        # Keeps draining after readiness so a chatty nfqws never blocks on a full pipe
+        for line in proc.stdout:
+            if not self.ready.is_set():
+                if READY_MARKER in line:
+                    self.bound = True
+                    self.ready.set()
+                else:
+                    logging.debug(f"[nfqws:{self.queue_num}] {line.decode(errors='replace').rstrip()}")
+        proc.stdout.close()
+        # EOF: the process is gone; wake up anyone still waiting
+        self.ready.set()
+
+    def alive(self) -> bool:
+        return self.proc is not None and self.proc.poll() is None
+
+    def wait_ready(self, timeout: float = READY_TIMEOUT) -> bool:
+        """True once nfqws has bound its queue, False on timeout or early exit."""
+        return self.ready.wait(timeout) and self.bound and self.alive()
+
+    def stop(self):
+        if self.proc is None:
+            return
+        if self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout=1)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+        if self._reader is not None:
+            self._reader.join(timeout=1)
+        self.proc = None
+        self._reader = None
+
+
+class NfqwsPool:
+    """
+    strategy -> warm NfqwsWorker. Queue numbers are assigned once per
+    strategy and never change, so steering rules stay valid across restarts.
+    """
+
+    def __init__(self, queue_base: int = TEST_QUEUE_BASE, nfqws_path: str = NFQWS_PATH,
+                 ready_timeout: float = READY_TIMEOUT):
+        self.queue_base = queue_base
+        self.nfqws_path = nfqws_path
+        self.ready_timeout = ready_timeout
+        self.workers: Dict[str, NfqwsWorker] = {}
+        self.lock = threading.Lock()
+        self.restarts = 0
+
+    def ensure(self, strategy_key: str) -> NfqwsWorker:
+        """The worker for a strategy, started if needed; does not wait for readiness."""
+        with self.lock:
+            worker = self.workers.get(strategy_key)
+            if worker is None:
+                worker = NfqwsWorker(strategy_key, self.queue_base + len(self.workers), self.nfqws_path)
+                self.workers[strategy_key] = worker
+            if not worker.alive():
+                if worker.proc is not None:
+                    self.restarts += 1
+                    worker.stop()
+                try:
+                    worker.start()
+                except OSError as e:
+                    logging.error(f"Failed to start nfqws for {strategy_key}: {e}")
+                    worker.ready.set()  # Don't make acquire() wait for a process that never started
+            return worker
+
+    def running(self, strategy_key: str) -> Optional[NfqwsWorker]:
+        """The worker for a strategy if its nfqws is alive; never starts one."""
+        worker = self.workers.get(strategy_key)
+        return worker if worker is not None and worker.alive() else None
+
+    def acquire(self, strategy_key: str) -> Optional[NfqwsWorker]:
+        """The running worker for a strategy (started on demand), or None if nfqws is not usable."""
+        if strategy_key not in STRATEGIES:
+            logging.error(f"Unknown strategy: {strategy_key}")
+            return None
+        worker = self.ensure(strategy_key)
+        if not worker.wait_ready(self.ready_timeout):
+            logging.debug(f"[{strategy_key}] nfqws not ready on queue {worker.queue_num}")
+            return None
+        return worker
+
+    def warm(self, strategies: Iterable[str]) -> int:
+        """Start workers for all strategies at once and wait for them; returns how many are ready."""
+        workers = [self.ensure(key) for key in strategies if key in STRATEGIES]
+        return sum(1 for worker in workers if worker.wait_ready(self.ready_timeout))
+
+    def stop(self):
+        with self.lock:
+            for worker in self.workers.values():
+                worker.stop()
+
+
+_pool_instance = None
+_pool_lock = threading.Lock()
+
+
+def get_nfqws_pool() -> NfqwsPool:
+    """Process-wide pool; its nfqws instances are stopped at interpreter exit."""
+    global _pool_instance
+    with _pool_lock:
+        if _pool_instance is None:
+            _pool_instance = NfqwsPool()
+            atexit.register(_pool_instance.stop)
+        return _pool_instance
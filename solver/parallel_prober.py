@@ -2,161 +2,344 @@ import threading
 import socket
 import logging
 import time
+import functools
+import ipaddress
+import itertools
 import requests
-import subprocess
-import shutil
-import shlex
 import urllib3
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, List
 
 urllib3.disable_warnings()
 
-from .heuristics import STRATEGIES, PRIORITY_LIST
+from .heuristics import PRIORITY_LIST
+from .nfqws_pool import get_nfqws_pool
+from .tls_probe import probe_tls, ProbeResult, CancelToken, OUTCOME_CANCELLED
+from .bandit import StrategyBandit, configured_isp, dst_prefix
+from core.firewall import RuleBatch, get_firewall
 from telemetry.stats_tracker import StatsTracker
 
 PROBE_TIMEOUT = 5.0
-USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
-NFQWS_PATH = shutil.which('nfqws') or '/usr/bin/nfqws'
-TEST_QUEUE_BASE = 210
+MAX_PARALLEL = 8  # Strategies probed at the same time
+
+# DoH record type (name, RR number) per address family
+DOH_TYPES = {socket.AF_INET: ("A", 1), socket.AF_INET6: ("AAAA", 28)}
+# Any global address of the family; a UDP connect to it only consults the routing table
+ROUTE_CHECK = {socket.AF_INET: "8.8.8.8", socket.AF_INET6: "2001:4860:4860::8888"}
+# Resolver answers meaning "no such record" (e.g. no AAAA): DoH would say the same, seconds later
+NO_RECORD_ERRORS = {getattr(socket, name) for name in ("EAI_NODATA", "EAI_NONAME") if hasattr(socket, name)}
+
+def _reserve_port(family: int = socket.AF_INET) -> socket.socket:
+    """
+    Socket bound to an ephemeral local port picked by the kernel, used as the
+    probe's source port. The probe connects from this very socket, so the
+    port cannot be taken while the rule matching it is being installed.
+    """
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.bind(('', 0))
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+def usable_ip(ip: str) -> bool:
+    """False for poisoned answers (0.0.0.0/8, ::, loopback) and anything that is not an IP."""
+    try:
+        addr = ipaddress.ip_address(ip)
+    except ValueError:
+        return False
+    return not (addr.is_unspecified or addr.is_loopback or (addr.version == 4 and addr.packed[0] == 0))
+
+@functools.lru_cache(maxsize=None)
+def has_route(family: int) -> bool:
+    """True if this host can reach the family's internet at all (no packet is sent)."""
+    try:
+        with socket.socket(family, socket.SOCK_DGRAM) as s:
+            s.connect((ROUTE_CHECK[family], 53))
+        return True
+    except OSError:
+        return False
+
+def resolve_family(domain: str, family: int = socket.AF_INET) -> Optional[str]:
+    """Sistem DNS'ini kullan. Sadece hata/zehirli cevapta Cloudflare DoH dene (A veya AAAA)."""
+    try:
+        # 1. Sistem DNS (NextDNS DoT)
+        ip = socket.getaddrinfo(domain, 443, family, socket.SOCK_STREAM)[0][4][0]
+        if usable_ip(ip):
+            logging.info(f"[DNS] Sistem Çözümü: {domain} -> {ip}")
+            return ip
+    except socket.gaierror as e:
+        if e.errno in NO_RECORD_ERRORS:
+            logging.debug(f"[DNS] {domain}: kayıt yok ({DOH_TYPES[family][0]})")
+            return None
+        logging.debug(f"[DNS] Sistem hatası: {e}")
+    except (OSError, IndexError) as e:
+        logging.debug(f"[DNS] Sistem hatası: {e}")
+    
+    # 2. Zehirlenme varsa DoH Fallback
+    record, rr_type = DOH_TYPES[family]
+    # Many domains simply have no AAAA: only a missing A record is worth a warning
+    log = logging.warning if family == socket.AF_INET else logging.debug
+    log(f"[DNS] Sistem başarısız/zehirli ({record}), DoH deneniyor...")
+    try:
+        resp = requests.get(
+            "https://cloudflare-dns.com/dns-query",
+            params={"name": domain, "type": record},
+            headers={"Accept": "application/dns-json"},
+            timeout=5, verify=False
+        )
+        for ans in resp.json().get("Answer", []):
+            if ans.get("type") == rr_type and usable_ip(ans.get("data", "")):
+                return ans.get("data")
+    except:
+        pass
+        
+    return None
+
+def resolve_domain(domain: str) -> str:
+    """IPv4 address of domain; the domain itself if it cannot be resolved."""
+    return resolve_family(domain, socket.AF_INET) or domain
+
+def resolve_ipv6(domain: str) -> Optional[str]:
+    """IPv6 address of domain, or None (also when this host has no IPv6 route)."""
+    if not has_route(socket.AF_INET6):
+        return None
+    return resolve_family(domain, socket.AF_INET6)
+
+def probe_targets(ipv4: Optional[str], ipv6: Optional[str]) -> List[str]:
+    """Addresses a strategy must pass on: IPv4 first, then IPv6."""
+    return [ip for ip in (ipv4, ipv6) if ip and usable_ip(ip)]
+
+def ip_family(ip: str) -> int:
+    """4 or 6."""
+    return 6 if ':' in ip else 4
+
+def _ms_since(start: float) -> int:
+    return round((time.monotonic() - start) * 1000)
+
+def probe_record(strategy_key: str, result: ProbeResult, sni: str, isp: str,
+                 prefix: Optional[str], timings: dict):
+    """(record, success) for StatsTracker.record_probe()."""
+    record = dict(timings, **result.timings_ms())
+    record.update(domain=sni, strategy=strategy_key, isp=isp, dst_prefix=prefix,
+                  outcome=result.outcome, phase=result.phase, alert=result.alert)
+    logging.debug(f"[{strategy_key}] {result.outcome}: " +
+                  ', '.join(f"{key[:-3]}={value}" for key, value in record.items()
+                            if key.endswith('_ms') and value is not None))
+    # A cancelled probe says nothing about the strategy: timings only, no attempt
+    success = None if result.outcome == OUTCOME_CANCELLED else result.ok
+    return record, success
 
 class ParallelProber:
-    def __init__(self, target_domain: str, enable_telemetry: bool = True):
+    def __init__(self, target_domain: str, enable_telemetry: bool = True, max_parallel: int = MAX_PARALLEL,
+                 adaptive: bool = True, isp: Optional[str] = None, resolved_ip: Optional[str] = None,
+                 sni_pool: Optional[List[str]] = None, dual_stack: bool = True,
+                 resolved_ipv6: Optional[str] = None):
         self.target_domain = target_domain
+        self.max_parallel = max(1, max_parallel)
+        self.adaptive = adaptive  # Order strategies by past outcomes (needs telemetry)
+        self.isp = configured_isp(isp)  # Scopes telemetry and the bandit (see solver.bandit)
+        # SNIs rotated across probes (domains sharing the target IP); default: the target itself
+        self.sni_pool = list(sni_pool) if sni_pool else [target_domain]
+        self._sni_counter = itertools.count()
         self.stop_event = threading.Event()
         self.winner_strategy = None
+        self.results = {}  # strategy -> ProbeResult of the deciding (primary) family
+        self.family_results: Dict[str, Dict[int, ProbeResult]] = {}  # strategy -> {4/6: ProbeResult}
         self.lock = threading.Lock()
+        self.cancel: Optional[CancelToken] = None  # Per solve(): aborts in-flight handshakes once a winner exists
+        self.done = threading.Event()    # Winner found or every probe finished
+        self.cleanup_thread = None
         self.enable_telemetry = enable_telemetry
         self.tracker = StatsTracker() if enable_telemetry else None
+        self.pool = get_nfqws_pool()
+        self.firewall = get_firewall()  # Rule changes of concurrent probes share transactions
         
         # TurkNet + NextDNS kullanıcısı için:
         # Önce sistem DNS'ine güven, sadece zehirlenme varsa DoH yap.
-        self._resolved_ip = self._resolve_domain()
+        self._resolved_ip = resolved_ip or self._resolve_domain()
+        # Dual-stack targets: the first one (IPv4 if any) decides, the other family is probed for the record
+        ipv6 = (resolved_ipv6 or self._resolve_ipv6()) if dual_stack else None
+        self.targets = probe_targets(self._resolved_ip, ipv6)
+        if self.targets and not usable_ip(self._resolved_ip):
+            self._resolved_ip = self.targets[0]  # IPv6-only domain
+        self._dst_prefix = dst_prefix(self._resolved_ip)
 
     def _resolve_domain(self) -> str:
-        """Sistem DNS'ini kullan. Sadece 0.0.0.0 dönerse Cloudflare DoH dene."""
-        try:
-            # 1. Sistem DNS (NextDNS DoT)
-            ip = socket.gethostbyname(self.target_domain)
-            if not ip.startswith("0.") and ip != "127.0.0.1":
-                logging.info(f"[DNS] Sistem Çözümü: {self.target_domain} -> {ip}")
-                return ip
-        except Exception as e:
-            logging.debug(f"[DNS] Sistem hatası: {e}")
-        
-        # 2. Zehirlenme varsa DoH Fallback
-        logging.warning("[DNS] Sistem başarısız/zehirli, DoH deneniyor...")
-        try:
-            resp = requests.get(
-                "https://cloudflare-dns.com/dns-query",
-                params={"name": self.target_domain, "type": "A"},
-                headers={"Accept": "application/dns-json"},
-                timeout=5, verify=False
-            )
-            for ans in resp.json().get("Answer", []):
-                if ans.get("type") == 1:
-                    return ans.get("data")
-        except:
-            pass
-            
-        return self.target_domain
+        return resolve_domain(self.target_domain)
+
+    def _resolve_ipv6(self) -> Optional[str]:
+        return resolve_ipv6(self.target_domain)
 
-    def _test_strategy(self, strategy_key: str, queue_num: int):
+    def _test_strategy(self, strategy_key: str):
         if self.stop_event.is_set(): return
         
         # IP kontrolü
-        if not self._resolved_ip or self._resolved_ip.startswith("0."):
+        if not self.targets:
             return
-            
-        nfqws_proc = None
+        
+        # Warm nfqws from the pool: no spawn, no fixed sleep
+        timings = {}
+        phase_start = time.monotonic()
+        worker = self.pool.acquire(strategy_key)
+        timings['ready_ms'] = _ms_since(phase_start)
+        if worker is None or self.stop_event.is_set():
+            return
+        
+        start_time = time.time()
+        # The primary family decides; a strategy failing there costs no IPv6 probe
+        primary, *others = self.targets
+        result = self._test_target(strategy_key, worker, primary, dict(timings))
+        if result is not None:
+            self.results[strategy_key] = result
+        if result is None or not result.ok or self.stop_event.is_set():
+            return
+        # A broken IPv6 path must not fail every strategy: its outcome only lands in family_results
+        for ip in others:
+            extra = self._test_target(strategy_key, worker, ip, dict(timings))
+            if extra is not None and not extra.ok:
+                logging.warning(f"[{strategy_key}] IPv{ip_family(ip)} başarısız, IPv{ip_family(primary)} yeterli")
+            if self.stop_event.is_set():
+                return
+        
+        duration = time.time() - start_time
+        families = '/'.join(f"IPv{family}" for family, outcome in self.family_results[strategy_key].items()
+                            if outcome.ok)
+        logging.info(f"[{strategy_key}] ✓ BAŞARILI ({duration:.2f}s, {families})")
+        with self.lock:
+            if not self.winner_strategy:
+                self.winner_strategy = strategy_key
+                self.stop_event.set()
+                if self.cancel is not None:
+                    self.cancel.cancel()
+                self.done.set()
+
+    def _test_target(self, strategy_key: str, worker, ip: str, timings: dict) -> Optional[ProbeResult]:
+        """One handshake to ip through the strategy's nfqws; None if the rule could not be added."""
+        # Every probe uses its own source port and the rule matches on it,
+        # so concurrent probes of the same IP never land in each other's queue
+        sock = _reserve_port(socket.AF_INET6 if ip_family(ip) == 6 else socket.AF_INET)
+        source_port = sock.getsockname()[1]
+        rule = [
+            'OUTPUT',
+            '-p', 'tcp', '--sport', str(source_port), '--dport', '443', '-d', ip,
+            '-j', 'NFQUEUE', '--queue-num', str(worker.queue_num), '--queue-bypass'
+        ]
         rules_added = False
+        result = sni = None
         
         try:
-            strategy_cmd = STRATEGIES[strategy_key]["cmd"]
-            start_time = time.time()
-            
-            # iptables
-            add_rule = [
-                'iptables', '-t', 'mangle', '-I', 'OUTPUT',
-                '-p', 'tcp', '--dport', '443', '-d', self._resolved_ip,
-                '-j', 'NFQUEUE', '--queue-num', str(queue_num), '--queue-bypass'
-            ]
-            
-            if subprocess.run(add_rule, capture_output=True).returncode == 0:
+            # iptables: steer the target into this strategy's queue
+            phase_start = time.monotonic()
+            if self.firewall.submit(RuleBatch().insert(rule)):
                 rules_added = True
+                timings['iptables_ms'] = _ms_since(phase_start)
             else:
-                return
-
-            # nfqws start
-            cmd = [NFQWS_PATH, f'--qnum={queue_num}'] + shlex.split(strategy_cmd)
-            nfqws_proc = subprocess.Popen(
-                cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, 
-                start_new_session=True
-            )
-            time.sleep(0.4) # Faster check
-            
-            if nfqws_proc.poll() is not None:
-                return
+                return None
             
-            # Request
-            if self._make_request_with_ip(self._resolved_ip):
-                duration = time.time() - start_time
-                logging.info(f"[{strategy_key}] ✓ BAŞARILI ({duration:.2f}s)")
-                with self.lock:
-                    if not self.winner_strategy:
-                        self.winner_strategy = strategy_key
-                        self.stop_event.set()
-            else:
-                logging.debug(f"[{strategy_key}] ✗ Request failed")
+            # Handshake
+            sni = self.sni_pool[next(self._sni_counter) % len(self.sni_pool)]
+            result = self._probe(ip, sock, sni)
+            self.family_results.setdefault(strategy_key, {})[ip_family(ip)] = result
+            if not result.ok:
+                logging.debug(f"[{strategy_key}] ✗ IPv{ip_family(ip)} {result}")
                 
         except Exception as e:
             logging.debug(f"[{strategy_key}] Exception: {e}")
         finally:
-            if nfqws_proc:
-                nfqws_proc.terminate()
-                try: nfqws_proc.wait(timeout=1)
-                except: nfqws_proc.kill()
+            sock.close()  # Already closed by the probe, unless it never ran
             if rules_added:
-                del_rule = [
-                    'iptables', '-t', 'mangle', '-D', 'OUTPUT',
-                    '-p', 'tcp', '--dport', '443', '-d', self._resolved_ip,
-                    '-j', 'NFQUEUE', '--queue-num', str(queue_num), '--queue-bypass'
-                ]
-                subprocess.run(del_rule, capture_output=True)
-
-    def _make_request_with_ip(self, ip: str) -> bool:
+                phase_start = time.monotonic()
+                self.firewall.submit(RuleBatch().delete(rule))
+                timings['teardown_ms'] = _ms_since(phase_start)
+            if result is not None:
+                self._record(strategy_key, result, sni, timings, ip)
+        return result
+
+    def _record(self, strategy_key: str, result: ProbeResult, sni: str, timings: dict, ip: Optional[str] = None):
+        """Queue the probe and its phase timings for probe_log / bypass_log (written in batches)."""
+        if self.tracker is None:
+            return
+        # Scoped by the probed address: IPv4 and IPv6 outcomes land in different prefixes
+        prefix = dst_prefix(ip) if ip else self._dst_prefix
         try:
-            # TurkNet bazen User-Agent filtering yapabilir mi? Sanmam ama standart tutalım.
-            resp = requests.get(
-                f"https://{ip}",
-                headers={"Host": self.target_domain, "User-Agent": "curl/7.68.0"},
-                timeout=PROBE_TIMEOUT, verify=False, allow_redirects=True
-            )
-            # 403 Forbidden bile olsa, bağlantı kuruldu demektir (Cloudflare block page)
-            # Bu yüzden status code kontrolünü esnetiyoruz.
-            # TCP bağlantısı kurulduysa ve SSL handshake bittiyse bypass çalışmıştır.
-            return True
-        except requests.exceptions.SSLError:
-            # SSL hatası = DPI Araya girdi (Fail)
-            return False
-        except requests.exceptions.ConnectionError:
-            # Bağlantı koptu = Fail
-            return False
-        except:
-            return False
+            self.tracker.record_probe(*probe_record(strategy_key, result, sni, self.isp, prefix, timings))
+        except Exception as e:
+            logging.debug(f"[{strategy_key}] Telemetry error: {e}")
+
+    def strategy_order(self) -> list:
+        """PRIORITY_LIST, re-ranked by the bandit when adaptive ordering is on."""
+        if not self.adaptive or self.tracker is None:
+            return list(PRIORITY_LIST)
+        return StrategyBandit(self.tracker).rank(isp=self.isp, ip=self._resolved_ip)
+
+    def _probe(self, ip: str, sock: Optional[socket.socket] = None, sni: Optional[str] = None) -> ProbeResult:
+        # A completed TLS handshake with the real SNI is enough: no redirects, no body
+        return probe_tls(ip, sni or self.target_domain, timeout=PROBE_TIMEOUT, sock=sock, cancel=self.cancel)
+
+    def verify(self, strategy_key: str) -> bool:
+        """Single probe of one strategy, e.g. to confirm a winner inherited from a related domain."""
+        # Nothing to race against: the probe runs without a CancelToken
+        self._test_strategy(strategy_key)
+        if self.tracker is not None:
+            self.tracker.flush_probes()
+        return self.winner_strategy == strategy_key
 
     def solve(self) -> Optional[str]:
         logging.info(f"[PROBER] TurkNet/NextDNS Modu: {self.target_domain}")
-        logging.info(f"[DNS] Hedef IP: {self._resolved_ip}")
+        logging.info(f"[DNS] Hedef IP: {', '.join(self.targets) or self._resolved_ip}")
         
-        threads = []
-        for idx, strategy in enumerate(PRIORITY_LIST):
-            queue_num = TEST_QUEUE_BASE + idx
-            t = threading.Thread(target=self._test_strategy, args=(strategy, queue_num))
-            t.start()
-            threads.append(t)
-            
-        for t in threads:
-            t.join(timeout=PROBE_TIMEOUT + 1)
+        # At most max_parallel probes in flight, best-ranked first: the top
+        # max_parallel strategies form the first wave, the rest of the list
+        # only runs if none of them wins
+        order = self.strategy_order()
+        # Solving again: the last run's probes must be gone before its state is reset
+        self.wait_cleanup()
+        self.stop_event.clear()
+        self.done.clear()
+        self.winner_strategy = None
+        self.results = {}
+        self.family_results = {}
+        # Created here, closed by _cleanup(): a prober that never solves holds no pipe
+        self.cancel = CancelToken()
+        logging.info(f"[PROBER] İlk dalga: {', '.join(order[:self.max_parallel])}")
+        executor = ThreadPoolExecutor(max_workers=self.max_parallel, thread_name_prefix="probe")
+        futures = [executor.submit(self._test_strategy, strategy) for strategy in order]
+        remaining = [len(futures)]
+        
+        def finished(_):
+            with self.lock:
+                remaining[0] -= 1
+                if remaining[0] <= 0:
+                    self.done.set()
+        
+        for future in futures:
+            future.add_done_callback(finished)
+        if not futures:
+            self.done.set()
+        self.done.wait()
+        
+        # Return as soon as there is a winner: losing handshakes are aborted,
+        # queued strategies dropped, and their rules removed in the background
+        self.stop_event.set()
+        self.cancel.cancel()
+        for future in futures:
+            future.cancel()
+        self.cleanup_thread = threading.Thread(target=self._cleanup, args=(executor, self.cancel), name="probe-cleanup")
+        self.cleanup_thread.start()
             
         logging.info(f"[PROBER] Kazanan: {self.winner_strategy}")
         return self.winner_strategy
+
+    def _cleanup(self, executor: ThreadPoolExecutor, cancel: CancelToken):
+        # Probe threads remove their own iptables rules on the way out
+        executor.shutdown(wait=True)
+        cancel.close()
+        if self.tracker is not None:
+            self.tracker.flush_probes()
+
+    def wait_cleanup(self, timeout: Optional[float] = None):
+        """Block until the probes of the last solve() have torn down their rules."""
+        if self.cleanup_thread is not None:
+            self.cleanup_thread.join(timeout)
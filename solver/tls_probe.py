@@ -0,0 +1,377 @@
+"""
+TLS Handshake Probe - lightweight replacement for a full HTTPS request
+Opens a TCP connection and sends a real OpenSSL ClientHello carrying the
+target SNI (driven through MemoryBIOs so every phase can be timed), then
+classifies the server's first answer:
+
+  ServerHello           -> success (or, with http=True, keep going until
+                           the first byte of an HTTP response arrives)
+  TLS alert             -> alert   (DPI or server refused the handshake)
+  RST                   -> rst     (typical injected reset)
+  nothing in time       -> timeout (typical silent drop)
+  FIN                   -> closed
+  anything else         -> unexpected (e.g. an injected plaintext block page)
+
+Every blocking wait also watches an optional CancelToken, so a probe that
+lost the race is aborted at once instead of running into its timeout.
+probe_tls_async() is the same probe on asyncio streams; it is cancelled
+like any other task.
+"""
+import asyncio
+import errno
+import os
+import select
+import socket
+import ssl
+import threading
+import time
+from typing import Optional
+
+PROBE_TIMEOUT = 5.0
+RECV_SIZE = 16384
+
+OUTCOME_SUCCESS = 'success'
+OUTCOME_RST = 'rst'
+OUTCOME_TIMEOUT = 'timeout'
+OUTCOME_ALERT = 'alert'
+OUTCOME_CLOSED = 'closed'
+OUTCOME_UNEXPECTED = 'unexpected'
+OUTCOME_ERROR = 'error'
+OUTCOME_CANCELLED = 'cancelled'
+
+# Phase the probe was in when the outcome was decided
+PHASE_CONNECT = 'connect'
+PHASE_HELLO = 'hello'          # ClientHello sent, waiting for the first server bytes
+PHASE_HANDSHAKE = 'handshake'  # ServerHello seen, finishing the handshake (http=True)
+PHASE_HTTP = 'http'            # Request sent, waiting for the first response byte
+
+TLS_CONTENT_ALERT = 0x15
+TLS_CONTENT_HANDSHAKE = 0x16
+TLS_HANDSHAKE_SERVER_HELLO = 0x02
+
+
+class ProbeResult:
+    """Outcome of one probe. Times are seconds from the start of the probe."""
+    __slots__ = ('outcome', 'phase', 'connect_time', 'first_byte_time', 'handshake_time', 'response_time',
+                 'total_time', 'alert', 'detail')
+
+    def __init__(self):
+        self.outcome = OUTCOME_ERROR
+        self.phase = PHASE_CONNECT
+        self.connect_time = None     # TCP handshake done
+        self.first_byte_time = None  # First server bytes after the ClientHello
+        self.handshake_time = None   # ServerHello seen (http=False) or handshake finished (http=True)
+        self.response_time = None    # First HTTP response byte (http=True only)
+        self.total_time = 0.0
+        self.alert = None            # TLS alert description code, if any
+        self.detail = ''
+
+    @property
+    def ok(self) -> bool:
+        return self.outcome == OUTCOME_SUCCESS
+
+    def timings_ms(self) -> dict:
+        """Per-phase durations in ms; None for phases that were never reached."""
+        def span(a, b):
+            return round((b - a) * 1000) if a is not None and b is not None else None
+        return {
+            'connect_ms': span(0.0, self.connect_time),
+            'first_byte_ms': span(self.connect_time, self.first_byte_time),
+            'handshake_ms': span(self.connect_time, self.handshake_time),
+            'response_ms': span(self.handshake_time, self.response_time),
+            'total_ms': round(self.total_time * 1000),
+        }
+
+    def __repr__(self):
+        alert = f" alert={self.alert}" if self.alert is not None else ''
+        detail = f" ({self.detail})" if self.detail else ''
+        return f"<{self.outcome} in {self.phase} after {self.total_time:.3f}s{alert}{detail}>"
+
+
+class _Closed(Exception):
+    pass
+
+
+class _Cancelled(Exception):
+    pass
+
+
+class CancelToken:
+    """
+    Shared by a group of probes. cancel() makes a pipe readable, which wakes
+    every probe blocked in connect or recv; close() once they have all returned.
+    Both are idempotent, and cancel() after close() only sets the event.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self._r, self._w = os.pipe()
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def fileno(self) -> int:
+        return self._r
+
+    def is_set(self) -> bool:
+        return self.event.is_set()
+
+    def cancel(self):
+        with self._lock:
+            if not self.event.is_set():
+                self.event.set()
+                if not self._closed:
+                    os.write(self._w, b"x")
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            for fd in (self._r, self._w):
+                os.close(fd)
+
+
+_contexts = {}
+
+
+def _context(http: bool) -> ssl.SSLContext:
+    # Only the handshake is judged, the certificate is not
+    ctx = _contexts.get(http)
+    if ctx is None:
+        ctx = ssl.create_default_context()
+        ctx.check_hostname = False
+        ctx.verify_mode = ssl.CERT_NONE
+        ctx.set_alpn_protocols(['http/1.1'] if http else ['h2', 'http/1.1'])
+        _contexts[http] = ctx
+    return ctx
+
+
+def _wait(sock: socket.socket, deadline: float, cancel: Optional[CancelToken], writable: bool = False):
+    """Block until sock is readable (or writable), the deadline passes or the probe is cancelled."""
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise socket.timeout()
+    poller = select.poll()
+    poller.register(sock, select.POLLOUT if writable else select.POLLIN)
+    if cancel is not None:
+        poller.register(cancel.fileno(), select.POLLIN)
+    events = poller.poll(remaining * 1000)
+    if cancel is not None and cancel.is_set():
+        raise _Cancelled()
+    if not events:
+        raise socket.timeout()
+    sock.settimeout(max(deadline - time.monotonic(), 0.001))
+
+
+def _connect(sock: socket.socket, addr: tuple, deadline: float, cancel: Optional[CancelToken]):
+    sock.setblocking(False)
+    err = sock.connect_ex(addr)
+    if err in (errno.EINPROGRESS, errno.EAGAIN):
+        _wait(sock, deadline, cancel, writable=True)
+        err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+    if err:
+        raise OSError(err, os.strerror(err))
+    sock.settimeout(max(deadline - time.monotonic(), 0.001))
+
+
+def _recv(sock: socket.socket, deadline: float, cancel: Optional[CancelToken] = None) -> bytes:
+    _wait(sock, deadline, cancel)
+    data = sock.recv(RECV_SIZE)
+    if not data:
+        raise _Closed()
+    return data
+
+
+def _flush(sock: socket.socket, outgoing: ssl.MemoryBIO):
+    pending = outgoing.read()
+    if pending:
+        sock.sendall(pending)
+
+
+def _drive(sock, tls, incoming, outgoing, step, deadline, cancel):
+    """Run an SSLObject call, shuttling records over the socket until it completes."""
+    while True:
+        try:
+            return step()
+        except ssl.SSLWantReadError:
+            _flush(sock, outgoing)
+            incoming.write(_recv(sock, deadline, cancel))
+
+
+def _start_handshake(sni: str, http: bool):
+    """SSLObject over MemoryBIOs with the ClientHello already queued in the outgoing BIO."""
+    incoming, outgoing = ssl.MemoryBIO(), ssl.MemoryBIO()
+    tls = _context(http).wrap_bio(incoming, outgoing, server_hostname=sni)
+    try:
+        tls.do_handshake()
+    except ssl.SSLWantReadError:
+        pass
+    return tls, incoming, outgoing
+
+
+def _needs_more(head: bytes) -> bool:
+    # Record type, version, length, then the handshake type (ServerHello)
+    # or the alert level and description
+    return len(head) < 7 and head[0] in (TLS_CONTENT_ALERT, TLS_CONTENT_HANDSHAKE)
+
+
+def _classify(result: ProbeResult, head: bytes) -> bool:
+    """Judge the first server record; True (and success) on ServerHello."""
+    if head[0] == TLS_CONTENT_ALERT:
+        result.outcome = OUTCOME_ALERT
+        result.alert = head[6]
+        return False
+    if head[0] == TLS_CONTENT_HANDSHAKE and head[5] == TLS_HANDSHAKE_SERVER_HELLO:
+        result.outcome = OUTCOME_SUCCESS
+        result.handshake_time = result.first_byte_time
+        return True
+    result.outcome = OUTCOME_UNEXPECTED
+    result.detail = bytes(head[:16]).hex()
+    return False
+
+
+def _http_request(sni: str) -> bytes:
+    return (f"GET / HTTP/1.1\r\nHost: {sni}\r\nUser-Agent: curl/7.68.0\r\n"
+            f"Connection: close\r\n\r\n").encode()
+
+
+def _set_failure(result: ProbeResult, e: Exception):
+    """Map a network / TLS exception onto the result; anything else is re-raised."""
+    if isinstance(e, (ConnectionResetError, ConnectionRefusedError)):
+        result.outcome = OUTCOME_RST
+    elif isinstance(e, (_Closed, ssl.SSLZeroReturnError, ssl.SSLEOFError)):
+        result.outcome = OUTCOME_CLOSED
+    elif isinstance(e, ssl.SSLError):
+        result.outcome = OUTCOME_ALERT if e.reason and 'ALERT' in e.reason else OUTCOME_ERROR
+        result.detail = e.reason or str(e)
+    elif isinstance(e, OSError):
+        result.outcome = OUTCOME_ERROR
+        result.detail = e.strerror or str(e)
+    else:
+        raise e
+
+
+def probe_tls(ip: str, sni: str, port: int = 443, timeout: float = PROBE_TIMEOUT,
+              source_port: Optional[int] = None, http: bool = False,
+              cancel: Optional[CancelToken] = None, sock: Optional[socket.socket] = None) -> ProbeResult:
+    """
+    Probe ip:port with a ClientHello for sni; never raises for network failures.
+    sock: already bound socket to probe from (source_port is then ignored), closed afterwards.
+    """
+    result = ProbeResult()
+    start = time.monotonic()
+    deadline = start + timeout
+    family = socket.AF_INET6 if ':' in ip else socket.AF_INET
+    bind = sock is None and source_port
+    if sock is None:
+        sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        if bind:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(('::' if family == socket.AF_INET6 else '0.0.0.0', source_port))
+        _connect(sock, (ip, port), deadline, cancel)
+        result.connect_time = time.monotonic() - start
+
+        result.phase = PHASE_HELLO
+        tls, incoming, outgoing = _start_handshake(sni, http)
+        _flush(sock, outgoing)
+
+        head = _recv(sock, deadline, cancel)
+        result.first_byte_time = time.monotonic() - start
+        while _needs_more(head):
+            head += _recv(sock, deadline, cancel)
+        if _classify(result, head) and http:
+            result.phase = PHASE_HANDSHAKE
+            incoming.write(head)
+            _drive(sock, tls, incoming, outgoing, tls.do_handshake, deadline, cancel)
+            result.handshake_time = time.monotonic() - start
+            result.phase = PHASE_HTTP
+            tls.write(_http_request(sni))
+            _flush(sock, outgoing)
+            if not _drive(sock, tls, incoming, outgoing, lambda: tls.read(1), deadline, cancel):
+                raise _Closed()
+            result.response_time = time.monotonic() - start
+    except _Cancelled:
+        result.outcome = OUTCOME_CANCELLED
+    except socket.timeout:
+        result.outcome = OUTCOME_TIMEOUT
+    except Exception as e:
+        _set_failure(result, e)
+    finally:
+        sock.close()
+        result.total_time = time.monotonic() - start
+    return result
+
+
+async def _read_async(reader: asyncio.StreamReader) -> bytes:
+    data = await reader.read(RECV_SIZE)
+    if not data:
+        raise _Closed()
+    return data
+
+
+async def _drive_async(reader, writer, tls, incoming, outgoing, step):
+    while True:
+        try:
+            return step()
+        except ssl.SSLWantReadError:
+            writer.write(outgoing.read())
+            incoming.write(await _read_async(reader))
+
+
+async def _probe_async(result: ProbeResult, start: float, ip: str, sni: str, port: int,
+                       source_port: Optional[int], http: bool, sock: Optional[socket.socket]):
+    if sock is not None:
+        # Connected here: open_connection() only takes an already connected socket
+        try:
+            sock.setblocking(False)
+            await asyncio.get_running_loop().sock_connect(sock, (ip, port))
+        except BaseException:
+            sock.close()
+            raise
+        reader, writer = await asyncio.open_connection(sock=sock)
+    else:
+        local_addr = None
+        if source_port:
+            local_addr = ('::' if ':' in ip else '0.0.0.0', source_port)
+        reader, writer = await asyncio.open_connection(ip, port, local_addr=local_addr)
+    try:
+        result.connect_time = time.monotonic() - start
+        result.phase = PHASE_HELLO
+        tls, incoming, outgoing = _start_handshake(sni, http)
+        writer.write(outgoing.read())
+
+        head = await _read_async(reader)
+        result.first_byte_time = time.monotonic() - start
+        while _needs_more(head):
+            head += await _read_async(reader)
+        if _classify(result, head) and http:
+            result.phase = PHASE_HANDSHAKE
+            incoming.write(head)
+            await _drive_async(reader, writer, tls, incoming, outgoing, tls.do_handshake)
+            result.handshake_time = time.monotonic() - start
+            result.phase = PHASE_HTTP
+            tls.write(_http_request(sni))
+            writer.write(outgoing.read())
+            if not await _drive_async(reader, writer, tls, incoming, outgoing, lambda: tls.read(1)):
+                raise _Closed()
+            result.response_time = time.monotonic() - start
+    finally:
+        writer.close()
+
+
+async def probe_tls_async(ip: str, sni: str, port: int = 443, timeout: float = PROBE_TIMEOUT,
+                          source_port: Optional[int] = None, http: bool = False,
+                          sock: Optional[socket.socket] = None) -> ProbeResult:
+    """probe_tls() for asyncio; the whole probe runs under one deadline."""
+    result = ProbeResult()
+    start = time.monotonic()
+    try:
+        await asyncio.wait_for(_probe_async(result, start, ip, sni, port, source_port, http, sock), timeout)
+    except asyncio.TimeoutError:
+        result.outcome = OUTCOME_TIMEOUT
+    except Exception as e:
+        _set_failure(result, e)
+    finally:
+        result.total_time = time.monotonic() - start
+    return result
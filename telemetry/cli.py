@@ -52,10 +52,25 @@ def format_stats(stats: dict, days: int) -> str:
     
     return output
 
+def format_timings(timings: list) -> str:
+    """Format per-outcome probe phase timings."""
+    output = f"\n{'─' * 45}\n"
+    output += "⏱  Probe Phases (avg ms):\n"
+    columns = (('iptables_ms', 'ipt'), ('ready_ms', 'ready'), ('connect_ms', 'conn'),
+               ('first_byte_ms', '1st'), ('handshake_ms', 'hs'), ('teardown_ms', 'down'),
+               ('total_ms', 'total'))
+    output += f"  {'outcome':10s} {'n':>5s}" + ''.join(f" {label:>6s}" for _, label in columns) + "\n"
+    for outcome, count, phases in timings:
+        cells = ''.join(f" {phases[key]:6.0f}" if phases[key] is not None else f" {'-':>6s}"
+                        for key, _ in columns)
+        output += f"  {outcome or '?':10s} {count:5d}{cells}\n"
+    return output
+
 def main():
     parser = argparse.ArgumentParser(description='Zapret Autonomous Statistics')
     parser.add_argument('--range', default='7d', help='Time range (e.g., 7d, 30d)')
     parser.add_argument('--by-strategy', action='store_true', help='Show strategy breakdown')
+    parser.add_argument('--timings', action='store_true', help='Show probe phase timings')
     parser.add_argument('command', nargs='?', default='today', help='Command: today, week, month')
     
     args = parser.parse_args()
@@ -76,6 +91,8 @@ def main():
     
     # Display
     print(format_stats(stats, days))
+    if args.timings:
+        print(format_timings(tracker.get_probe_timings(days=days)))
 
 if __name__ == '__main__':
     main()
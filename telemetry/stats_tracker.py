@@ -4,12 +4,22 @@ Logs bypass attempts and generates statistics
 """
 import sqlite3
 import logging
+import threading
 from datetime import datetime
-from typing import Optional
+from typing import Optional, Dict, Tuple
+
+# Probe records are buffered and written this many at a time
+PROBE_BATCH = 64
+
+PROBE_COLUMNS = ('domain', 'strategy', 'isp', 'dst_prefix', 'outcome', 'phase', 'alert',
+                 'iptables_ms', 'ready_ms', 'connect_ms', 'first_byte_ms', 'handshake_ms',
+                 'response_ms', 'teardown_ms', 'total_ms')
 
 class StatsTracker:
     def __init__(self, db_path: str = "strategies.db"):
         self.db_path = db_path
+        self._probes = []
+        self._probes_lock = threading.Lock()
         self._init_db()
     
     def _init_db(self):
@@ -28,6 +38,39 @@ class StatsTracker:
             )
         ''')
         
+        # Scope columns for adaptive strategy ordering (added to older databases)
+        columns = {row[1] for row in cursor.execute("PRAGMA table_info(bypass_log)")}
+        for column in ('isp', 'dst_prefix'):
+            if column not in columns:
+                cursor.execute(f"ALTER TABLE bypass_log ADD COLUMN {column} TEXT")
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_bypass_log_scope
+            ON bypass_log (isp, dst_prefix, strategy)
+        ''')
+        
+        # One row per probe with its phase timings (ms); NULL = phase not reached
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS probe_log (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                domain TEXT NOT NULL,
+                strategy TEXT,
+                isp TEXT,
+                dst_prefix TEXT,
+                outcome TEXT,
+                phase TEXT,
+                alert INTEGER,
+                iptables_ms INTEGER,
+                ready_ms INTEGER,
+                connect_ms INTEGER,
+                first_byte_ms INTEGER,
+                handshake_ms INTEGER,
+                response_ms INTEGER,
+                teardown_ms INTEGER,
+                total_ms INTEGER
+            )
+        ''')
+        
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS daily_summary (
                 date DATE PRIMARY KEY,
@@ -40,21 +83,111 @@ class StatsTracker:
         conn.commit()
         conn.close()
     
-    def log_bypass(self, domain: str, strategy: str, success: bool, latency_ms: int):
+    def log_bypass(self, domain: str, strategy: str, success: bool, latency_ms: int,
+                   isp: Optional[str] = None, dst_prefix: Optional[str] = None):
         """Log a bypass attempt."""
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
         
         cursor.execute('''
-            INSERT INTO bypass_log (domain, strategy, success, latency_ms)
-            VALUES (?, ?, ?, ?)
-        ''', (domain, strategy, success, latency_ms))
+            INSERT INTO bypass_log (domain, strategy, success, latency_ms, isp, dst_prefix)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (domain, strategy, success, latency_ms, isp, dst_prefix))
         
         conn.commit()
         conn.close()
         
         logging.debug(f"Logged: {domain} -> {strategy} ({'✓' if success else '✗'})")
     
+    def record_probe(self, record: dict, success: Optional[bool] = None):
+        """
+        Buffer one probe (PROBE_COLUMNS keys) for probe_log. With success set,
+        it also counts as an attempt in bypass_log. Written every PROBE_BATCH records
+        and on flush_probes().
+        """
+        with self._probes_lock:
+            self._probes.append((record, success))
+            full = len(self._probes) >= PROBE_BATCH
+        if full:
+            self.flush_probes()
+    
+    def flush_probes(self):
+        """Write all buffered probe records in one transaction."""
+        with self._probes_lock:
+            batch, self._probes = self._probes, []
+        if not batch:
+            return
+        
+        conn = sqlite3.connect(self.db_path)
+        try:
+            with conn:
+                conn.executemany(
+                    f"INSERT INTO probe_log ({', '.join(PROBE_COLUMNS)}) "
+                    f"VALUES ({', '.join('?' * len(PROBE_COLUMNS))})",
+                    [tuple(record.get(column) for column in PROBE_COLUMNS) for record, _ in batch]
+                )
+                conn.executemany('''
+                    INSERT INTO bypass_log (domain, strategy, success, latency_ms, isp, dst_prefix)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', [(r['domain'], r['strategy'], success, r.get('total_ms'), r.get('isp'), r.get('dst_prefix'))
+                      for r, success in batch if success is not None])
+        finally:
+            conn.close()
+        
+        logging.debug(f"Logged {len(batch)} probes")
+    
+    def strategy_outcomes(self, isp: Optional[str] = None, dst_prefix: Optional[str] = None,
+                          days: int = 90) -> Dict[str, Tuple[int, int, Optional[float]]]:
+        """
+        Per-strategy (successes, failures, avg success latency ms) over the last N days,
+        optionally restricted to one ISP and/or destination prefix.
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        query = '''
+            SELECT strategy,
+                SUM(CASE WHEN success THEN 1 ELSE 0 END),
+                SUM(CASE WHEN success THEN 0 ELSE 1 END),
+                AVG(CASE WHEN success THEN latency_ms END)
+            FROM bypass_log
+            WHERE timestamp >= datetime('now', ? || ' days') AND strategy IS NOT NULL
+        '''
+        params = [f'-{days}']
+        if isp is not None:
+            query += " AND isp = ?"
+            params.append(isp)
+        if dst_prefix is not None:
+            query += " AND dst_prefix = ?"
+            params.append(dst_prefix)
+        cursor.execute(query + " GROUP BY strategy", params)
+        rows = cursor.fetchall()
+        conn.close()
+        
+        return {strategy: (ok, failed, latency) for strategy, ok, failed, latency in rows}
+    
+    def get_probe_timings(self, days: int = 7, isp: Optional[str] = None) -> list:
+        """Average phase timings (ms) per probe outcome: [(outcome, count, {phase: avg_ms}), ...]."""
+        phases = ('iptables_ms', 'ready_ms', 'connect_ms', 'first_byte_ms', 'handshake_ms',
+                  'response_ms', 'teardown_ms', 'total_ms')
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        query = f'''
+            SELECT outcome, COUNT(*), {', '.join(f'AVG({phase})' for phase in phases)}
+            FROM probe_log
+            WHERE timestamp >= datetime('now', ? || ' days')
+        '''
+        params = [f'-{days}']
+        if isp is not None:
+            query += " AND isp = ?"
+            params.append(isp)
+        cursor.execute(query + " GROUP BY outcome ORDER BY COUNT(*) DESC", params)
+        rows = cursor.fetchall()
+        conn.close()
+        
+        return [(row[0], row[1], dict(zip(phases, row[2:]))) for row in rows]
+    
     def update_daily_summary(self):
         """Aggregate today's stats into summary table."""
         conn = sqlite3.connect(self.db_path)
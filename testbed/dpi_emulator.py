@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+DPI Emulator - In-path SNI filter for the local test bed
+Runs on an NFQUEUE in the middle namespace of testbed/lab.py and acts like
+a stateful ISP DPI box: it reads the ClientHello of every TLS flow and,
+when the SNI is on its blocklist, injects a RST towards the client or
+blackholes the flow.
+
+Real DPI takes shortcuts, and every desync strategy exploits one of them.
+The shortcuts are switchable (DpiConfig), so solver runs can be scored
+against a filter whose holes are known:
+  reassemble        off: a ClientHello is only read from a single segment (split, disorder)
+  lock_first_hello  on:  the first ClientHello seen decides the flow (fakes)
+  check_checksum    off: segments with a bad TCP checksum are inspected (badsum)
+  check_md5sig      off: segments carrying a TCP MD5 option are inspected (md5sig)
+  check_seq         off: segments outside the client's sequence window are inspected (badseq)
+  server_hops       segments arriving with a lower TTL are inspected, then expire
+                    before reaching the server (ttl fakes)
+
+IPv4 only. The verdict logic (DpiEmulator.handle) is pure and needs no
+NFQUEUE; run() wires it to one.
+Usage: python3 -m testbed.dpi_emulator --profile split --block blocked.test [--queue 250]
+"""
+import sys
+import socket
+import struct
+import logging
+import argparse
+from typing import Dict, Iterable, Optional, Tuple
+
+from core.domain_index import SuffixIndex
+from core.packet_parser import (parse_packet, parse_client_hello, PROTO_TCP,
+                                TCP_SYN, TCP_ACK, TCP_RST, TLS_CONTENT_HANDSHAKE)
+
+DPI_QUEUE = 250
+INSPECT_LIMIT = 16384   # Client bytes per flow before the DPI gives up on finding a ClientHello
+SEQ_WINDOW = 65535      # Accepted distance from the next expected client sequence number
+INJECT_TTL = 64
+TCP_OPT_MD5SIG = 19
+
+ACTION_RST = "rst"
+ACTION_DROP = "drop"
+
+# Flow states
+FLOW_INSPECT = 0
+FLOW_ALLOWED = 1
+FLOW_BLOCKED = 2
+
+
+class DpiConfig:
+    """Which shortcuts the emulated DPI takes; see the module docstring."""
+    __slots__ = ('action', 'reassemble', 'lock_first_hello', 'check_checksum',
+                 'check_md5sig', 'check_seq', 'server_hops')
+
+    def __init__(self, action: str = ACTION_RST, reassemble: bool = True, lock_first_hello: bool = False,
+                 check_checksum: bool = True, check_md5sig: bool = True, check_seq: bool = True,
+                 server_hops: int = 0):
+        self.action = action
+        self.reassemble = reassemble
+        self.lock_first_hello = lock_first_hello
+        self.check_checksum = check_checksum
+        self.check_md5sig = check_md5sig
+        self.check_seq = check_seq
+        self.server_hops = server_hops
+
+    def __repr__(self):
+        return f"DpiConfig({', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)})"
+
+
+# Named filters for the benchmark. 'strict' has no hole: no strategy should pass it.
+PROFILES = {
+    'strict': DpiConfig(),
+    'split': DpiConfig(reassemble=False),
+    'fake-ttl': DpiConfig(lock_first_hello=True, server_hops=6),
+    'fake-badsum': DpiConfig(lock_first_hello=True, check_checksum=False),
+    'fake-md5sig': DpiConfig(lock_first_hello=True, check_md5sig=False),
+    'fake-badseq': DpiConfig(lock_first_hello=True, check_seq=False),
+    'blackhole': DpiConfig(action=ACTION_DROP, reassemble=False),
+}
+
+
+class _Flow:
+    __slots__ = ('state', 'next_seq', 'segments')
+
+    def __init__(self, next_seq: Optional[int] = None):
+        self.state = FLOW_INSPECT
+        self.next_seq = next_seq  # None until the SYN (or first data segment) is seen
+        self.segments: Dict[int, bytes] = {}
+
+
+def _checksum(data: bytes) -> int:
+    if len(data) % 2:
+        data += b'\0'
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    while total >> 16:
+        total = (total & 0xFFFF) + (total >> 16)
+    return ~total & 0xFFFF
+
+
+def _tcp_checksum(src: bytes, dst: bytes, segment: bytes) -> int:
+    return _checksum(src + dst + struct.pack("!BBH", 0, PROTO_TCP, len(segment)) + segment)
+
+
+def _has_option(options: bytes, kind: int) -> bool:
+    off = 0
+    while off < len(options):
+        if options[off] == 0:
+            return False
+        if options[off] == 1:
+            off += 1
+            continue
+        if options[off] == kind:
+            return True
+        if off + 1 >= len(options) or options[off + 1] < 2:
+            return False
+        off += options[off + 1]
+    return False
+
+
+def build_rst(src: bytes, dst: bytes, sport: int, dport: int, seq: int, ack: int) -> bytes:
+    """IPv4 RST|ACK from src:sport to dst:dport, checksums filled in."""
+    tcp = struct.pack("!HHIIBBHHH", sport, dport, seq, ack, 5 << 4, TCP_RST | TCP_ACK, 0, 0, 0)
+    tcp = tcp[:16] + struct.pack("!H", _tcp_checksum(src, dst, tcp)) + tcp[18:]
+    ip = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + len(tcp), 0, 0x4000, INJECT_TTL, PROTO_TCP, 0, src, dst)
+    ip = ip[:10] + struct.pack("!H", _checksum(ip)) + ip[12:]
+    return ip + tcp
+
+
+class DpiEmulator:
+    def __init__(self, blocked: Iterable[str], config: Optional[DpiConfig] = None, port: int = 443):
+        self.blocked = SuffixIndex({domain: ACTION_RST for domain in blocked})
+        self.config = config or DpiConfig()
+        self.port = port
+        self.flows: Dict[tuple, _Flow] = {}
+        self.stats = {'inspected': 0, 'ignored': 0, 'expired': 0, 'blocked': 0, 'allowed': 0}
+
+    def handle(self, raw: bytes) -> Tuple[bool, Optional[bytes]]:
+        """
+        Verdict for one client -> server packet: (accept, packet to inject or None).
+        Everything that is not IPv4 TCP to the filtered port is accepted untouched.
+        """
+        info = parse_packet(raw, tls=False)
+        if info is None or info.proto != PROTO_TCP or info.dport != self.port or len(info.src) != 4:
+            return True, None
+
+        ihl = (raw[0] & 0x0F) * 4
+        doff = (raw[ihl + 12] >> 4) * 4
+        seq, ack = struct.unpack_from("!II", raw, ihl + 4)
+        key = (info.src, info.sport, info.dst, info.dport)
+        flow = self.flows.get(key)
+        if info.tcp_flags & TCP_SYN:
+            self.flows[key] = _Flow((seq + 1) & 0xFFFFFFFF)
+            return True, None
+        if flow is None:
+            flow = self.flows[key] = _Flow()
+
+        if flow.state == FLOW_BLOCKED:
+            return False, None
+        if flow.state == FLOW_ALLOWED or not info.payload:
+            return True, None
+
+        # Segments a careful DPI would discard are not inspected; the server drops them too
+        config = self.config
+        segment = bytes(raw[ihl:ihl + doff + len(info.payload)])
+        if ((config.check_checksum and _tcp_checksum(info.src, info.dst, segment) != 0)
+                or (config.check_md5sig and _has_option(segment[20:doff], TCP_OPT_MD5SIG))
+                or (config.check_seq and flow.next_seq is not None
+                    and (seq - flow.next_seq) & 0xFFFFFFFF > SEQ_WINDOW)):
+            self.stats['ignored'] += 1
+            return True, None
+
+        self.stats['inspected'] += 1
+        verdict = self._inspect(flow, seq, bytes(info.payload))
+        if verdict == FLOW_BLOCKED:
+            self.stats['blocked'] += 1
+            logging.debug(f"[DPI] Blocked {info.src_ip}:{info.sport} -> {info.dst_ip}")
+            if config.action == ACTION_RST:
+                # Spoofed from the server: its next sequence number is what the client acks
+                return False, build_rst(info.dst, info.src, info.dport, info.sport, ack,
+                                        (seq + len(info.payload)) & 0xFFFFFFFF)
+            return False, None
+        if verdict == FLOW_ALLOWED:
+            self.stats['allowed'] += 1
+
+        if info.ttl < config.server_hops:
+            self.stats['expired'] += 1
+            return False, None
+        return True, None
+
+    def _inspect(self, flow: _Flow, seq: int, payload: bytes) -> int:
+        if flow.next_seq is None:
+            flow.next_seq = seq
+        hello = parse_client_hello(payload)
+        if (hello is None or hello[0] is None) and self.config.reassemble:
+            # Last write wins: a later segment with the same sequence number replaces an earlier one
+            flow.segments[(seq - flow.next_seq) & 0xFFFFFFFF] = payload
+            data, off = b'', 0
+            while off in flow.segments:
+                data += flow.segments[off]
+                off = len(data)
+            if data and data[0] != TLS_CONTENT_HANDSHAKE:
+                flow.state = FLOW_ALLOWED
+                return flow.state
+            hello = parse_client_hello(data)
+
+        sni = hello[0] if hello else None
+        if sni is not None:
+            if self.blocked.lookup(sni) is not None:
+                flow.state = FLOW_BLOCKED
+            elif self.config.lock_first_hello:
+                flow.state = FLOW_ALLOWED
+        elif sum(map(len, flow.segments.values())) > INSPECT_LIMIT:
+            flow.state = FLOW_ALLOWED
+        return flow.state
+
+
+def run(emulator: DpiEmulator, queue_num: int = DPI_QUEUE):
+    """Serve verdicts on an NFQUEUE until interrupted."""
+    from netfilterqueue import NetfilterQueue
+
+    raw_sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_RAW)
+
+    def callback(packet):
+        try:
+            accept, inject = emulator.handle(packet.get_payload())
+        except Exception as e:
+            logging.error(f"[DPI] {e}")
+            accept, inject = True, None
+        if inject is not None:
+            raw_sock.sendto(inject, (socket.inet_ntoa(inject[16:20]), 0))
+        if accept:
+            packet.accept()
+        else:
+            packet.drop()
+
+    nfqueue = NetfilterQueue()
+    nfqueue.bind(queue_num, callback)
+    print("ready", flush=True)
+    try:
+        nfqueue.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        nfqueue.unbind()
+        raw_sock.close()
+        logging.info(f"[DPI] {emulator.stats}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="In-path DPI emulator for the test bed")
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="strict")
+    parser.add_argument("--block", action="append", default=[], help="Blocked domain (and its subdomains)")
+    parser.add_argument("--queue", type=int, default=DPI_QUEUE)
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format='%(message)s')
+    if not args.block:
+        parser.error("at least one --block domain is required")
+    run(DpiEmulator(args.block, PROFILES[args.profile]), args.queue)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,151 @@
+"""
+DPI Test Bed - client / DPI / server path built from network namespaces
+    [host: prober + nfqws] --veth-- [zdpi: router + DPI emulator] --veth-- [zsrv: TLS server]
+The host side stays in the root namespace, so ParallelProber runs unchanged:
+its iptables rules and nfqws workers only ever match SERVER_IP. The middle
+namespace forwards between the two links and queues client -> server :443
+traffic to testbed.dpi_emulator, which can be restarted with another
+profile without tearing the path down.
+
+Needs root, iproute2, iptables, nfqws and NetfilterQueue.
+"""
+import os
+import sys
+import select
+import logging
+import subprocess
+import time
+from typing import Iterable, List, Optional
+
+from testbed.dpi_emulator import DPI_QUEUE
+
+NS_DPI = "zdpi"
+NS_SERVER = "zsrv"
+HOST_LINK = "zt-host"        # Host end of the host <-> DPI link
+DPI_HOST_LINK = "zt-dpi0"
+DPI_SERVER_LINK = "zt-dpi1"
+SERVER_LINK = "zt-srv"
+
+CLIENT_IP = "10.66.1.1"
+DPI_CLIENT_IP = "10.66.1.2"
+DPI_SERVER_IP = "10.66.2.1"
+SERVER_IP = "10.66.2.2"
+SERVER_NET = "10.66.2.0/24"
+
+BLOCKED_DOMAINS = ("blocked.test",)
+READY_TIMEOUT = 10.0
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+def _run(cmd: List[str], check: bool = True) -> bool:
+    result = subprocess.run(cmd, capture_output=True)
+    if check and result.returncode != 0:
+        raise RuntimeError(f"{' '.join(cmd)}: {result.stderr.decode(errors='replace').strip()}")
+    return result.returncode == 0
+
+
+def _in_ns(ns: str, cmd: List[str]) -> List[str]:
+    return ['ip', 'netns', 'exec', ns] + cmd
+
+
+def _wait_ready(proc: subprocess.Popen, timeout: float) -> bool:
+    """Wait for the child's "ready" line on stdout."""
+    deadline = time.monotonic() + timeout
+    while proc.poll() is None:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        if select.select([proc.stdout], [], [], remaining)[0]:
+            line = proc.stdout.readline()
+            if line.strip() == b"ready":
+                return True
+            if not line:
+                break
+    return False
+
+
+class DpiTestbed:
+    def __init__(self, profile: str = "strict", blocked: Iterable[str] = BLOCKED_DOMAINS,
+                 python: str = sys.executable):
+        self.profile = profile
+        self.blocked = list(blocked)
+        self.python = python
+        self.server: Optional[subprocess.Popen] = None
+        self.emulator: Optional[subprocess.Popen] = None
+
+    def _spawn(self, ns: str, module: str, *args: str) -> subprocess.Popen:
+        proc = subprocess.Popen(
+            _in_ns(ns, [self.python, '-m', module, *args]), cwd=REPO_ROOT,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, stdin=subprocess.DEVNULL,
+            start_new_session=True
+        )
+        if not _wait_ready(proc, READY_TIMEOUT):
+            self._stop(proc)
+            raise RuntimeError(f"{module} did not come up in {ns}")
+        return proc
+
+    @staticmethod
+    def _stop(proc: Optional[subprocess.Popen]):
+        if proc is None or proc.poll() is not None:
+            return
+        proc.terminate()
+        try:
+            proc.wait(timeout=2)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+    def setup(self):
+        """Build the namespaces and links, then start the server and the emulator."""
+        self.teardown()
+        for ns in (NS_DPI, NS_SERVER):
+            _run(['ip', 'netns', 'add', ns])
+        _run(['ip', 'link', 'add', HOST_LINK, 'type', 'veth', 'peer', 'name', DPI_HOST_LINK, 'netns', NS_DPI])
+        _run(['ip', '-n', NS_DPI, 'link', 'add', DPI_SERVER_LINK, 'type', 'veth',
+              'peer', 'name', SERVER_LINK, 'netns', NS_SERVER])
+
+        _run(['ip', 'addr', 'add', f'{CLIENT_IP}/24', 'dev', HOST_LINK])
+        _run(['ip', 'link', 'set', HOST_LINK, 'up'])
+        _run(['ip', 'route', 'replace', SERVER_NET, 'via', DPI_CLIENT_IP, 'dev', HOST_LINK])
+        for link, addr in ((DPI_HOST_LINK, DPI_CLIENT_IP), (DPI_SERVER_LINK, DPI_SERVER_IP)):
+            _run(['ip', '-n', NS_DPI, 'addr', 'add', f'{addr}/24', 'dev', link])
+            _run(['ip', '-n', NS_DPI, 'link', 'set', link, 'up'])
+        _run(['ip', '-n', NS_DPI, 'link', 'set', 'lo', 'up'])
+        _run(_in_ns(NS_DPI, ['sysctl', '-qw', 'net.ipv4.ip_forward=1']))
+        _run(['ip', '-n', NS_SERVER, 'addr', 'add', f'{SERVER_IP}/24', 'dev', SERVER_LINK])
+        _run(['ip', '-n', NS_SERVER, 'link', 'set', SERVER_LINK, 'up'])
+        _run(['ip', '-n', NS_SERVER, 'link', 'set', 'lo', 'up'])
+        _run(['ip', '-n', NS_SERVER, 'route', 'add', 'default', 'via', DPI_SERVER_IP])
+
+        # No --queue-bypass: with the emulator down the path is closed, not silently open
+        _run(_in_ns(NS_DPI, ['iptables', '-A', 'FORWARD', '-p', 'tcp', '-d', SERVER_IP, '--dport', '443',
+                             '-j', 'NFQUEUE', '--queue-num', str(DPI_QUEUE)]))
+
+        self.server = self._spawn(NS_SERVER, 'testbed.tls_server')
+        self.set_profile(self.profile)
+        logging.info(f"[TESTBED] {CLIENT_IP} -> {NS_DPI} -> {SERVER_IP}, blocked: {', '.join(self.blocked)}")
+
+    def set_profile(self, profile: str):
+        """(Re)start the DPI emulator with another profile."""
+        self._stop(self.emulator)
+        args = ['--profile', profile, '--queue', str(DPI_QUEUE)]
+        for domain in self.blocked:
+            args += ['--block', domain]
+        self.emulator = self._spawn(NS_DPI, 'testbed.dpi_emulator', *args)
+        self.profile = profile
+
+    def teardown(self):
+        """Stop the children and remove everything setup() created; safe to call twice."""
+        for proc in (self.emulator, self.server):
+            self._stop(proc)
+        self.emulator = self.server = None
+        _run(['ip', 'link', 'del', HOST_LINK], check=False)
+        for ns in (NS_DPI, NS_SERVER):
+            _run(['ip', 'netns', 'del', ns], check=False)
+
+    def __enter__(self):
+        self.setup()
+        return self
+
+    def __exit__(self, *exc):
+        self.teardown()
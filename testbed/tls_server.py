@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Test Bed TLS Server - answers any SNI with a tiny HTTP response
+Runs in the server namespace of testbed/lab.py. The certificate is a
+throwaway self-signed one generated at startup: probes judge the handshake,
+not the chain.
+Usage: python3 -m testbed.tls_server [--port 443]
+"""
+import os
+import sys
+import ssl
+import socket
+import logging
+import argparse
+import datetime
+import tempfile
+import threading
+
+RESPONSE = b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\nConnection: close\r\n\r\nok"
+CLIENT_TIMEOUT = 10.0
+
+
+def make_context(common_name: str = "testbed.local") -> ssl.SSLContext:
+    """Server context with a fresh self-signed EC certificate."""
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (x509.CertificateBuilder()
+            .subject_name(name).issuer_name(name)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(days=1))
+            .not_valid_after(now + datetime.timedelta(days=30))
+            .sign(key, hashes.SHA256()))
+
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "cert.pem")
+        with open(path, "wb") as f:
+            f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                      serialization.NoEncryption()))
+            f.write(cert.public_bytes(serialization.Encoding.PEM))
+        ctx.load_cert_chain(path)
+    ctx.set_alpn_protocols(['h2', 'http/1.1'])
+    return ctx
+
+
+def _serve_client(ctx: ssl.SSLContext, conn: socket.socket):
+    conn.settimeout(CLIENT_TIMEOUT)
+    try:
+        with ctx.wrap_socket(conn, server_side=True) as tls:
+            request = b""
+            while b"\r\n\r\n" not in request:
+                chunk = tls.recv(4096)
+                if not chunk:
+                    return
+                request += chunk
+            tls.sendall(RESPONSE)
+    except (OSError, ssl.SSLError) as e:
+        logging.debug(f"[SERVER] {e}")
+    finally:
+        conn.close()
+
+
+def serve(port: int = 443, host: str = "0.0.0.0"):
+    ctx = make_context()
+    listener = socket.create_server((host, port), reuse_port=True)
+    print("ready", flush=True)
+    try:
+        while True:
+            conn, _ = listener.accept()
+            threading.Thread(target=_serve_client, args=(ctx, conn), daemon=True).start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TLS endpoint for the test bed")
+    parser.add_argument("--port", type=int, default=443)
+    parser.add_argument("--host", default="0.0.0.0")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    serve(args.port, args.host)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
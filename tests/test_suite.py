@@ -15,10 +15,46 @@ except ImportError:
     sys.modules["dns"] = mock_dns
     sys.modules["dns.resolver"] = mock_dns
 
+# Mock netfilterqueue if not present (needs libnetfilter_queue to build)
+try:
+    import netfilterqueue
+except ImportError:
+    from unittest.mock import MagicMock
+    sys.modules["netfilterqueue"] = MagicMock()
+
 from installer.distro_detector import DistroDetector
 from telemetry.stats_tracker import StatsTracker
 from intelligence.blocklist_manager import BlocklistManager
 from solver.parallel_prober import ParallelProber
+from core.packet_parser import parse_packet
+from core.flow_table import FlowTable
+from core.packet_parser import parse_http_host
+from core import quic
+from core.db import StrategyDB
+from core.domain_index import SuffixIndex
+from core.verdict_cache import VerdictCache, VERDICT_GOOD, VERDICT_BLOCKED
+from solver.nfqws_pool import NfqwsPool
+from solver import tls_probe
+from solver.bandit import StrategyBandit, dst_prefix
+from solver import batch_solver
+from solver import async_prober
+
+FAKE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'files', 'fake'))
+
+def load_fake(name: str) -> bytes:
+    with open(os.path.join(FAKE_DIR, name), 'rb') as f:
+        return f.read()
+
+class FakeNfqPacket:
+    """Stand-in for netfilterqueue.Packet"""
+    def __init__(self, payload: bytes):
+        self.payload = payload
+        self.mark = 0
+        self.verdict = None
+    def get_payload(self): return self.payload
+    def get_mark(self): return self.mark
+    def set_mark(self, mark): self.mark = mark
+    def accept(self): self.verdict = "accept"
 
 class TestZapretAutonomous(unittest.TestCase):
     @classmethod
@@ -45,10 +81,810 @@ class TestZapretAutonomous(unittest.TestCase):
         self.assertIsNotNone(cursor.fetchone())
         conn.close()
 
+    def test_strategy_db_wal_roundtrip(self):
+        db = StrategyDB(db_path=self.db_path)
+        db.save_strategy("example.org", "fake_ttl3")
+        self.assertEqual(db.get_strategy("example.org"), "fake_ttl3")
+        mode = db._conn().execute("PRAGMA journal_mode").fetchone()[0]
+        self.assertEqual(mode, "wal")
+        db.delete_strategy("example.org")
+        self.assertIsNone(db.get_strategy("example.org"))
+        db.close()
+
+    def test_strategy_db_write_behind_coalesces(self):
+        db = StrategyDB(db_path=self.db_path, flush_interval=60)
+        for strategy in ("fake_ttl1", "fake_ttl2", "split_1"):
+            db.save_strategy("coalesce.org", strategy)
+        self.assertEqual(db.get_strategy("coalesce.org"), "split_1")
+        db.flush()
+        row = db._conn().execute("SELECT strategy, success_count FROM domains WHERE domain = ?",
+                                 ("coalesce.org",)).fetchone()
+        self.assertEqual(row, ("split_1", 3))
+        db.close()
+        self.assertEqual(StrategyDB(db_path=self.db_path).get_strategy("coalesce.org"), "split_1")
+
+    def test_strategy_db_retries_failed_flush(self):
+        import tempfile
+        from unittest import mock
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        db = StrategyDB(db_path=os.path.join(tmp.name, "retry.db"), flush_interval=60)
+        db.save_strategy("locked.org", "split_1")
+
+        class Locked:
+            def __enter__(self): return self
+            def __exit__(self, *exc): return False
+            def execute(self, *args): raise sqlite3.OperationalError("database is locked")
+            executemany = execute
+
+        with mock.patch.object(db, "_conn", return_value=Locked()):
+            with self.assertRaises(sqlite3.OperationalError):
+                db.flush()
+        # Saved again meanwhile: the newer strategy wins, the successes add up
+        db.save_strategy("locked.org", "fake_ttl3")
+        db.delete_strategy("gone.org")
+        db.close()
+        db.save_strategy("late.org", "split_2")  # After close(): persisted at once
+        conn = sqlite3.connect(db.db_path)
+        rows = dict((domain, (strategy, count)) for domain, strategy, count in
+                    conn.execute("SELECT domain, strategy, success_count FROM domains"))
+        conn.close()
+        self.assertEqual(rows, {"locked.org": ("fake_ttl3", 2), "late.org": ("split_2", 1)})
+
+    def test_strategy_db_bulk_roundtrip(self):
+        db = StrategyDB(db_path=self.db_path, flush_interval=60)
+        domains = [f"bulk{i}.org" for i in range(1200)]  # Spans several IN chunks
+        db.save_strategies({domain: "fake_ttl3" for domain in domains})
+        db.delete_strategies(domains[:700])
+        db.close()
+        db = StrategyDB(db_path=self.db_path)
+        found = db.get_strategies(domains + ["missing.org"])
+        self.assertEqual(sum(1 for s in found.values() if s == "fake_ttl3"), 500)
+        self.assertIsNone(found["bulk0.org"])
+        self.assertIsNone(found["missing.org"])
+
+    def test_nfqws_pool_readiness(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as tmp:
+            fake = os.path.join(tmp, "nfqws")
+            with open(fake, "w") as f:
+                # Binds unless asked for the 'broken' queue, then stays up like nfqws does
+                f.write('#!/bin/sh\n[ "$1" = "--qnum=301" ] && exit 1\n'
+                        'echo "initializing raw sockets bind-fix4=0 bind-fix6=0"\nexec sleep 30\n')
+            os.chmod(fake, 0o755)
+            pool = NfqwsPool(queue_base=300, nfqws_path=fake, ready_timeout=5)
+            try:
+                worker = pool.acquire("fake_ttl1")
+                self.assertIsNotNone(worker)
+                self.assertEqual(worker.queue_num, 300)
+                self.assertIsNone(pool.acquire("split_1"))  # exited before binding
+                self.assertIs(pool.acquire("fake_ttl1"), worker)  # reused, not respawned
+                self.assertEqual(pool.restarts, 0)
+            finally:
+                pool.stop()
+            self.assertFalse(worker.alive())
+
+    def test_tls_probe_outcomes(self):
+        import asyncio, socket, threading
+        from core.packet_parser import parse_client_hello
+
+        def serve(reply):
+            """One-shot server: reads the ClientHello, answers with reply (None = stay silent)."""
+            srv = socket.socket()
+            srv.bind(("127.0.0.1", 0))
+            srv.listen(1)
+            seen = {}
+            def run():
+                conn, peer = srv.accept()
+                seen["port"] = peer[1]
+                seen["sni"] = parse_client_hello(conn.recv(65536))[0]
+                if reply is not None:
+                    conn.sendall(reply)
+                else:
+                    threading.Event().wait(1)
+                conn.close()
+                srv.close()
+            threading.Thread(target=run, daemon=True).start()
+            return srv.getsockname()[1], seen
+
+        port, seen = serve(b"\x16\x03\x03\x00\x5a\x02\x00\x00\x56\x03\x03")
+        result = tls_probe.probe_tls("127.0.0.1", "blocked.example", port=port, timeout=2)
+        self.assertTrue(result.ok)
+        self.assertEqual(seen["sni"], "blocked.example")
+        self.assertIsNotNone(result.first_byte_time)
+
+        # From a socket bound beforehand (the probers' reserved source port), sync and async
+        from solver.parallel_prober import _reserve_port
+        for probe in (tls_probe.probe_tls, lambda *a, **k: asyncio.run(tls_probe.probe_tls_async(*a, **k))):
+            port, seen = serve(b"\x16\x03\x03\x00\x5a\x02\x00\x00\x56\x03\x03")
+            sock = _reserve_port()
+            source_port = sock.getsockname()[1]
+            self.assertTrue(probe("127.0.0.1", "blocked.example", port=port, timeout=2, sock=sock).ok)
+            self.assertEqual(seen["port"], source_port)
+            self.assertEqual(sock.fileno(), -1)
+
+        port, _ = serve(b"\x15\x03\x03\x00\x02\x02\x28")
+        result = tls_probe.probe_tls("127.0.0.1", "blocked.example", port=port, timeout=2)
+        self.assertEqual((result.outcome, result.alert), (tls_probe.OUTCOME_ALERT, 40))
+
+        port, _ = serve(None)
+        result = tls_probe.probe_tls("127.0.0.1", "blocked.example", port=port, timeout=0.3)
+        self.assertEqual((result.outcome, result.phase), (tls_probe.OUTCOME_TIMEOUT, tls_probe.PHASE_HELLO))
+
+        with socket.socket() as closed:
+            closed.bind(("127.0.0.1", 0))
+            port = closed.getsockname()[1]
+        result = tls_probe.probe_tls("127.0.0.1", "blocked.example", port=port, timeout=1)
+        self.assertEqual((result.outcome, result.phase), (tls_probe.OUTCOME_RST, tls_probe.PHASE_CONNECT))
+
+        # A losing probe is aborted by its cancel token long before its timeout
+        port, _ = serve(None)
+        token = tls_probe.CancelToken()
+        threading.Timer(0.1, token.cancel).start()
+        result = tls_probe.probe_tls("127.0.0.1", "blocked.example", port=port, timeout=5, cancel=token)
+        token.close()
+        self.assertEqual(result.outcome, tls_probe.OUTCOME_CANCELLED)
+        self.assertLess(result.total_time, 1)
+        # Late winners and a second cleanup never touch the closed (possibly reused) fds
+        token.close()
+        late = tls_probe.CancelToken()
+        late.close()
+        late.cancel()
+        self.assertTrue(late.is_set())
+
+    def test_bandit_ranks_by_history(self):
+        import random, tempfile
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        tracker = StatsTracker(db_path=os.path.join(tmp.name, "bandit.db"))
+        prefix = dst_prefix("203.0.113.7")
+        self.assertEqual(prefix, "203.0.113.0/24")
+        for _ in range(20):
+            tracker.log_bypass("bandit.org", "split_2", True, 150, isp="TestISP", dst_prefix=prefix)
+        for _ in range(6):
+            tracker.log_bypass("bandit.org", "wssize_fake", False, 5000, isp="TestISP", dst_prefix=prefix)
+        order = StrategyBandit(tracker, rng=random.Random(7)).rank(isp="TestISP", ip="203.0.113.99")
+        self.assertEqual(order[0], "split_2")
+        self.assertGreater(order.index("wssize_fake"), len(order) // 2)
+
+    def test_isp_configured_for_probers(self):
+        from unittest.mock import patch
+        from solver.bandit import ISP_ENV, configured_isp
+        with patch.dict(os.environ, {ISP_ENV: "TestISP"}):
+            self.assertEqual(configured_isp(), "TestISP")
+            self.assertEqual(configured_isp("Other"), "Other")
+            self.assertEqual(ParallelProber("isp.example", enable_telemetry=False, resolved_ip="203.0.113.7",
+                                            dual_stack=False).isp, "TestISP")
+            self.assertEqual(batch_solver.BatchSolver(["isp.example"]).isp, "TestISP")
+        with patch.dict(os.environ, {ISP_ENV: ""}):
+            self.assertEqual(configured_isp(), "Unknown")
+
+    def test_batch_solver_probes_once_per_edge(self):
+        from unittest.mock import patch, MagicMock
+        ips = {"a.example": "104.16.1.1", "b.example": "104.16.1.2", "c.example": "104.16.1.3",
+               "d.example": "151.101.0.1", "e.example": "151.101.0.2"}
+        runs = []
+
+        def fake_prober(self, domain, **kwargs):
+            prober = MagicMock()
+            runs.append((domain, kwargs.get("sni_pool")))
+            prober.solve.return_value = "split_2" if domain.startswith(("a", "e")) else "fake_ttl3"
+            prober.verify.side_effect = lambda strategy: domain != "c.example"
+            return prober
+
+        with patch.object(batch_solver, "resolve_domain", ips.get), \
+                patch.object(batch_solver, "resolve_ipv6", return_value=None), \
+                patch.object(batch_solver.BatchSolver, "_prober", fake_prober):
+            solver = batch_solver.BatchSolver(list(ips))
+            results = solver.solve()
+        self.assertEqual(len(solver.groups), 2)
+        self.assertEqual(results, {"a.example": "split_2", "b.example": "split_2", "c.example": "fake_ttl3",
+                                   "d.example": "fake_ttl3", "e.example": "fake_ttl3"})
+        # One full run per edge plus one for the member that failed verification
+        self.assertEqual(solver.probes, 3)
+        self.assertIn(("a.example", ["a.example", "b.example", "c.example"]), runs)
+
+    def test_async_prober_cancels_losers(self):
+        import asyncio, time
+        from unittest.mock import patch, MagicMock
+        rules = []
+
+        async def fake_firewall(self, batch):
+            rules.extend(action for action, _, _, _ in batch.changes)
+            return True
+
+        async def fake_probe(ip, sni, timeout, sock):
+            result = tls_probe.ProbeResult()
+            await asyncio.sleep(0.05 if fake_probe.calls == 2 else 10)
+            result.outcome = tls_probe.OUTCOME_SUCCESS
+            return result
+        fake_probe.calls = 0
+
+        def counting_probe(*args, **kwargs):
+            fake_probe.calls += 1
+            return fake_probe(*args, **kwargs)
+
+        worker = MagicMock(queue_num=300, bound=True)
+        worker.alive.return_value = True
+        pool = MagicMock()
+        pool.running.return_value = None
+        pool.ensure.return_value = worker
+
+        async def run():
+            prober = async_prober.AsyncProber("blocked.example", enable_telemetry=False, adaptive=False,
+                                              resolved_ip="203.0.113.7", max_parallel=4, dual_stack=False)
+            start = time.monotonic()
+            winner = await prober.solve()
+            elapsed = time.monotonic() - start
+            await prober.wait_cleanup()
+            return winner, elapsed
+
+        with patch.object(async_prober.AsyncProber, "_firewall", fake_firewall), \
+                patch.object(async_prober, "probe_tls_async", counting_probe), \
+                patch.object(async_prober, "get_nfqws_pool", return_value=pool):
+            winner, elapsed = asyncio.run(run())
+        self.assertEqual(winner, async_prober.PRIORITY_LIST[1])
+        self.assertLess(elapsed, 1)
+        self.assertEqual(fake_probe.calls, 4)  # Only the first wave ever started
+        self.assertEqual(rules.count("-I"), rules.count("-D"))
+
+        # Cancelled while its insert is still queued: the rule goes in anyway and must come out
+        async def slow_firewall(self, batch):
+            await asyncio.sleep(0.05)
+            return await fake_firewall(self, batch)
+
+        async def cancel_mid_insert():
+            prober = async_prober.AsyncProber("blocked.example", enable_telemetry=False)
+            task = asyncio.ensure_future(prober._test_target("split_2", worker, "203.0.113.7", {}))
+            await asyncio.sleep(0.01)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        del rules[:]
+        with patch.object(async_prober.AsyncProber, "_firewall", slow_firewall), \
+                patch.object(async_prober, "get_nfqws_pool", return_value=pool):
+            asyncio.run(cancel_mid_insert())
+        self.assertEqual(rules, ["-I", "-D"])
+
+    def test_parallel_prober_caps_and_isolates_probes(self):
+        import threading, time
+        from unittest.mock import patch, MagicMock
+        from solver import parallel_prober
+        from solver.parallel_prober import PRIORITY_LIST
+        pool = MagicMock()
+        pool.acquire.side_effect = lambda key: MagicMock(queue_num=200 + PRIORITY_LIST.index(key))
+        with patch.object(parallel_prober, "get_nfqws_pool", return_value=pool):
+            prober = ParallelProber("blocked.example", enable_telemetry=False, adaptive=False,
+                                    resolved_ip="203.0.113.7", max_parallel=3, dual_stack=False)
+        inserted = []
+        prober.firewall = MagicMock()
+        prober.firewall.submit.side_effect = lambda batch: inserted.extend(
+            rule for action, _, rule, _ in batch.changes if action == "-I") or True
+
+        lock = threading.Lock()
+        in_flight, peak, ports = [0], [0], []
+
+        def probe(ip, sock=None, sni=None):
+            with lock:
+                in_flight[0] += 1
+                peak[0] = max(peak[0], in_flight[0])
+                ports.append(sock.getsockname()[1])  # Still bound: the port cannot be taken meanwhile
+            time.sleep(0.02)
+            with lock:
+                in_flight[0] -= 1
+            return tls_probe.ProbeResult()  # Never a winner: every strategy gets probed
+
+        with patch.object(prober, "_probe", probe):
+            self.assertIsNone(prober.solve())
+        prober.wait_cleanup()
+        self.assertEqual(peak[0], 3)
+        self.assertEqual(len(ports), len(PRIORITY_LIST))
+        # Each probe's rule matches its own source port and queue
+        sports = [int(rule[rule.index('--sport') + 1]) for rule in inserted]
+        self.assertEqual(sorted(sports), sorted(ports))
+        self.assertEqual(len({(rule[rule.index('--sport') + 1], rule[rule.index('--queue-num') + 1])
+                              for rule in inserted}), len(PRIORITY_LIST))
+
+        # Same instance again: a fresh run, not the last one's finished state
+        def win(ip, sock=None, sni=None):
+            result = tls_probe.ProbeResult()
+            result.outcome = tls_probe.OUTCOME_SUCCESS
+            return result
+
+        del ports[:]
+        with patch.object(prober, "_probe", win):
+            self.assertIn(prober.solve(), PRIORITY_LIST[:3])  # First wave, whichever answers first
+        prober.wait_cleanup()
+        with patch.object(prober, "_probe", probe):
+            self.assertIsNone(prober.solve())
+        prober.wait_cleanup()
+        self.assertEqual(len(ports), len(PRIORITY_LIST))
+        self.assertIsNone(prober.winner_strategy)
+
+    def test_probe_log_batched(self):
+        import tempfile
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        tracker = StatsTracker(db_path=os.path.join(tmp.name, "probes.db"))
+        base = {"domain": "blocked.example", "strategy": "split_2", "isp": "TestISP", "dst_prefix": "203.0.113.0/24",
+                "iptables_ms": 4, "ready_ms": 0, "connect_ms": 30, "teardown_ms": 3}
+        tracker.record_probe(dict(base, outcome="success", handshake_ms=40, total_ms=72), success=True)
+        tracker.record_probe(dict(base, outcome="rst", total_ms=35), success=False)
+        tracker.record_probe(dict(base, outcome="cancelled", total_ms=10), success=None)
+        self.assertEqual(tracker.get_probe_timings(days=1), [])  # still buffered
+        tracker.flush_probes()
+        timings = {outcome: (count, phases) for outcome, count, phases in tracker.get_probe_timings(days=1)}
+        self.assertEqual(timings["success"][0], 1)
+        self.assertEqual(timings["success"][1]["handshake_ms"], 40)
+        self.assertIsNone(timings["rst"][1]["handshake_ms"])
+        # Cancelled probes keep their timings but are not attempts
+        self.assertEqual(tracker.strategy_outcomes(isp="TestISP")["split_2"][:2], (1, 1))
+
+    def test_suffix_index_longest_match(self):
+        index = SuffixIndex({"googlevideo.com": "fake_ttl3", "*.youtube.com": "split_1",
+                             "m.youtube.com": "disorder_1"})
+        self.assertEqual(index.lookup("rr3---sn-xyz.googlevideo.com"), ("googlevideo.com", "fake_ttl3"))
+        self.assertEqual(index.lookup("www.youtube.com"), ("*.youtube.com", "split_1"))
+        self.assertEqual(index.lookup("a.m.youtube.com"), ("m.youtube.com", "disorder_1"))
+        self.assertIsNone(index.lookup("youtube.com"))  # wildcard covers subdomains only
+        self.assertIsNone(index.lookup("example.com"))
+
+    def test_packet_parser_sni(self):
+        from scapy.all import IP, IPv6, TCP, Raw
+        hello = load_fake("tls_clienthello_iana_org.bin")
+        for pkt in (IP(dst="192.0.43.8") / TCP(dport=443, flags="PA") / Raw(hello),
+                    IPv6(dst="2001:500:88:200::8") / TCP(dport=443, flags="PA") / Raw(hello)):
+            info = parse_packet(bytes(pkt))
+            self.assertEqual(info.sni, "iana.org")
+            self.assertEqual(info.dport, 443)
+        # Bare SYN: parsed, but no SNI
+        info = parse_packet(bytes(IP(dst="192.0.43.8") / TCP(dport=443, flags="S")))
+        self.assertIsNone(info.sni)
+        self.assertIsNone(parse_packet(b"\x45\x00"))
+
+    @unittest.skipUnless(quic.is_available(), "cryptography not installed")
+    def test_quic_initial_sni(self):
+        decoder = quic.QuicInitialDecoder()
+        self.assertEqual(decoder.decode(load_fake("quic_initial_www_google_com.bin")), ("www.google.com", ["h3"]))
+        # ClientHello split over two Initials of the same connection
+        self.assertIsNone(decoder.decode(load_fake("quic_initial_rutracker_org_kyber_1.bin")))
+        self.assertEqual(decoder.decode(load_fake("quic_initial_rutracker_org_kyber_2.bin"))[0], "rutracker.org")
+        self.assertIsNone(decoder.decode(load_fake("quic_short_header.bin")))
+
+    def test_http_host(self):
+        self.assertEqual(parse_http_host(load_fake("http_iana_org.bin")), "www.iana.org")
+        self.assertIsNone(parse_http_host(load_fake("tls_clienthello_iana_org.bin")))
+
+    def test_flow_table_lookup_and_expiry(self):
+        from scapy.all import IP, TCP
+        table = FlowTable(max_flows=2, idle_timeout=10)
+        out = parse_packet(bytes(IP(src="10.0.0.2", dst="1.1.1.1") / TCP(sport=40000, dport=443, flags="S")))
+        back = parse_packet(bytes(IP(src="1.1.1.1", dst="10.0.0.2") / TCP(sport=443, dport=40000, flags="SA")))
+        entry = table.add(out, now=0)
+        self.assertEqual(table.lookup(back, now=5), (entry, True))
+        self.assertEqual(table.expire(now=12), 0)
+        self.assertEqual(table.expire(now=16), 1)
+        self.assertEqual(table.lookup(out), (None, False))
+
+    def test_verdict_cache_ttl_and_lru(self):
+        cache = VerdictCache(max_entries=2)
+        cache.set(b"\x01", "a.com", VERDICT_GOOD, ttl=10, now=0)
+        cache.set(b"\x02", "b.com", VERDICT_BLOCKED, ttl=10, now=0)
+        self.assertEqual(cache.get(b"\x01", "a.com", now=5), VERDICT_GOOD)
+        cache.set(b"\x03", "c.com", VERDICT_GOOD, ttl=10, now=5)   # evicts b.com (LRU)
+        self.assertIsNone(cache.get(b"\x02", "b.com", now=5))
+        self.assertIsNone(cache.get(b"\x01", "a.com", now=11))    # expired
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_block_detector_injected_rst(self):
+        from scapy.all import IP, TCP, Raw
+        from core.interceptor import PacketInterceptor
+        blocked = []
+        interceptor = PacketInterceptor(None, blocked.append, batch_size=1)
+        interceptor.threaded_callbacks = False
+        client = dict(src="10.0.0.2", dst="192.0.43.8")
+        server = dict(src="192.0.43.8", dst="10.0.0.2")
+        for pkt in (IP(ttl=64, **client) / TCP(sport=40000, dport=443, flags="S"),
+                    IP(ttl=50, **server) / TCP(sport=443, dport=40000, flags="SA"),
+                    IP(ttl=64, **client) / TCP(sport=40000, dport=443, flags="PA") / Raw(load_fake("tls_clienthello_iana_org.bin")),
+                    IP(ttl=61, **server) / TCP(sport=443, dport=40000, flags="R")):
+            fake = FakeNfqPacket(bytes(pkt))
+            interceptor._process_packet(fake)
+            self.assertEqual(fake.verdict, "accept")
+        self.assertEqual(blocked, ["iana.org"])
+        self.assertEqual(interceptor.detector.signals["rst_injected"], 1)
+
+    def test_interceptor_drains_per_wakeup(self):
+        from unittest import mock
+        from scapy.all import IP, TCP
+        from core import interceptor as ic
+        interceptor = ic.PacketInterceptor(None, lambda domain: None)
+        interceptor.nfqueue = nfqueue = mock.MagicMock()
+        syn = bytes(IP(src="10.0.0.2", dst="192.0.43.8") / TCP(sport=40000, dport=443, flags="S"))
+        accepts = {}
+
+        class Packet(FakeNfqPacket):
+            def accept(self):
+                accepts[id(self)] = accepts.get(id(self), 0) + 1
+
+        bursts = [[Packet(syn) for _ in range(3)], [Packet(syn) for _ in range(2)]]
+        flushes = []
+        interceptor.on_flush = lambda i: flushes.append(i.packets)
+
+        def run(block=True):
+            # One non-blocking drain; the binding cannot batch verdicts, so none is held back
+            self.assertFalse(block)
+            burst = bursts[len(flushes)]
+            for packet in burst:
+                nfqueue.bind.call_args[0][1](packet)
+                self.assertEqual(accepts[id(packet)], 1)
+            interceptor.running = len(flushes) + 1 < len(bursts)
+
+        nfqueue.run.side_effect = run
+        with mock.patch.object(ic.select, "select", return_value=([3], [], [])):
+            interceptor.start()
+        self.assertEqual(flushes, [3, 5])
+        self.assertEqual(interceptor.batches, 2)
+        self.assertEqual(sorted(accepts.values()), [1] * 5)
+
+        # Pool workers re-read the table the parent saves solves into
+        db = mock.MagicMock()
+        worker = ic.PacketInterceptor(db, lambda domain: None, db_reload_interval=30)
+        worker._reload_db(worker._db_loaded + 10)
+        db.reload.assert_not_called()
+        worker._reload_db(worker._db_loaded + 31)
+        db.reload.assert_called_once_with()
+
+        # The pool sums up what its workers publish per queue
+        pool = ic.InterceptorPool(lambda domain: None, queue_base=10, workers=2)
+        for slot, (packets, batches) in enumerate(((300, 5), (100, 2))):
+            pool.packet_counters[slot], pool.batch_counters[slot] = packets, batches
+            pool.hit_counters[slot], pool.miss_counters[slot] = packets - 1, 1
+        pool._last_sample = (0.0, [100, 0])
+        with mock.patch.object(ic.time, "monotonic", return_value=2.0):
+            stats = pool.stats()
+        self.assertEqual(sorted(stats), [10, 11])
+        self.assertEqual(stats[10], {'packets': 300, 'batches': 5, 'cache_hits': 299, 'cache_misses': 1, 'pps': 100.0})
+        self.assertEqual(stats[11]['pps'], 50.0)
+        self.assertEqual(sum(queue['packets'] for queue in stats.values()), 400)
+
+    def test_dpi_emulator_weaknesses(self):
+        from scapy.all import IP, TCP, Raw
+        from testbed.dpi_emulator import DpiEmulator, PROFILES, _tcp_checksum
+        hello = load_fake("tls_clienthello_iana_org.bin")
+        decoy = load_fake("tls_clienthello_www_google_com.bin")
+        client = dict(src="10.66.1.1", dst="10.66.2.2")
+
+        def segment(port, seq, data, ttl=64, **tcp):
+            return bytes(IP(ttl=ttl, **client) / TCP(sport=port, dport=443, flags="PA", seq=seq, ack=5000, **tcp) / Raw(data))
+
+        def flow(profile, packets, port=40000):
+            dpi = DpiEmulator(["iana.org"], PROFILES[profile])
+            dpi.handle(bytes(IP(**client) / TCP(sport=port, dport=443, flags="S", seq=1000)))
+            return [dpi.handle(segment(port, seq, data, **kwargs)) for seq, data, kwargs in packets]
+
+        # Whole ClientHello: blocked, RST spoofed from the server with its next sequence number
+        (accept, rst), = flow('strict', [(1001, hello, {})])
+        self.assertFalse(accept)
+        info = parse_packet(rst)
+        self.assertEqual((info.src_ip, info.sport, info.dport), ("10.66.2.2", 443, 40000))
+        self.assertEqual(rst[24:28], (5000).to_bytes(4, 'big'))
+        self.assertEqual(_tcp_checksum(info.src, info.dst, rst[20:]), 0)
+
+        # Split after the first byte: only a reassembling DPI sees the SNI
+        split = [(1001, hello[:1], {}), (1002, hello[1:], {})]
+        self.assertEqual([v[0] for v in flow('split', split)], [True, True])
+        self.assertEqual([v[0] for v in flow('strict', split)], [True, False])
+
+        # Decoy hello with a bad checksum decides the flow only for a DPI that skips validation
+        fake = [(1001, decoy, dict(chksum=0xdead)), (1001, hello, {})]
+        self.assertEqual([v[0] for v in flow('fake-badsum', fake)], [True, True])
+        self.assertEqual([v[0] for v in flow('strict', fake)], [True, False])
+
+        # Low-TTL decoy: inspected, then expires before the server
+        fake = [(1001, decoy, dict(ttl=3)), (1001, hello, {})]
+        self.assertEqual(flow('fake-ttl', fake), [(False, None), (True, None)])
+        self.assertEqual([v[0] for v in flow('strict', fake)], [True, False])
+
+    def test_applicator_loads_one_set(self):
+        from unittest import mock
+        from core import strategy_applicator as sa
+        from core.firewall import Firewall
+        applicator = sa.StrategyApplicator()
+        applicator.firewall = Firewall(backend='iptables-legacy')
+        calls = []
+
+        def run(cmd, **kwargs):
+            calls.append((cmd, kwargs.get('input')))
+            return mock.Mock(returncode=1 if '-C' in cmd else 0)
+
+        ips = {f"d{i}.example": f"10.0.{i // 250}.{i % 250}" for i in range(1000)}
+        with mock.patch.object(sa.StrategyApplicator, 'set_backend', 'ipset'), mock.patch.object(sa.subprocess, 'run', run), \
+                mock.patch.object(applicator, '_resolve_ips', lambda domain: [ips[domain]]):
+            self.assertTrue(applicator._apply_iptables(list(ips)))
+        restore, check, exists, insert = calls
+        self.assertEqual(restore[0], ['ipset', '-exist', 'restore'])
+        self.assertEqual(restore[1].count(b"\nadd zapret_auto "), 1000)
+        self.assertIn('-C', check[0])
+        self.assertIn('ZAPRET_AUTO_OUTPUT', exists[0])
+        self.assertEqual(insert[0], ['iptables-restore', '--noflush'])
+        self.assertIn(b"-I ZAPRET_AUTO_OUTPUT -p tcp --dport 443 -m set --match-set zapret_auto dst", insert[1])
+        self.assertIn("elements = { 10.0.0.0, 10.0.0.1 }", sa.nft_script(["10.0.0.0", "10.0.0.1"]))
+
+    def test_applicator_profiles_per_strategy(self):
+        import tempfile, time
+        from unittest import mock
+        from core import strategy_applicator as sa
+        from core.firewall import Firewall
+        with tempfile.TemporaryDirectory() as tmp:
+            applicator = sa.StrategyApplicator(hostlist_dir=tmp)
+            applicator.firewall = Firewall(backend='iptables-legacy')
+            ips = {"a.org": "10.0.0.1", "b.org": "10.0.0.2", "c.org": "10.0.0.3"}
+            popen = mock.Mock(side_effect=lambda *a, **k: mock.Mock(**{"poll.return_value": None}))
+            run = mock.Mock(return_value=mock.Mock(returncode=0))
+            with mock.patch.object(sa.StrategyApplicator, 'set_backend', 'ipset'), mock.patch.object(sa, 'RETIRE_DELAY', 0), \
+                    mock.patch('core.firewall.STATE_PATH', os.path.join(tmp, "fw", "firewall.json")), \
+                    mock.patch.object(sa.subprocess, 'run', run), \
+                    mock.patch.object(sa.subprocess, 'Popen', popen), \
+                    mock.patch.object(applicator, '_wait_ready', return_value=True), \
+                    mock.patch.object(applicator, '_resolve_ips', lambda domain: [ips[domain]]):
+                self.assertTrue(applicator.apply("fake_ttl3", ["a.org"]))
+                # Same strategy: hostlist rewritten, nfqws left running
+                self.assertTrue(applicator.apply("fake_ttl3", ["b.org"]))
+                self.assertEqual(popen.call_count, 1)
+                with open(os.path.join(tmp, "fake_ttl3.txt")) as f:
+                    self.assertEqual(f.read().split(), ["a.org", "b.org"])
+                # New strategy: both profiles in one nfqws, started make-before-break on the other queue
+                first = applicator.current_process
+                self.assertTrue(applicator.apply("split_1", ["c.org"]))
+                self.assertEqual(popen.call_count, 2)
+                cmd = popen.call_args[0][0]
+                self.assertEqual(cmd[1], f"--qnum={sa.NFQUEUE_ALT}")
+                self.assertEqual(cmd.count('--new'), 1)
+                self.assertIn(f"--hostlist={os.path.join(tmp, 'split_1.txt')}", cmd)
+                swap = run.call_args[1]['input'].decode()
+                self.assertEqual(run.call_args[0][0], ['iptables-restore', '--noflush'])
+                self.assertIn(f"-I ZAPRET_AUTO_OUTPUT {' '.join(sa.set_rule(sa.NFQUEUE_ALT)[1:])}", swap)
+                self.assertIn(f"-D ZAPRET_AUTO_OUTPUT {' '.join(sa.set_rule(sa.NFQUEUE_NUM)[1:])}", swap)
+                for _ in range(100):
+                    if first.terminate.called:
+                        break
+                    time.sleep(0.01)
+                first.terminate.assert_called_once()
+                applicator.current_process.terminate.assert_not_called()
+                applicator.stop()
+
+    def test_applicator_back_to_back_reloads(self):
+        import tempfile, time
+        from unittest import mock
+        from core import strategy_applicator as sa
+        from core.firewall import Firewall
+        with tempfile.TemporaryDirectory() as tmp:
+            applicator = sa.StrategyApplicator(hostlist_dir=tmp)
+            applicator.firewall = Firewall(backend='iptables-legacy')
+            ips = {"a.org": "10.0.0.1", "b.org": "10.0.0.2", "c.org": "10.0.0.3"}
+            procs = []
+
+            def spawn(cmd, **kwargs):
+                # The queue must be free by the time its next nfqws starts
+                self.assertTrue(all(p.terminate.called for p, qnum in procs[:-1] if qnum == cmd[1]))
+                procs.append((mock.Mock(**{"poll.return_value": None}), cmd[1]))
+                return procs[-1][0]
+
+            with mock.patch.object(sa.StrategyApplicator, 'set_backend', 'ipset'), \
+                    mock.patch.object(sa, 'RETIRE_DELAY', 0.2), \
+                    mock.patch('core.firewall.STATE_PATH', os.path.join(tmp, "fw", "firewall.json")), \
+                    mock.patch.object(sa.subprocess, 'run', return_value=mock.Mock(returncode=0)), \
+                    mock.patch.object(sa.subprocess, 'Popen', side_effect=spawn), \
+                    mock.patch.object(applicator, '_wait_ready', return_value=True), \
+                    mock.patch.object(applicator, '_resolve_ips', lambda domain: [ips[domain]]):
+                self.assertTrue(applicator.apply("fake_ttl3", ["a.org"]))
+                self.assertTrue(applicator.apply("split_1", ["b.org"]))
+                # Second reload well within RETIRE_DELAY: back onto the first queue
+                self.assertTrue(applicator.apply("fake_ttl1", ["c.org"]))
+                (first, q1), (second, q2), (third, q3) = procs
+                self.assertEqual((q1, q2, q3), (f"--qnum={sa.NFQUEUE_NUM}", f"--qnum={sa.NFQUEUE_ALT}",
+                                                f"--qnum={sa.NFQUEUE_NUM}"))
+                first.terminate.assert_called_once()
+                time.sleep(0.4)  # Past the first reload's retire timer
+                third.terminate.assert_not_called()
+                self.assertTrue(os.path.exists(applicator._log_path(sa.NFQUEUE_NUM)))
+                second.terminate.assert_called_once()
+                applicator.stop()
+                self.assertEqual(applicator.retiring, {})
+            self.assertEqual(os.listdir(tmp), [])
+
+    def test_firewall_group_commit(self):
+        import threading, time
+        from unittest import mock
+        from core import firewall
+        batch = firewall.RuleBatch().insert(['OUTPUT', '-d', '10.0.0.1', '-j', 'NFQUEUE']).delete(['OUTPUT', '-j', 'ACCEPT'])
+        self.assertEqual(firewall.iptables_script(batch),
+                         "*mangle\n-I ZAPRET_AUTO_OUTPUT -d 10.0.0.1 -j NFQUEUE\n-D ZAPRET_AUTO_OUTPUT -j ACCEPT\nCOMMIT\n")
+        rule = ['OUTPUT', '-p', 'tcp', '--sport', '40000', '--dport', '443', '-d', '203.0.113.7',
+                '-j', 'NFQUEUE', '--queue-num', '300', '--queue-bypass']
+        self.assertEqual(firewall.nft_expression(rule),
+                         ('output', 'tcp sport 40000 tcp dport 443 ip daddr 203.0.113.7 queue num 300 bypass'))
+        from core.interceptor import steering_rules
+        reply = steering_rules(['-j', 'NFQUEUE', '--queue-num', '1', '--queue-bypass'], quic_ports="")[1]
+        self.assertEqual(firewall.nft_expression(reply),
+                         ('prerouting', 'tcp sport { 80, 443 } ct mark and 0x20000000 != 0x20000000 '
+                                        'ct reply packets 1-6 queue num 1 bypass'))
+
+        # Probes arriving during a transaction share the next one
+        fw = firewall.Firewall(backend=firewall.BACKEND_LEGACY)
+
+        def slow_run(cmd, **kwargs):
+            time.sleep(0.05)
+            return mock.Mock(returncode=0)
+
+        results = []
+        with mock.patch.object(firewall.subprocess, 'run', slow_run):
+            threads = [threading.Thread(target=lambda i=i: results.append(
+                fw.submit(firewall.RuleBatch().insert(['OUTPUT', '--sport', str(i)])))) for i in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        self.assertEqual(results, [True] * 8)
+        self.assertLess(fw.commits, 8)
+
+    def test_firewall_owns_chains(self):
+        import tempfile
+        from unittest import mock
+        from core import firewall
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        scripts = []
+
+        def run(cmd, **kwargs):
+            scripts.append(kwargs.get('input', b'').decode())
+            return mock.Mock(returncode=1 if '-S' in cmd else 0)  # No chain left from earlier runs
+
+        rule = ['OUTPUT', '-p', 'tcp', '--dport', '443', '-j', 'NFQUEUE', '--queue-num', '200']
+        with mock.patch.object(firewall, 'STATE_PATH', os.path.join(tmp.name, "firewall.json")), \
+                mock.patch.object(firewall.subprocess, 'run', run):
+            fw = firewall.Firewall(backend=firewall.BACKEND_LEGACY)
+            self.assertTrue(fw.commit(firewall.RuleBatch().insert(rule)))
+            self.assertTrue(fw.commit(firewall.RuleBatch().insert(rule)))
+            # Created with its jump in the first transaction only; built-in chains get nothing else
+            self.assertEqual(scripts[1], "*mangle\n:ZAPRET_AUTO_OUTPUT - [0:0]\n-I OUTPUT -j ZAPRET_AUTO_OUTPUT\n"
+                                         f"-I ZAPRET_AUTO_OUTPUT {' '.join(rule[1:])}\nCOMMIT\n")
+            self.assertNotIn(":ZAPRET_AUTO_OUTPUT", scripts[2])
+            self.assertEqual(firewall.load_state()['chains'], [[4, 'mangle', 'ZAPRET_AUTO_OUTPUT']])
+
+            # Another process tears down from the record alone
+            self.assertTrue(firewall.Firewall(backend=firewall.BACKEND_LEGACY).teardown())
+            self.assertEqual(scripts[-1], "*mangle\n-D OUTPUT -j ZAPRET_AUTO_OUTPUT\n-F ZAPRET_AUTO_OUTPUT\n"
+                                          "-X ZAPRET_AUTO_OUTPUT\nCOMMIT\n")
+            self.assertEqual(firewall.load_state(), {})
+
+        # A tampered record can only ever name our own chains
+        state = {'chains': [[4, 'mangle', 'INPUT'], [4, 'mangle', 'ZAPRET_AUTO_../x'], [4, 'filter', 'ZAPRET_AUTO_OUTPUT'],
+                            [6, 'mangle', 'ZAPRET_AUTO_POSTROUTING']]}
+        self.assertEqual(firewall.recorded_chains(state), [(6, 'mangle', 'POSTROUTING')])
+
+    def test_dual_stack_rules_and_probes(self):
+        from unittest import mock
+        from core import firewall
+        from core import strategy_applicator as sa
+        from solver import parallel_prober
+
+        # One transaction per family; a failing IPv6 half takes the IPv4 half back
+        cmds = []
+
+        def run(cmd, **kwargs):
+            cmds.append((cmd[0], kwargs.get('input', b'').decode()))
+            return mock.Mock(returncode=1 if cmd[0].startswith('ip6tables-restore') else 0)
+
+        batch = firewall.RuleBatch().insert(sa.ip_rule("10.0.0.1")).insert(sa.ip_rule("2001:db8::1"))
+        with mock.patch.object(firewall.subprocess, 'run', run):
+            self.assertFalse(firewall.Firewall(backend=firewall.BACKEND_LEGACY).commit(batch))
+        restores = [(cmd, script) for cmd, script in cmds if cmd.endswith('-restore')]
+        self.assertEqual([cmd for cmd, _ in restores], ['iptables-restore', 'ip6tables-restore', 'iptables-restore'])
+        self.assertIn("-D ZAPRET_AUTO_OUTPUT -p tcp --dport 443 -d 10.0.0.1", restores[2][1])
+
+        self.assertIn("add zapret_auto6 2001:db8::1", sa.ipset_script(["10.0.0.1", "2001:db8::1"]))
+        with self.assertRaises(ValueError):
+            firewall.nft_expression(sa.set_rule(200, 6))  # nft cannot see ipsets
+        with mock.patch.object(sa.shutil, 'which', lambda name: f"/usr/sbin/{name}"):
+            self.assertEqual(sa.set_type(firewall.BACKEND_NFT), 'nft')
+            self.assertEqual(sa.set_type(firewall.BACKEND_IPT_NFT), 'ipset')
+        self.assertNotIn("elements", sa.nft_script(["10.0.0.1"]).split("zapret_auto6")[1])
+
+        # IPv4 decides, IPv6 is only recorded per family
+        pool = mock.Mock(**{"acquire.return_value": mock.Mock(queue_num=300)})
+        with mock.patch.object(parallel_prober, "get_nfqws_pool", return_value=pool), \
+                mock.patch.object(parallel_prober.ParallelProber, "_resolve_ipv6", return_value="2001:db8::7"):
+            prober = parallel_prober.ParallelProber("dual.example", enable_telemetry=False, resolved_ip="203.0.113.7")
+        prober.firewall = mock.Mock(**{"submit.return_value": True})
+        self.assertEqual(prober.targets, ["203.0.113.7", "2001:db8::7"])
+        # split_2: IPv4 reset (no IPv6 probe); fake_ttl3: IPv4 ok, IPv6 reset
+        outcomes = [mock.Mock(ok=ok) for ok in (False, True, False)]
+        with mock.patch.object(prober, "_probe", side_effect=outcomes) as probe:
+            for key in ("split_2", "fake_ttl3"):
+                prober._test_strategy(key)
+        self.assertEqual([call[0][0] for call in probe.call_args_list], ["203.0.113.7"] + prober.targets)
+        self.assertEqual(prober.winner_strategy, "fake_ttl3")
+        self.assertTrue(prober.results["fake_ttl3"].ok)
+        self.assertFalse(prober.family_results["fake_ttl3"][6].ok)
+        self.assertNotIn(6, prober.family_results["split_2"])
+
+        # No AAAA is an answer, not a failure: no DoH round trip
+        socket = parallel_prober.socket
+        nodata = socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+        with mock.patch.object(socket, "getaddrinfo", side_effect=nodata), \
+                mock.patch.object(parallel_prober.requests, "get") as doh:
+            self.assertIsNone(parallel_prober.resolve_family("v4only.example", socket.AF_INET6))
+        doh.assert_not_called()
+
+    def test_runtime_dir_refuses_symlinks(self):
+        import tempfile
+        from core import runtime
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        shared = os.path.join(tmp.name, "shared")
+        os.mkdir(shared, 0o777)
+        os.chmod(shared, 0o777)
+        with self.assertRaises(PermissionError):
+            runtime.ensure_runtime_dir(shared)
+
+        private = runtime.ensure_runtime_dir(os.path.join(tmp.name, "private"))
+        victim = os.path.join(tmp.name, "victim")
+        with open(victim, "w") as f:
+            f.write("keep")
+        os.symlink(victim, os.path.join(private, "split_1.txt"))
+        with self.assertRaises(OSError):
+            runtime.read_file(os.path.join(private, "split_1.txt"))
+        runtime.write_atomic(os.path.join(private, "split_1.txt"), b"a.org\n")
+        with open(victim) as f:
+            self.assertEqual(f.read(), "keep")
+        self.assertEqual(runtime.read_file(os.path.join(private, "split_1.txt")), b"a.org\n")
+        # nfqws reads its hostlists after dropping root: readable by all, writable by us only
+        old_umask = os.umask(0o077)
+        try:
+            narrowed = runtime.ensure_runtime_dir(os.path.join(tmp.name, "narrowed"))
+        finally:
+            os.umask(old_umask)
+        self.assertEqual(os.stat(narrowed).st_mode & 0o777, 0o755)
+        self.assertEqual(os.stat(os.path.join(private, "split_1.txt")).st_mode & 0o777, 0o644)
+
+    def test_async_firewall_folds_on_loop(self):
+        import asyncio
+        from unittest import mock
+        from core import firewall
+        scripts = []
+
+        class Proc:
+            returncode = 0
+
+            async def communicate(self, data=None):
+                await asyncio.sleep(0.02)
+                if data is not None:
+                    scripts.append(data.decode())
+                return b"", b""
+
+        async def fake_exec(*cmd, **kwargs):
+            return Proc()
+
+        async def run():
+            fw = firewall.AsyncFirewall(firewall.Firewall(backend=firewall.BACKEND_LEGACY))
+            batches = [firewall.RuleBatch().insert(['OUTPUT', '--sport', str(i)]) for i in range(8)]
+            return await asyncio.gather(*(fw.submit(b) for b in batches))
+
+        with mock.patch.object(firewall.asyncio, 'create_subprocess_exec', fake_exec), \
+                mock.patch.object(firewall.Firewall, '_record'):
+            self.assertEqual(asyncio.run(run()), [True] * 8)
+        # Everything reached iptables-restore through stdin, in fewer transactions than batches
+        self.assertEqual(sum(script.count("--sport") for script in scripts), 8)
+        self.assertLess(len(scripts), 8)
+
     @classmethod
     def tearDownClass(cls):
-        if os.path.exists(cls.db_path):
-            os.remove(cls.db_path)
+        for path in (cls.db_path, cls.db_path + "-wal", cls.db_path + "-shm"):
+            if os.path.exists(path):
+                os.remove(path)
 
 if __name__ == '__main__':
     unittest.main()
@@ -4,6 +4,7 @@ Zapret CLI - Simple command-line interface for DPI bypass
 Usage:
     sudo python3 zapret-cli.py turbo.cr jpg6.su        # Bypass (auto-detect)
     sudo python3 zapret-cli.py -f turbo.cr             # Fresh probe
+    sudo python3 zapret-cli.py --isp rostelecom x.com  # Scope probe history by ISP
     sudo python3 zapret-cli.py status
     sudo python3 zapret-cli.py stop
 """
@@ -28,48 +29,72 @@ def is_domain(arg: str) -> bool:
     """Check if argument looks like a domain name."""
     return '.' in arg and not arg.startswith('-') and arg not in ['status', 'stop', 'test', 'clear', 'bypass']
 
-def cmd_bypass(domains: list, fresh: bool = False):
+def cmd_bypass(domains: list, fresh: bool = False, isp: str = None):
     """Find working strategy and apply bypass for given domains."""
-    from core.db import StrategyDB
+    from core.db import get_db
     from core.strategy_applicator import get_applicator
     from solver.parallel_prober import ParallelProber
+    from solver.batch_solver import BatchSolver
+    from solver.bandit import configured_isp
     
-    db = StrategyDB()
+    isp = configured_isp(isp)
+    db = get_db()
     applicator = get_applicator()
     
     # If fresh mode, clear old strategies for these domains
     if fresh:
         print("[FRESH] Clearing cached strategies and re-probing...")
-        for domain in domains:
-            db.delete_strategy(domain)
+        db.delete_strategies(domains)
     
-    for domain in domains:
-        print(f"\n{'='*50}")
-        print(f"  Processing: {domain}")
-        print(f"{'='*50}")
+    # One bulk lookup instead of a DB round-trip per domain
+    cached = {} if fresh else db.get_strategies(domains)
+    solved = {}
+    batch = {}
+    active = {}
+    
+    # Several unsolved domains: probe once per edge instead of once per domain
+    unsolved = [domain for domain in domains if not cached.get(domain)]
+    if len(unsolved) > 1:
+        print(f"[PROBE] Batch-solving {len(unsolved)} domains...")
+        batch = BatchSolver(unsolved, isp=isp).solve()
+    
+    try:
+        for domain in domains:
+            print(f"\n{'='*50}")
+            print(f"  Processing: {domain}")
+            print(f"{'='*50}")
         
-        # Check DB first (unless fresh mode)
-        cached_strategy = None if fresh else db.get_strategy(domain)
+            cached_strategy = cached.get(domain)
         
-        if cached_strategy:
-            print(f"[CACHE] Found saved strategy: {cached_strategy}")
-            strategy = cached_strategy
-        else:
-            print(f"[PROBE] Testing strategies for {domain}...")
-            prober = ParallelProber(domain)
-            strategy = prober.solve()
-            
-            if strategy:
-                db.save_strategy(domain, strategy)
-                print(f"[SAVE] Strategy '{strategy}' saved to database")
+            if cached_strategy:
+                print(f"[CACHE] Found saved strategy: {cached_strategy}")
+                strategy = cached_strategy
             else:
-                print(f"[FAIL] No working strategy found for {domain}")
-                continue
+                if domain in batch:
+                    strategy = batch[domain]
+                else:
+                    print(f"[PROBE] Testing strategies for {domain}...")
+                    prober = ParallelProber(domain, isp=isp)
+                    strategy = prober.solve()
+            
+                if strategy:
+                    solved[domain] = strategy
+                else:
+                    print(f"[FAIL] No working strategy found for {domain}")
+                    continue
         
-        # Apply the strategy
-        print(f"[APPLY] Activating bypass with strategy: {strategy}")
-        if applicator.apply(strategy, [domain]):
-            print(f"✓ Bypass ACTIVE for {domain}")
+            print(f"[APPLY] {domain} -> {strategy}")
+            active[domain] = strategy
+    finally:
+        # Persist what was solved even if a later domain is interrupted
+        if solved:
+            db.save_strategies(solved, isp=isp)
+            print(f"[SAVE] {len(solved)} new strategies saved to database")
+    
+    # One nfqws for all of them: a profile per strategy
+    if active:
+        if applicator.apply_many(active):
+            print(f"✓ Bypass ACTIVE for {len(active)} domains ({len(set(active.values()))} strategies)")
         else:
             print(f"✗ Failed to apply bypass")
     
@@ -103,13 +128,13 @@ def cmd_status():
         print(f"  Active: ✗ NO")
         print(f"  nfqws: Not running")
     
-    # Check iptables rules
-    result = subprocess.run(
-        ['iptables', '-t', 'mangle', '-L', 'POSTROUTING', '-n'],
-        capture_output=True, text=True
-    )
-    has_rules = 'NFQUEUE' in result.stdout
-    print(f"  IPTables Rules: {'Applied' if has_rules else 'Not applied'}")
+    # Check iptables rules: our own chains, as recorded when they were created
+    from core.firewall import load_state, own_chain, recorded_chains
+    state = load_state()
+    chains = [f"{own_chain(chain)} (IPv{family})" for family, _, chain in recorded_chains(state)]
+    if state.get('nft_table'):
+        chains = [f"inet {state['nft_table']}"]
+    print(f"  IPTables Rules: {'Applied (' + ', '.join(chains) + ')' if chains else 'Not applied'}")
     
     # Show saved domains
     print(f"\n  Saved Strategies:")
@@ -138,20 +163,13 @@ def cmd_stop():
     
     # Remove iptables rules
     print("[STOP] Removing iptables rules...")
-    subprocess.run([
-        'iptables', '-t', 'mangle', '-D', 'POSTROUTING',
-        '-p', 'tcp', '-m', 'multiport', '--dports', '80,443',
-        '-m', 'connbytes', '--connbytes-dir=original', '--connbytes-mode=packets', '--connbytes', '1:6',
-        '-m', 'mark', '!', '--mark', '0x40000000/0x40000000',
-        '-j', 'NFQUEUE', '--queue-num', '200', '--queue-bypass'
-    ], capture_output=True)
-    
-    subprocess.run([
-        'iptables', '-t', 'mangle', '-D', 'POSTROUTING',
-        '-p', 'udp', '--dport', '443',
-        '-m', 'mark', '!', '--mark', '0x40000000/0x40000000',
-        '-j', 'NFQUEUE', '--queue-num', '200', '--queue-bypass'
-    ], capture_output=True)
+    # Everything we installed lives in our own chains / table: one flush, whoever installed it
+    from core.firewall import get_firewall
+    get_firewall().teardown()
+    
+    # Target set, now that no rule references it
+    from core.strategy_applicator import remove_target_set
+    remove_target_set()
     
     print("✓ Bypass stopped and rules cleaned up")
 
@@ -182,9 +200,29 @@ def cmd_clear():
         print("✓ Strategy database cleared")
     except FileNotFoundError:
         print("Database already empty")
+    # WAL side files would otherwise be replayed into the next database
+    for suffix in ('-wal', '-shm'):
+        try:
+            os.remove('strategies.db' + suffix)
+        except FileNotFoundError:
+            pass
+
+def pop_option(args: list, name: str):
+    """Remove '--name VALUE' from args and return VALUE (None if absent)."""
+    if name not in args:
+        return None
+    i = args.index(name)
+    if i + 1 >= len(args):
+        print(f"Usage: {name} VALUE")
+        sys.exit(1)
+    value = args[i + 1]
+    del args[i:i + 2]
+    return value
 
 def main():
     args = sys.argv[1:]
+    # ISP label probe history is scoped by (default: $ZAPRET_ISP)
+    isp = pop_option(args, '--isp')
     
     if not args:
         print("""
@@ -198,6 +236,9 @@ Usage:
   sudo python3 zapret-cli.py test DOMAIN            Test accessibility
   sudo python3 zapret-cli.py clear                  Clear saved strategies
 
+Options:
+  --isp NAME    ISP label probe history is scoped by (default: $ZAPRET_ISP)
+
 Examples:
   sudo python3 zapret-cli.py turbo.cr jpg6.su
   sudo python3 zapret-cli.py -f twitter.com
@@ -228,7 +269,7 @@ Examples:
         if not domains:
             print("Usage: sudo python3 zapret-cli.py -f DOMAIN [DOMAIN...]")
             sys.exit(1)
-        cmd_bypass(domains, fresh=True)
+        cmd_bypass(domains, fresh=True, isp=isp)
     elif cmd == 'bypass':
         # Explicit bypass command
         check_root()
@@ -237,12 +278,12 @@ Examples:
         if not domains:
             print("Usage: sudo python3 zapret-cli.py bypass DOMAIN [DOMAIN...]")
             sys.exit(1)
-        cmd_bypass(domains, fresh=fresh)
+        cmd_bypass(domains, fresh=fresh, isp=isp)
     elif is_domain(cmd):
         # Auto-detect: first arg is domain
         check_root()
         domains = [a for a in args if is_domain(a)]
-        cmd_bypass(domains, fresh=False)
+        cmd_bypass(domains, fresh=False, isp=isp)
     else:
         print(f"Unknown command: {cmd}")
         print("Run without arguments for help.")